@@ -0,0 +1,157 @@
+"""Compares FTPS transfers of small files with and without TLS session reuse.
+
+A local pyftpdlib server, requiring explicit FTPS on control and data
+connections with a self-signed certificate, serves an input directory and
+accepts the uploads of an output directory. The filer moves them one file at
+a time, so that the time per file is the latency of a transfer: without
+session reuse every data connection makes a full TLS handshake, with it they
+resume the session of the control connection.
+
+Needs 'pyftpdlib', 'pyopenssl' and the 'openssl' command:
+
+    $ pip install pyftpdlib pyopenssl
+    $ python benchmarks/ftps_session_reuse.py --files 500 --size 4096
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import TLS_FTPHandler
+from pyftpdlib.servers import FTPServer
+
+from tesk_core import filer_ftp
+from tesk_core.transput import Type
+
+USER = 'tesk'
+PASSWORD = 'tesk'
+
+
+def make_certificate(directory):
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+                    '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                    '-addext', 'subjectAltName=DNS:localhost',
+                    '-keyout', key, '-out', cert],
+                   check=True, capture_output=True)
+    return cert, key
+
+
+def serve_forever(root, cert, key, port):
+    authorizer = DummyAuthorizer()
+    authorizer.add_user(USER, PASSWORD, root, perm='elradfmwMT')
+    handler = TLS_FTPHandler
+    handler.authorizer = authorizer
+    handler.certfile = cert
+    handler.keyfile = key
+    handler.tls_control_required = True
+    handler.tls_data_required = True
+    logging.disable(logging.CRITICAL)
+    FTPServer(('localhost', port), handler).serve_forever()
+
+
+def start_server(root, cert, key, port):
+    # A process of its own, so that the server does not compete with the
+    # filer for the GIL
+    server = multiprocessing.Process(target=serve_forever,
+                                     args=(root, cert, key, port),
+                                     daemon=True)
+    server.start()
+    time.sleep(1)
+    return server
+
+
+def count_resumed():
+    '''
+    Makes the data connections count how many of them resumed a session.
+    '''
+    counts = {'connections': 0, 'resumed': 0}
+    ntransfercmd = filer_ftp.ReusingFTP_TLS.ntransfercmd
+
+    def counting(self, cmd, rest=None):
+        conn, size = ntransfercmd(self, cmd, rest)
+        counts['connections'] += 1
+        counts['resumed'] += conn.session_reused
+        return conn, size
+
+    filer_ftp.ReusingFTP_TLS.ntransfercmd = counting
+    return counts
+
+
+def run(reuse, base_url, work_dir, counts):
+    filer_ftp.TLS_SESSION_REUSE = reuse
+    counts.update(connections=0, resumed=0)
+    local_dir = os.path.join(work_dir, 'reuse' if reuse else 'full')
+
+    started = time.monotonic()
+    down = filer_ftp.FTPTransput(local_dir, base_url + '/in', Type.Directory)
+    assert down.download_dir() == 0
+    download_time = time.monotonic() - started
+
+    started = time.monotonic()
+    up = filer_ftp.FTPTransput(local_dir, base_url + '/out/' +
+                               os.path.basename(local_dir), Type.Directory)
+    assert up.upload_dir() == 0
+    upload_time = time.monotonic() - started
+
+    filer_ftp.close_pool()
+    shutil.rmtree(local_dir)
+    return download_time, upload_time, dict(counts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--size', type=int, default=4096)
+    parser.add_argument('--port', type=int, default=2990)
+    args = parser.parse_args()
+
+    # Only the timings matter
+    logging.disable(logging.CRITICAL)
+    filer_ftp.WORKERS = 1
+    os.environ['TESK_FTP_USERNAME'] = USER
+    os.environ['TESK_FTP_PASSWORD'] = PASSWORD
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        cert, key = make_certificate(work_dir)
+        # The filer trusts the self-signed certificate
+        os.environ['SSL_CERT_FILE'] = cert
+
+        root = os.path.join(work_dir, 'root')
+        os.makedirs(os.path.join(root, 'in'))
+        os.makedirs(os.path.join(root, 'out'))
+        for i in range(args.files):
+            with open(os.path.join(root, 'in', 'file{:06d}'.format(i)),
+                      'wb') as file:
+                file.write(os.urandom(args.size))
+        server = start_server(root, cert, key, args.port)
+        base_url = 'ftps://localhost:{}'.format(args.port)
+        counts = count_resumed()
+
+        print('{} files of {} bytes, one at a time'.format(args.files,
+                                                           args.size))
+        print('{:14} {:>16} {:>16} {:>16}'.format(
+            'session reuse', 'download ms/file', 'upload ms/file',
+            'resumed'))
+        for reuse in (False, True):
+            download_time, upload_time, reuse_counts = run(
+                reuse, base_url, work_dir, counts)
+            print('{:14} {:16.2f} {:16.2f} {:>16}'.format(
+                'yes' if reuse else 'no',
+                download_time / args.files * 1000,
+                upload_time / args.files * 1000,
+                '{resumed}/{connections}'.format(**reuse_counts)))
+        server.terminate()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,169 @@
+"""Compares the requests and HTTP/2 engines of the filer on many small files.
+
+A local Hypercorn server, speaking HTTP/2 over TLS with a self-signed
+certificate, serves an input directory as an HTML index and accepts the PUTs
+of an output directory. Every request is answered after --delay seconds, to
+stand in for the round trip to a remote host.
+
+Needs 'httpx[http2]', 'hypercorn' and the 'openssl' command:
+
+    $ pip install 'httpx[http2]' hypercorn
+    $ python benchmarks/http2_small_files.py --files 2000 --size 4096
+"""
+
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+
+from tesk_core import filer_http
+from tesk_core.transput import Type
+
+
+def make_app(names, size, delay):
+    body = os.urandom(size)
+    index = ''.join('<a href="{0}">{0}</a>'.format(name) for name in names)
+    index = '<html><body>{}</body></html>'.format(index).encode()
+
+    # Client ports of the connections opened since the last /connections
+    clients = set()
+
+    async def app(scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        clients.add(tuple(scope['client']))
+        more_body = True
+        while more_body:
+            message = await receive()
+            more_body = message.get('more_body', False)
+        await asyncio.sleep(delay)
+
+        if scope['path'] == '/connections':
+            status, headers = 200, []
+            content = str(len(clients) - 1).encode()
+            clients.clear()
+        elif scope['method'] == 'PUT':
+            status, headers, content = 201, [], b''
+        elif scope['path'] == '/in/':
+            status, content = 200, index
+            headers = [(b'content-type', b'text/html')]
+        elif scope['path'].startswith('/in/'):
+            status, headers, content = 200, [], body
+        else:
+            status, headers, content = 405, [], b''
+        headers.append((b'content-length', str(len(content)).encode()))
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': headers})
+        await send({'type': 'http.response.body', 'body': content})
+
+    return app
+
+
+def make_certificate(directory):
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048',
+                    '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                    '-addext', 'subjectAltName=DNS:localhost',
+                    '-keyout', key, '-out', cert],
+                   check=True, capture_output=True)
+    return cert, key
+
+
+def serve_forever(app, cert, key, port):
+    config = Config()
+    config.bind = ['localhost:{}'.format(port)]
+    config.certfile = cert
+    config.keyfile = key
+    config.alpn_protocols = ['h2', 'http/1.1']
+    # Hypercorn closes connections after 1000 requests by default, failing
+    # the streams still open on them
+    config.keep_alive_max_requests = 10 ** 9
+    config.loglevel = 'WARNING'
+    config.accesslog = None
+    asyncio.run(serve(app, config))
+
+
+def start_server(app, cert, key, port):
+    # A process of its own, so that the server does not compete with the
+    # filer for the GIL
+    server = multiprocessing.Process(target=serve_forever,
+                                     args=(app, cert, key, port), daemon=True)
+    server.start()
+    time.sleep(1)
+    return server
+
+
+def run(engine, base_url, work_dir):
+    filer_http.select_engine(engine)
+    in_dir = os.path.join(work_dir, engine)
+
+    started = time.monotonic()
+    down = filer_http.HTTPTransput(in_dir, base_url + '/in/',
+                                   Type.Directory)
+    assert down.download_dir() == 0
+    download_time = time.monotonic() - started
+
+    started = time.monotonic()
+    up = filer_http.HTTPTransput(in_dir, base_url + '/out/', Type.Directory)
+    assert up.upload_dir() == 0
+    upload_time = time.monotonic() - started
+
+    filer_http.close_session()
+    shutil.rmtree(in_dir)
+    connections = requests.get(base_url + '/connections').text
+    return download_time, upload_time, connections
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=1000)
+    parser.add_argument('--size', type=int, default=4096)
+    parser.add_argument('--delay', type=float, default=0.01,
+                        help='seconds taken by the server on every request')
+    parser.add_argument('--workers', type=int, default=16,
+                        help='files transferred at once')
+    parser.add_argument('--port', type=int, default=8443)
+    args = parser.parse_args()
+
+    # Only the timings matter
+    logging.disable(logging.CRITICAL)
+    filer_http.DOWNLOAD_WORKERS = args.workers
+    filer_http.UPLOAD_WORKERS = args.workers
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        cert, key = make_certificate(work_dir)
+        # Both engines trust the self-signed certificate
+        os.environ['SSL_CERT_FILE'] = cert
+        os.environ['REQUESTS_CA_BUNDLE'] = cert
+
+        names = ['file{:06d}'.format(i) for i in range(args.files)]
+        server = start_server(make_app(names, args.size, args.delay), cert,
+                              key, args.port)
+        base_url = 'https://localhost:{}'.format(args.port)
+
+        print('{} files of {} bytes, {} workers, {:.0f} ms per request'
+              .format(args.files, args.size, args.workers, args.delay * 1000))
+        print('{:10} {:>12} {:>12} {:>12}'.format(
+            'engine', 'download s', 'upload s', 'connections'))
+        for engine in filer_http.ENGINES:
+            download_time, upload_time, connections = run(engine, base_url,
+                                                          work_dir)
+            print('{:10} {:12.2f} {:12.2f} {:>12}'.format(
+                engine, download_time, upload_time, connections))
+        server.terminate()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,137 @@
+"""Sweeps the S3 multipart settings of the filer on one large object.
+
+The object is uploaded and downloaded again with every combination of part
+size and parts at once asked for, objects of at least a part being sent in
+parts. By default a local moto server stands in for S3; --endpoint points
+the filer at another one, e.g. a local MinIO, with the credentials of the
+environment.
+
+Needs 'moto[server]' for the stand-in:
+
+    $ pip install 'moto[server]<5'
+    $ python benchmarks/s3_transfer_config.py --size 256 \\
+          --chunk-sizes 5,8,16,64 --concurrency 1,4,10,16
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import boto3
+
+from tesk_core import filer_s3
+from tesk_core.transput import Type
+
+MIB = 1024 * 1024
+BUCKET = 'tesk-benchmark'
+
+
+def serve_forever(port):
+    from moto.server import ThreadedMotoServer
+    logging.disable(logging.CRITICAL)
+    ThreadedMotoServer(ip_address='localhost', port=port).start()
+    threading.Event().wait()
+
+
+def start_server(port):
+    # A process of its own, so that the server does not compete with the
+    # filer for the GIL
+    server = multiprocessing.Process(target=serve_forever, args=(port,),
+                                     daemon=True)
+    server.start()
+    time.sleep(2)
+    return server
+
+
+def use_endpoint(endpoint):
+    '''
+    Makes the filer talk to 'endpoint' instead of the endpoint of the AWS
+    configuration.
+    '''
+    get_resource = filer_s3.get_resource
+    filer_s3.get_resource = lambda endpoint_url=None: get_resource(endpoint)
+
+
+def run(path, copy, chunk_size, concurrency, bandwidth):
+    filer_s3.MULTIPART_THRESHOLD = chunk_size
+    filer_s3.MULTIPART_CHUNK_SIZE = chunk_size
+    filer_s3.MAX_CONCURRENCY = concurrency
+    filer_s3.MAX_BANDWIDTH = bandwidth
+    url = 's3://{}/object'.format(BUCKET)
+
+    started = time.monotonic()
+    with filer_s3.S3Transput(path, url, Type.File) as transfer:
+        assert transfer.upload_file() == 0
+    upload_time = time.monotonic() - started
+
+    started = time.monotonic()
+    with filer_s3.S3Transput(copy, url, Type.File) as transfer:
+        assert transfer.download_file() == 0
+    download_time = time.monotonic() - started
+    os.remove(copy)
+    return upload_time, download_time
+
+
+def numbers(value):
+    return [int(number) for number in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=64,
+                        help='MiB of the object')
+    parser.add_argument('--chunk-sizes', type=numbers, default=[5, 8, 16, 32],
+                        help='MiB of a part, comma separated')
+    parser.add_argument('--concurrency', type=numbers, default=[1, 4, 10],
+                        help='parts at once, comma separated')
+    parser.add_argument('--bandwidth', type=int, default=0,
+                        help='bytes per second at most (0: no limit)')
+    parser.add_argument('--endpoint',
+                        help='S3 endpoint to use instead of a local moto '
+                             'server')
+    parser.add_argument('--port', type=int, default=5000)
+    args = parser.parse_args()
+
+    # Only the timings matter
+    logging.disable(logging.CRITICAL)
+    server = None
+    endpoint = args.endpoint
+    if endpoint is None:
+        for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'):
+            os.environ[name] = 'benchmark'
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        server = start_server(args.port)
+        endpoint = 'http://localhost:{}'.format(args.port)
+    use_endpoint(endpoint)
+    boto3.client('s3', endpoint_url=endpoint).create_bucket(Bucket=BUCKET)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        path = os.path.join(work_dir, 'object')
+        with open(path, 'wb') as file:
+            for _ in range(args.size):
+                file.write(os.urandom(MIB))
+
+        print('Object of {} MiB, {}'.format(
+            args.size, endpoint if args.endpoint else 'moto server'))
+        print('{:>10} {:>12} {:>12} {:>14}'.format(
+            'part MiB', 'at once', 'upload MiB/s', 'download MiB/s'))
+        for chunk_size in args.chunk_sizes:
+            for concurrency in args.concurrency:
+                upload_time, download_time = run(
+                    path, os.path.join(work_dir, 'copy'), chunk_size * MIB,
+                    concurrency, args.bandwidth)
+                print('{:>10} {:>12} {:12.1f} {:14.1f}'.format(
+                    chunk_size, concurrency, args.size / upload_time,
+                    args.size / download_time))
+    if server is not None:
+        server.terminate()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -88,6 +88,9 @@ setup(
     # $ pip install -e .[dev,test]
     extras_require={
         'dev': DEV_DEPS,
-        'test': TEST_DEPS
+        'test': TEST_DEPS,
+        'zstd': ['zstandard'],
+        'crc32c': ['crc32c'],
+        'http2': ['httpx[http2]']
     },
 )
@@ -0,0 +1,134 @@
+import os
+import logging
+import tarfile
+import threading
+from tesk_core.compression import (
+    supported_encodings,
+    encoding_writer,
+    decoding_reader
+)
+
+# Archive formats of the 'archive' option, and how each is compressed
+FORMATS = {
+    'tar': None,
+    'tar.gz': 'gzip',
+    'tgz': 'gzip',
+    'tar.zst': 'zstd',
+}
+
+# Extracted members are checked here, newer Pythons check them again
+EXTRACT_ARGS = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+
+
+def archive_encoding(value):
+    '''
+    The compression of the archive format 'value' of the 'archive' option.
+    True picks the best one available.
+
+    >>> archive_encoding('tar.gz')
+    'gzip'
+    >>> archive_encoding('tar') is None
+    True
+    '''
+    if value is True:
+        return supported_encodings()[-1]
+    if value not in FORMATS:
+        raise ValueError('Unknown archive format: {}'.format(value))
+    encoding = FORMATS[value]
+    if encoding is not None and encoding not in supported_encodings():
+        raise ValueError("The {} archive format needs the 'zstandard' "
+                         "package".format(value))
+    return encoding
+
+
+class Packer:
+    '''
+    Binary file reading the directory 'path' as a tar archive compressed with
+    'encoding'. A thread writes the archive into a pipe as it is read, so it
+    is never stored as a whole, in memory or on disk.
+
+    Errors of the thread, e.g. a file that cannot be read, are raised by
+    read() instead of ending the archive early.
+    '''
+
+    def __init__(self, path, encoding):
+        read_fd, write_fd = os.pipe()
+        self.file = os.fdopen(read_fd, 'rb')
+        self.size = 0
+        self.error = None
+        self.thread = threading.Thread(
+            target=self.write, args=(path, encoding, os.fdopen(write_fd, 'wb')),
+            daemon=True)
+        self.thread.start()
+
+    def write(self, path, encoding, pipe):
+        try:
+            with pipe:
+                compressed = encoding_writer(pipe, encoding)
+                # Symbolic links are followed, like the other uploads do
+                with tarfile.open(fileobj=compressed, mode='w|',
+                                  dereference=True) as tar:
+                    for name in sorted(os.listdir(path)):
+                        tar.add(os.path.join(path, name), arcname=name)
+                compressed.close()
+        except BrokenPipeError:
+            # The reader stopped reading, e.g. because the upload failed
+            pass
+        except Exception as err:
+            self.error = err
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        if not data or size is None or size < 0:
+            self.thread.join()
+            if self.error is not None:
+                raise self.error
+        self.size += len(data)
+        return data
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self.file.close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def check_member(member, path):
+    '''
+    Raises ValueError for members of an archive that would be extracted
+    outside of 'path'.
+    '''
+    parts = member.name.replace('\\', '/').split('/')
+    if member.name.startswith('/') or '..' in parts:
+        raise ValueError('Refusing to extract {} outside of "{}"'
+                         .format(member.name, path))
+
+
+def unpack(file, path, encoding):
+    '''
+    Extracts the tar archive read from the binary file 'file', compressed
+    with 'encoding', into the directory 'path', as it is read. Only files and
+    directories are extracted.
+
+    Returns the number of files extracted.
+    '''
+    os.makedirs(path, exist_ok=True)
+    count = 0
+    with tarfile.open(fileobj=decoding_reader(file, encoding),
+                      mode='r|') as tar:
+        for member in tar:
+            check_member(member, path)
+            if not (member.isfile() or member.isdir()):
+                logging.warning('Skipping %s of the archive: only files and '
+                                'directories are extracted', member.name)
+                continue
+            tar.extract(member, path, **EXTRACT_ARGS)
+            count += member.isfile()
+    return count
@@ -0,0 +1,162 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
+# Where the digests computed during a filer run are written, as JSON
+REPORT_PATH = os.environ.get('TESK_FILER_CHECKSUM_REPORT')
+
+
+class Crc32c:
+    '''
+    hashlib-like CRC-32C (Castagnoli), as used by Google Cloud Storage and S3.
+    Needs the optional 'crc32c' package.
+    '''
+
+    def __init__(self):
+        if crc32c is None:
+            raise ValueError("crc32c checksums need the 'crc32c' package")
+        self.value = 0
+
+    def update(self, data):
+        self.value = crc32c.crc32c(data, self.value)
+
+    def hexdigest(self):
+        return '{:08x}'.format(self.value)
+
+
+ALGORITHMS = {
+    'md5': hashlib.md5,
+    'sha256': hashlib.sha256,
+    'crc32c': Crc32c,
+}
+
+
+class Checksum:
+    '''
+    Digest of the bytes of a file, computed as they are written, and the value
+    it is expected to have.
+    '''
+
+    def __init__(self, algorithm, expected):
+        if algorithm not in ALGORITHMS:
+            raise ValueError('Unknown checksum algorithm: {}'.format(algorithm))
+        self.algorithm = algorithm
+        self.expected = expected.lower()
+        self.hash = ALGORITHMS[algorithm]()
+
+    @classmethod
+    def parse(cls, value):
+        '''
+        Builds a Checksum from a '<algorithm>:<hex digest>' option such as
+        'sha256:9f86d0...'. Returns None for no option.
+
+        >>> Checksum.parse('md5:D41D8CD98F00B204E9800998ECF8427E').expected
+        'd41d8cd98f00b204e9800998ecf8427e'
+        '''
+        if value is None:
+            return None
+        algorithm, _, expected = str(value).partition(':')
+        if not expected:
+            raise ValueError("Expected '<algorithm>:<digest>', got '{}'"
+                             .format(value))
+        return cls(algorithm.lower(), expected.strip())
+
+    def update(self, data):
+        self.hash.update(data)
+
+    def reset(self):
+        '''
+        Forgets what was added so far, for a file written again from its
+        start.
+        '''
+        self.hash = ALGORITHMS[self.algorithm]()
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+    def verify(self, path, url):
+        '''
+        Compares the digest of what was written to 'path' with the expected
+        one and records both in the report. Returns 0 if they match, 1 if
+        not.
+        '''
+        digest = self.hexdigest()
+        matches = digest == self.expected
+        add_to_report({'path': path, 'url': url, 'algorithm': self.algorithm,
+                       'digest': digest, 'expected': self.expected,
+                       'ok': matches})
+        if matches:
+            logging.debug('%s checksum of %s is correct', self.algorithm, url)
+            return 0
+        logging.error('%s checksum of %s is %s instead of %s', self.algorithm,
+                      url, digest, self.expected)
+        return 1
+
+
+def hashed(chunks, checksum):
+    '''
+    Yields the chunks of the iterable 'chunks', adding them to 'checksum'
+    on the way.
+    '''
+    for chunk in chunks:
+        checksum.update(chunk)
+        yield chunk
+
+
+def hash_prefix(path, size, checksum, chunk_size=1024 * 1024):
+    '''
+    Adds the first 'size' bytes of the file at 'path' to 'checksum', e.g.
+    those kept of an interrupted download being resumed.
+    '''
+    with open(path, 'rb') as file:
+        while size > 0:
+            chunk = file.read(min(size, chunk_size))
+            if not chunk:
+                break
+            checksum.update(chunk)
+            size -= len(chunk)
+
+
+class HashingWriter:
+    '''
+    Write-only binary file adding everything written to 'file' to
+    'checksum'. It is deliberately not seekable, so that writers (e.g. boto3)
+    write it in order.
+    '''
+
+    def __init__(self, file, checksum):
+        self.file = file
+        self.checksum = checksum
+
+    def write(self, data):
+        self.checksum.update(data)
+        return self.file.write(data)
+
+
+_report = []
+_report_lock = threading.Lock()
+
+
+def add_to_report(entry):
+    with _report_lock:
+        _report.append(entry)
+
+
+def write_report(path=None):
+    '''
+    Writes the digests computed so far to 'path' (REPORT_PATH by default) as
+    a JSON list, if there is a path to write to.
+    '''
+    path = path or REPORT_PATH
+    if not path:
+        return
+    with _report_lock:
+        entries = list(_report)
+    with open(path, 'w') as file:
+        json.dump(entries, file, indent=2)
@@ -0,0 +1,64 @@
+import gzip
+import zlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def supported_encodings():
+    '''
+    The content encodings that can be streamed, in order of preference.
+    'zstd' needs the optional 'zstandard' package.
+    '''
+    return ['gzip', 'zstd'] if zstandard is not None else ['gzip']
+
+
+def decoding_reader(raw, encoding):
+    '''
+    Wraps the binary file 'raw', whose contents are compressed with
+    'encoding', into a file whose read() returns them decompressed, at most
+    as many bytes as asked for at a time.
+    '''
+    if encoding in (None, '', 'identity'):
+        return raw
+    if encoding == 'gzip':
+        return gzip.GzipFile(fileobj=raw, mode='rb')
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().stream_reader(
+            raw, read_across_frames=True)
+    raise ValueError('Unsupported content encoding: {}'.format(encoding))
+
+
+def encoding_writer(raw, encoding):
+    '''
+    Wraps the binary file 'raw' into a file compressing what is written to
+    it with 'encoding' into 'raw'. Closing it writes what is left of the
+    compressed stream, but does not close 'raw'.
+    '''
+    if encoding in (None, '', 'identity'):
+        return raw
+    if encoding == 'gzip':
+        return gzip.GzipFile(fileobj=raw, mode='wb')
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+    raise ValueError('Unsupported content encoding: {}'.format(encoding))
+
+
+def compress_chunks(chunks, encoding):
+    '''
+    Yields the chunks of bytes of the iterable 'chunks' compressed with
+    'encoding'.
+    '''
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    elif encoding == 'zstd' and zstandard is not None:
+        compressor = zstandard.ZstdCompressor().compressobj()
+    else:
+        raise ValueError('Unsupported content encoding: {}'.format(encoding))
+
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
@@ -8,3 +8,20 @@ class FileProtocolDisabled(Exception):
 
 class InvalidHostPath(Exception):
     pass
+
+class RangeIgnored(Exception):
+    '''
+    A server answered a byte range request with the whole resource, because
+    it does not serve ranges of it or the resource changed.
+    '''
+    pass
+
+class TransientTransferError(Exception):
+    '''
+    A transfer failed in a way that may not happen again if it is retried,
+    e.g. the server was overloaded. 'retry_after' is the number of seconds
+    the server asked to wait, if it did.
+    '''
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
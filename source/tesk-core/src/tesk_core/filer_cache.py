@@ -0,0 +1,182 @@
+import os
+import errno
+import json
+import fcntl
+import hashlib
+import logging
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+
+class InputCache:
+    '''
+    Downloaded inputs kept in a directory shared by the filer pods (e.g. a
+    ReadWriteMany volume), along with the validators (ETag, Last-Modified)
+    needed to check that they are still current.
+
+    Layout of the directory:
+
+        objects/<key>       contents of the URL whose SHA-256 is <key>
+        objects/<key>.json  its URL, validators, size and time of last use
+        locks/<key>         held while <key> is looked up, filled or evicted
+        locks/.evict        held while entries are being evicted
+
+    Locks are POSIX record locks, which NFS and CephFS share between nodes.
+    As those are owned by the process, a thread lock is held with each.
+    Lock files are never deleted: a process could still be waiting on one.
+    '''
+
+    def __init__(self, root, max_bytes, link=False):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.link = link
+        self.thread_locks = {}
+        self.thread_locks_lock = threading.Lock()
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(root, 'locks'), exist_ok=True)
+
+    @staticmethod
+    def key(url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def data_path(self, key):
+        return os.path.join(self.root, 'objects', key)
+
+    def meta_path(self, key):
+        return self.data_path(key) + '.json'
+
+    @contextmanager
+    def locked(self, name, blocking=True):
+        '''
+        Holds the lock 'name' (an entry key) while active, yielding whether
+        it was acquired. It always is unless 'blocking' is False.
+        '''
+        with self.thread_locks_lock:
+            thread_lock = self.thread_locks.setdefault(name, threading.Lock())
+        if not thread_lock.acquire(blocking):
+            yield False
+            return
+        try:
+            fd = os.open(os.path.join(self.root, 'locks', name),
+                         os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                try:
+                    fcntl.lockf(fd, fcntl.LOCK_EX
+                                | (0 if blocking else fcntl.LOCK_NB))
+                except (BlockingIOError, PermissionError):
+                    yield False
+                    return
+                try:
+                    yield True
+                finally:
+                    fcntl.lockf(fd, fcntl.LOCK_UN)
+            finally:
+                os.close(fd)
+        finally:
+            thread_lock.release()
+
+    def lookup(self, key):
+        '''
+        Returns the metadata of the entry 'key' if it is complete, else None.
+        Must be called holding the lock of 'key'.
+        '''
+        try:
+            with open(self.meta_path(key)) as file:
+                meta = json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as err:
+            logging.warning('Ignoring unreadable cache entry %s: %s', key, err)
+            return None
+        if not os.path.exists(self.data_path(key)):
+            return None
+        return meta
+
+    def save_meta(self, key, meta):
+        tmp_path = self.meta_path(key) + '.tmp'
+        with open(tmp_path, 'w') as file:
+            json.dump(meta, file)
+        os.replace(tmp_path, self.meta_path(key))
+
+    def touch(self, key, meta):
+        meta['last_used'] = time.time()
+        self.save_meta(key, meta)
+
+    def store(self, key, url, etag, last_modified, write):
+        '''
+        Replaces the entry 'key' with the bytes written by 'write', a function
+        taking a binary file. Must be called holding the lock of 'key'.
+        '''
+        tmp_path = self.data_path(key) + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            write(file)
+            size = file.tell()
+        os.chmod(tmp_path, 0o444)
+        os.replace(tmp_path, self.data_path(key))
+        self.touch(key, {'url': url, 'etag': etag,
+                         'last_modified': last_modified, 'size': size})
+
+    def copy_to(self, key, path):
+        '''
+        Puts the contents of the entry 'key' at 'path', as a hard link when
+        enabled and possible, as a copy otherwise.
+        '''
+        if self.link:
+            try:
+                if os.path.lexists(path):
+                    os.remove(path)
+                os.link(self.data_path(key), path)
+                return
+            except OSError as err:
+                if err.errno != errno.EXDEV:
+                    logging.debug('Cannot link cached %s, copying it: %s',
+                                  key, err)
+                else:
+                    # Separate volumes, as the cache and task volumes are
+                    # when mounted apart: no entry can ever be linked
+                    logging.warning('Cannot hard link cached inputs to %s, '
+                                    'not on the file system of the cache %s. '
+                                    'Copying them instead.', path, self.root)
+                    self.link = False
+        shutil.copyfile(self.data_path(key), path)
+
+    def entries(self):
+        for name in os.listdir(os.path.join(self.root, 'objects')):
+            if not name.endswith('.json'):
+                continue
+            key = name[:-len('.json')]
+            try:
+                with open(self.meta_path(key)) as file:
+                    yield key, json.load(file)
+            except (OSError, ValueError):
+                continue
+
+    def evict(self):
+        '''
+        Removes the least recently used entries until the cache holds at most
+        'max_bytes'. Entries in use are skipped.
+        '''
+        if self.max_bytes <= 0:
+            return
+        with self.locked('.evict', blocking=False) as acquired:
+            # Some other filer is already evicting
+            if not acquired:
+                return
+            entries = sorted(self.entries(),
+                             key=lambda entry: entry[1].get('last_used', 0))
+            total = sum(meta.get('size', 0) for _, meta in entries)
+            for key, meta in entries:
+                if total <= self.max_bytes:
+                    break
+                with self.locked(key, blocking=False) as acquired:
+                    if not acquired:
+                        continue
+                    for path in (self.meta_path(key), self.data_path(key)):
+                        try:
+                            os.remove(path)
+                        except FileNotFoundError:
+                            pass
+                    total -= meta.get('size', 0)
+                    logging.debug('Evicted %s from the cache', meta.get('url'))
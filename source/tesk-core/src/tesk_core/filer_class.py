@@ -3,6 +3,10 @@ from tesk_core import path
 from tesk_core.path import fileEnabled
 
 
+# Environment variables of the taskmaster with this prefix tune the transfers
+# (e.g. TESK_FILER_HTTP_SEGMENTS) and are passed on to the filer unchanged
+TRANSFER_SETTINGS_PREFIX = 'TESK_FILER_'
+
 class Filer:
 
     def getVolumes(self):           return self.spec['spec']['template']['spec']['volumes']
@@ -129,6 +133,19 @@ class Filer:
         """
         self.spec['spec'].update({"backoffLimit": limit})
 
+    def set_transfer_settings(self, environ):
+        """Pass the transfer settings found in 'environ' on to the filer container. Use environment
+        variables such as TESK_API_TASKMASTER_ENVIRONMENT_TESK_FILER_HTTP_SEGMENTS to set them.
+
+        Args:
+            environ: A mapping of environment variables, whose names starting with TESK_FILER_ are
+                     copied to the filer environment.
+        """
+        env = self.getEnv()
+        for name in sorted(environ):
+            if name.startswith(TRANSFER_SETTINGS_PREFIX):
+                env.append({"name": name, "value": environ[name]})
+
     def add_volume_mount(self, pvc):
         self.getVolumeMounts().extend(pvc.volume_mounts)
         self.getVolumes().append({"name": "task-volume",
@@ -136,6 +153,25 @@ class Filer:
                                       "claimName": pvc.name}})
 
 
+    def add_cache_mount(self, pvc_name, mount_path='/cache'):
+        '''
+            Mounts the (ReadWriteMany) volume claimed by 'pvc_name' at 'mount_path' and makes
+            the filer cache its HTTP inputs there, so that filers of all tasks share them.
+        '''
+
+        self.getVolumeMounts().append({"name"      : 'input-cache',
+                                       "mountPath" : mount_path
+                                      })
+        self.getVolumes().append({"name"                  : 'input-cache',
+                                  "persistentVolumeClaim" : {
+                                      "claimName" : pvc_name
+                                  }
+                                 })
+        self.getEnv().append({"name": "TESK_FILER_HTTP_CACHE_DIR",
+                              "value": mount_path
+                            })
+
+
     def add_netrc_mount(self, netrc_name='netrc'):
         '''
             Sets $HOME to an arbitrary location (to prevent its change as a result of runAsUser), currently hardcoded to `/opt/home`
@@ -0,0 +1,1038 @@
+import ftplib
+import os
+import re
+import calendar
+import logging
+import socket
+import time
+import ssl
+import threading
+from collections import namedtuple
+import distutils.dir_util
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager, nullcontext
+from ftplib import FTP
+from tesk_core.path import getIntEnv, getBoolEnv
+from tesk_core.transput import Transput, Type, urlparse
+from tesk_core.checksum import HashingWriter, hash_prefix
+from tesk_core.retry import with_retries
+
+# Files of a directory transferred at once, each over a connection of its
+# own, and the most connections open to a single host (0 for no limit)
+WORKERS = getIntEnv('TESK_FILER_FTP_WORKERS', 4)
+HOST_CONNECTIONS = getIntEnv('TESK_FILER_FTP_HOST_CONNECTIONS', 8)
+
+# Whether the data connections of FTPS resume the TLS session of their
+# control connection instead of each negotiating one. Servers such as
+# vsftpd with require_ssl_reuse refuse those that do not.
+TLS_SESSION_REUSE = getBoolEnv('TESK_FILER_FTP_TLS_SESSION_REUSE', True)
+
+# Whether uploads of directories leave out the files the server already has
+# with the same size, modified since the local copy was
+SYNC = getBoolEnv('TESK_FILER_FTP_SYNC')
+
+# Whether a file whose transfer was interrupted is continued from where it
+# stopped, with REST (or APPE), when it is retried
+RESUME = getBoolEnv('TESK_FILER_FTP_RESUME', True)
+
+# A line of the LIST output of Unix-like servers, which is all LIST is parsed
+# for when a server does not support MLSD.
+# This is horrible and I'm sorry but it works flawlessly.
+# Credit to Chris Haas for writing this
+# See https://stackoverflow.com/questions/966578/parse-response-from-ftp-list-command-syntax-variations
+# for attribution
+LIST_LINE = re.compile(
+    r'^(?P<dir>[\-ld])(?P<permission>([\-r][\-w][\-xs]){3})\s+(?P<filecode>\d+)\s+(?P<owner>\w+)\s+(?P<group>\w+)\s+(?P<size>\d+)\s+(?P<timestamp>((\w{3})\s+(\d{2})\s+(\d{1,2}):(\d{2}))|((\w{3})\s+(\d{1,2})\s+(\d{4})))\s+(?P<name>.+)$')
+
+LIST_TOTAL = re.compile(r'^total\s+\d+\s*$')
+
+# An entry of a remote directory. 'size' and 'modified' (in seconds since
+# the epoch) are None when the server does not tell them.
+FTPEntry = namedtuple('FTPEntry', ['name', 'is_dir', 'size', 'modified'],
+                      defaults=[None])
+
+
+class ReusingFTP_TLS(ftplib.FTP_TLS):
+    '''
+    FTP_TLS (explicit FTPS) whose data connections resume the TLS session of
+    the control connection, sparing a full handshake for every file, if
+    TLS_SESSION_REUSE.
+    '''
+
+    def ntransfercmd(self, cmd, rest=None):
+        conn, size = FTP.ntransfercmd(self, cmd, rest)
+        # The last TLS records of a file, and the closure alert, would
+        # otherwise wait for the delayed ACK of the previous ones
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self._prot_p:
+            session = self.sock.session if TLS_SESSION_REUSE else None
+            conn = self.context.wrap_socket(conn, server_hostname=self.host,
+                                            session=session)
+        return conn, size
+
+
+def split_netloc(netloc):
+    '''
+    Returns the host and port (0 for the default one) of 'netloc'.
+
+    >>> split_netloc('ftp.example.org'), split_netloc('[::1]:2121')
+    (('ftp.example.org', 0), ('::1', 2121))
+    '''
+    parsed = urlparse('//' + netloc)
+    return parsed.hostname, parsed.port or 0
+
+
+def is_dropped(err):
+    '''
+    Whether 'err' means that the control connection was lost, e.g. closed by
+    the server after being idle (421).
+    '''
+    if isinstance(err, ftplib.error_temp):
+        return str(err).startswith('421')
+    return isinstance(err, (EOFError, ConnectionError, TimeoutError))
+
+
+class FTPConnection:
+    '''
+    Control connection to the server at 'netloc', shared by the transputs of
+    a directory so that it is logged into once. It is opened when first
+    used, and opened again if the server drops it.
+
+    It carries one command at a time: threads sharing it hold it as a
+    context manager while they use it.
+
+    'dirs' maps the remote directories known to exist to whether they were
+    created in this run, sparing the round trips checking for them again.
+    Connections to the same host can share it.
+
+    With 'tls', it is secured with explicit FTPS (AUTH TLS), as are its data
+    connections (PROT P).
+    '''
+
+    def __init__(self, netloc, netrc_file, ftp=None, dirs=None, tls=False):
+        self.netloc = netloc
+        self.netrc_file = netrc_file
+        self._ftp = ftp
+        self.tls = tls
+        self.dirs = {} if dirs is None else dirs
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.lock.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.lock.release()
+
+    @property
+    def ftp(self):
+        if self._ftp is None:
+            if self.tls:
+                ftp = ReusingFTP_TLS(context=ssl.create_default_context())
+            else:
+                ftp = FTP()
+            ftp.connect(*split_netloc(self.netloc))
+            # FTP_TLS secures the control connection before logging in
+            ftp_login(ftp, self.netloc, self.netrc_file)
+            if self.tls:
+                ftp.prot_p()
+            self._ftp = ftp
+        return self._ftp
+
+    def reconnect(self):
+        logging.info('Reconnecting to %s', self.netloc)
+        self.close()
+        return self.ftp
+
+    def run(self, action):
+        '''
+        Returns action(), calling it again on a new connection if the current
+        one turns out to have been dropped.
+        '''
+        try:
+            return action()
+        except (ftplib.error_temp, EOFError, OSError) as err:
+            if not is_dropped(err):
+                raise
+            logging.warning('Lost the connection to %s: %s', self.netloc,
+                            err)
+        self.reconnect()
+        return action()
+
+    def close(self):
+        if self._ftp is None:
+            return
+        try:
+            self._ftp.close()
+        except (ftplib.Error, OSError):
+            pass
+        self._ftp = None
+
+
+class FTPPool:
+    '''
+    Connections logged into FTP servers, kept open to be reused by the
+    transfers of the whole run. At most 'host_connections' of them are open
+    to a host at once (0 for no limit); transfers wait for one to be free.
+    '''
+
+    def __init__(self, host_connections):
+        self.host_connections = host_connections
+        self.idle = {}
+        self.slots = {}
+        self.dirs = {}
+        self.lock = threading.Lock()
+
+    def slot(self, netloc):
+        with self.lock:
+            if netloc not in self.slots:
+                self.slots[netloc] = (
+                    threading.BoundedSemaphore(self.host_connections)
+                    if self.host_connections > 0 else nullcontext())
+            return self.slots[netloc]
+
+    @contextmanager
+    def connection(self, netloc, netrc_file, tls=False):
+        '''
+        Context manager lending an FTPConnection to 'netloc', secured with
+        TLS if 'tls', while active. It only logs in when first used.
+        '''
+        with self.slot(netloc):
+            with self.lock:
+                idle = self.idle.setdefault((netloc, tls), [])
+                dirs = self.dirs.setdefault(netloc, {})
+                connection = (idle.pop() if idle
+                              else FTPConnection(netloc, netrc_file,
+                                                 dirs=dirs, tls=tls))
+            try:
+                yield connection
+            except BaseException:
+                # It could be left in the middle of a command
+                connection.close()
+                raise
+            finally:
+                with self.lock:
+                    idle.append(connection)
+
+    def close(self):
+        with self.lock:
+            connections = [connection for idle in self.idle.values()
+                           for connection in idle]
+            self.idle.clear()
+        for connection in connections:
+            connection.close()
+
+
+_pool = FTPPool(HOST_CONNECTIONS)
+
+
+def close_pool():
+    '''
+    Closes the connections the pool keeps open.
+    '''
+    _pool.close()
+
+
+# How far the transfers whose last attempt raised an exception got, in
+# bytes of the file that went through a data connection of this run, for
+# the retries to go on from there
+_transferred = {}
+
+
+@contextmanager
+def attempt(*transfer):
+    '''
+    Context manager for an attempt at 'transfer'. It yields the bytes earlier,
+    interrupted attempts at it are known to have transferred (0 if none) and
+    a function recording the position this one reaches, so that the next
+    attempt can go on from where this one stopped.
+    '''
+    done = _transferred.get(transfer, 0) if RESUME else 0
+
+    def reached(position):
+        _transferred[transfer] = position
+    yield done, reached
+    # Only reached if no exception was raised
+    _transferred.pop(transfer, None)
+
+
+class FTPTransput(Transput):
+    def __init__(self, path, url, ftype, ftp_conn=None, options=None):
+        Transput.__init__(self, path, url, ftype, options)
+
+        self.connection_owner = ftp_conn is None
+        if not isinstance(ftp_conn, FTPConnection):
+            ftp_conn = FTPConnection(self.netloc, self.netrc_file, ftp_conn,
+                                     tls=urlparse(url).scheme == 'ftps')
+        self.connection = ftp_conn
+        # Size of the file to download, when known from a listing
+        self.size = None
+
+    @property
+    def ftp_connection(self):
+        return self.connection.ftp
+
+    # entice users to use contexts when using this class
+    def __enter__(self):
+        # The connection is opened when first used
+        return self
+
+    def borrow(self):
+        '''
+        Context manager lending a connection for a listing or the transfer of
+        a file of this directory: one of the pool, or the one this transput
+        was given, which is then shared by the transfers one at a time.
+        '''
+        if self.connection_owner:
+            return _pool.connection(self.netloc, self.netrc_file,
+                                    self.connection.tls)
+        return self.connection
+
+    def workers(self):
+        return max(WORKERS, 1) if self.connection_owner else 1
+
+    def transfer_file(self, direction, path, url, size=None):
+        '''
+        Uploads or downloads, as 'direction' says, the file at 'path' to or
+        from 'url' over a borrowed connection. Returns 0 or 1.
+        '''
+        logging.debug('FTP %s of "%s" to or from %s', direction, path, url)
+        try:
+            with self.borrow() as connection:
+                transfer = FTPTransput(path, url, Type.File, connection)
+                transfer.size = size
+                action = getattr(transfer, direction)
+                return with_retries(lambda: connection.run(action), url)
+        except ftplib.all_errors:
+            logging.exception('Unable to %s "%s"', direction, url)
+            return 1
+
+    def report_failed(self, direction, files, results):
+        failed = [item for item, result in zip(files, results) if result]
+        if failed:
+            logging.error('Unable to %s %d of %d files of "%s":', direction,
+                          len(failed), len(files), self.path)
+            for file_path, file_url in failed:
+                logging.error('  "%s" - %s', file_path, file_url)
+            return 1
+        return 0
+
+    def upload_dir(self):
+        files = []
+        dirs = set()
+        pending = [(self.path, self.url)]
+        # We recurse into the directories, ending with files which are
+        # uploaded. Downside is nothing happens with empty dirs.
+        while pending:
+            dir_path, dir_url = pending.pop(0)
+            for file in sorted(os.listdir(dir_path)):
+                file_path = dir_path + '/' + file
+                file_url = dir_url + '/' + file
+
+                if os.path.isdir(file_path):
+                    pending.append((file_path, file_url))
+                elif os.path.isfile(file_path):
+                    files.append((file_path, file_url))
+                    dirs.add(os.path.dirname(urlparse(file_url).path))
+                else:
+                    logging.error(
+                        'Directory listing in is neither file nor directory: '
+                        '"%s"', file_url)
+                    return 1
+
+        # Created beforehand, so that concurrent uploads do not race to
+        # create them
+        with self.borrow() as connection:
+            for path in sorted(dirs):
+                if connection.run(lambda: ftp_make_dirs(
+                        connection.ftp, path, connection.dirs)):
+                    logging.error('Unable to create remote directory %s',
+                                  path)
+                    return 1
+            known_dirs = connection.dirs
+
+        with ThreadPoolExecutor(max_workers=self.workers()) as executor:
+            if SYNC:
+                unchanged = self.unchanged_files(files, known_dirs, executor)
+                if unchanged:
+                    logging.info('Leaving out %d of %d files of "%s", '
+                                 'unchanged on the server', len(unchanged),
+                                 len(files), self.path)
+                    files = [item for item in files if item not in unchanged]
+            results = list(executor.map(
+                lambda item: self.transfer_file('upload', *item), files))
+        return self.report_failed('upload', files, results)
+
+    def unchanged_files(self, files, known_dirs, executor):
+        '''
+        Returns the (path, url) pairs of 'files' whose remote copy has the
+        size of the local file and was modified since it. Each remote
+        directory is listed once, with 'executor'; those this run created
+        ('known_dirs', as kept by FTPConnection) are known to be empty.
+        '''
+        by_dir = {}
+        for path, url in files:
+            dir_url = url.rsplit('/', 1)[0]
+            if not known_dirs.get(urlparse(dir_url).path):
+                by_dir.setdefault(dir_url, []).append((path, url))
+
+        def unchanged_in(dir_url):
+            entries = self.list_dir(dir_url)
+            if entries is None:
+                return []
+            remote = {entry.name: entry for entry in entries
+                      if not entry.is_dir}
+            return [(path, url) for path, url in by_dir[dir_url]
+                    if self.is_unchanged(path, url,
+                                         remote.get(url.rsplit('/', 1)[1]))]
+
+        return {item for items in executor.map(unchanged_in, by_dir)
+                for item in items}
+
+    def is_unchanged(self, path, url, entry):
+        '''
+        Whether the remote file 'entry' (an FTPEntry, None if missing) has
+        the size of the local file at 'path' and was modified since it.
+        Without the time in the listing, it is asked with MDTM.
+        '''
+        stat = os.stat(path)
+        if entry is None or entry.size != stat.st_size:
+            return False
+        modified = entry.modified
+        if modified is None:
+            url_path = urlparse(url).path
+            with self.borrow() as connection:
+                modified = connection.run(
+                    lambda: ftp_modified(connection.ftp, url_path))
+        return modified is not None and modified >= int(stat.st_mtime)
+
+    def upload_file(self):
+        error = ftp_make_dirs(self.ftp_connection,
+                              os.path.dirname(self.url_path),
+                              self.connection.dirs)
+        if error:
+            logging.error(
+                'Unable to create remote directories needed for %s',
+                self.url
+            )
+            return 1
+
+        if not ftp_check_directory(self.ftp_connection, self.url_path,
+                                   self.connection.dirs):
+            return 1
+
+        with attempt('upload', self.path, self.url) as (sent, reached):
+            offset = 0
+            received = None
+            if sent:
+                # The remote file may be one that was there before, or hold
+                # less than was sent: only what both agree on is kept
+                received = ftp_remote_size(self.ftp_connection,
+                                           '/' + self.url_path)
+                if received is not None:
+                    offset = resume_offset(min(sent, received),
+                                           os.path.getsize(self.path))
+            return ftp_upload_file(self.ftp_connection, self.path,
+                                   self.url_path, offset, reached,
+                                   append=offset == received)
+
+    def upload_fileobj(self, file):
+        if ftp_make_dirs(self.ftp_connection, os.path.dirname(self.url_path),
+                         self.connection.dirs):
+            logging.error(
+                'Unable to create remote directories needed for %s',
+                self.url
+            )
+            return 1
+        try:
+            self.ftp_connection.storbinary("STOR /" + self.url_path, file)
+        except (ftplib.error_reply, ftplib.error_perm):
+            logging.exception('Unable to upload to "%s"', self.url)
+            return 1
+        return 0
+
+    def download_fileobj(self, consume):
+        try:
+            self.ftp_connection.voidcmd('TYPE I')
+            with self.ftp_connection.transfercmd(
+                    'RETR ' + self.url_path) as data_connection:
+                with data_connection.makefile('rb') as file:
+                    consume(file)
+            self.ftp_connection.voidresp()
+        except (ftplib.error_reply, ftplib.error_perm):
+            logging.exception('Unable to download "%s"', self.url)
+            return 1
+        return 0
+
+    def list_dir(self, dir_url):
+        '''
+        Returns the FTPEntry of the directory at 'dir_url', None if it
+        cannot be listed.
+        '''
+        dir_url_path = urlparse(dir_url).path
+        try:
+            with self.borrow() as connection:
+                return with_retries(
+                    lambda: connection.run(lambda: ftp_list_dir(
+                        connection.ftp, dir_url_path)),
+                    dir_url, failed=None)
+        # ValueError: a LIST line in a format it does not know
+        except ftplib.all_errors + (ValueError,):
+            logging.exception('Unable to list "%s"', dir_url)
+            return None
+
+    def plan_download(self):
+        '''
+        Lists the whole remote tree of the directory, its subdirectories
+        concurrently. Returns the local directories it needs, the (path,
+        url, size) of its files, and whether some listing failed.
+        '''
+        dirs = [self.path]
+        files = []
+        listing_failed = False
+        with ThreadPoolExecutor(max_workers=self.workers()) as executor:
+            pending = {executor.submit(self.list_dir, self.url):
+                       (self.path, self.url)}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    dir_path, dir_url = pending.pop(future)
+                    entries = future.result()
+                    if entries is None:
+                        listing_failed = True
+                        continue
+                    for entry in entries:
+                        path = dir_path + '/' + entry.name
+                        url = dir_url + '/' + entry.name
+                        if entry.is_dir:
+                            dirs.append(path)
+                            pending[executor.submit(self.list_dir, url)] = (
+                                path, url)
+                        else:
+                            files.append((path, url, entry.size))
+        return dirs, files, listing_failed
+
+    def download_dir(self):
+        logging.debug('Processing ftp dir: %s target: %s', self.url, self.path)
+
+        dirs, files, listing_failed = self.plan_download()
+        logging.info('Downloading %d files (%d bytes) in %d directories '
+                     'from %s', len(files),
+                     sum(size or 0 for _, _, size in files), len(dirs),
+                     self.url)
+        for path in dirs:
+            os.makedirs(path, exist_ok=True)
+
+        # Largest first, so that no large file is left to transfer alone
+        # at the end
+        files.sort(key=lambda file: (-(file[2] or 0), file[0]))
+        with ThreadPoolExecutor(max_workers=self.workers()) as executor:
+            results = list(executor.map(
+                lambda file: self.transfer_file('download', *file), files))
+        return self.report_failed('download', [file[:2] for file in files],
+                                  results) or int(listing_failed)
+
+    def download_file(self):
+        logging.debug('Downloading ftp file: "%s" Target: %s', self.url,
+                      self.path)
+        basedir = os.path.dirname(self.path)
+        distutils.dir_util.mkpath(basedir)
+
+        with attempt('download', self.url, self.path) as (received,
+                                                          reached):
+            offset = 0
+            size = self.size
+            if received and os.path.exists(self.path):
+                size = ftp_remote_size(self.ftp_connection, self.url_path)
+                offset = resume_offset(
+                    min(received, os.path.getsize(self.path)), size)
+            return ftp_download_file(self.ftp_connection, self.url_path,
+                                     self.path, self.checksum, size,
+                                     offset, reached) or self.verify_checksum()
+
+    def delete(self):
+        if self.connection_owner:
+            self.connection.close()
+
+
+def ftp_login(ftp_connection, netloc, netrc_file):
+    user = None
+    if netrc_file is not None:
+        creds = netrc_file.authenticators(netloc)
+        if creds:
+            user, _, password = creds
+    elif 'TESK_FTP_USERNAME' in os.environ and 'TESK_FTP_PASSWORD' in os.environ:
+        user = os.environ['TESK_FTP_USERNAME']
+        password = os.environ['TESK_FTP_PASSWORD']
+
+    if user:
+        try:
+            ftp_connection.login(user, password)
+        except ftplib.error_perm:
+            ftp_connection.login()
+    else:
+        ftp_connection.login()
+
+
+# Hosts found not to support MLSD, which are listed with LIST
+_no_mlsd = set()
+# Hosts found not to support MLST, whose paths are checked with CWD
+_no_mlst = set()
+
+
+def ftp_list_dir(ftp_connection, path):
+    '''
+    Returns the FTPEntry of the files and directories in the directory
+    'path', listed with MLSD or, on servers without it, LIST.
+    '''
+    host = getattr(ftp_connection, 'host', None)
+    if host not in _no_mlsd:
+        try:
+            return mlsd_entries(ftp_connection.mlsd(
+                path, ['type', 'size', 'modify']))
+        except ftplib.error_perm as err:
+            # 500 and 502: unknown or unimplemented command
+            if not str(err).startswith(('500', '502')):
+                raise
+            logging.debug('%s does not support MLSD, using LIST', host)
+            _no_mlsd.add(host)
+
+    ftp_connection.cwd(path)
+    lines = []
+    ftp_connection.retrlines('LIST', lines.append)
+    return list_entries(lines)
+
+
+def mlsd_entries(facts):
+    '''
+    Turns the (name, facts) pairs of an MLSD listing into FTPEntry, leaving
+    out the directory itself and its parent. What is neither file nor
+    directory, e.g. a symbolic link, is left out with a warning, as in
+    list_entries.
+
+    >>> mlsd_entries([('.', {'type': 'cdir'}),  # doctest: +NORMALIZE_WHITESPACE
+    ...               ('a', {'type': 'file', 'size': '3',
+    ...                      'modify': '20200101000000.123'}),
+    ...               ('b', {'type': 'dir'}),
+    ...               ('c', {'type': 'OS.unix=slink:/x'})])
+    [FTPEntry(name='a', is_dir=False, size=3, modified=1577836800),
+     FTPEntry(name='b', is_dir=True, size=None, modified=None)]
+    '''
+    entries = []
+    for name, fact in facts:
+        kind = fact.get('type', '').lower()
+        if kind in ('cdir', 'pdir'):
+            continue
+        if kind not in ('file', 'dir'):
+            logging.warning('Skipping "%s", which is neither a file nor a '
+                            'directory (type %s)', name,
+                            fact.get('type') or 'unknown')
+            continue
+        size = fact.get('size')
+        entries.append(FTPEntry(name, kind == 'dir',
+                                int(size) if size and size.isdigit() else None,
+                                parse_ftp_time(fact.get('modify'))))
+    return entries
+
+
+def parse_ftp_time(value):
+    '''
+    Returns the seconds since the epoch of a time as given by MLSD and MDTM,
+    YYYYMMDDHHMMSS[.sss] in UTC, None if it is not one.
+
+    >>> parse_ftp_time('20200101000000'), parse_ftp_time('yesterday')
+    (1577836800, None)
+    '''
+    try:
+        return calendar.timegm(time.strptime(value[:14], '%Y%m%d%H%M%S'))
+    except (TypeError, ValueError):
+        return None
+
+
+def ftp_modified(ftp_connection, path):
+    '''
+    Returns the time the remote file 'path' was last modified, in seconds
+    since the epoch, as told by MDTM. None if it cannot be told.
+    '''
+    try:
+        response = ftp_connection.sendcmd('MDTM ' + path)
+    except (ftplib.error_reply, ftplib.error_perm):
+        return None
+    code, _, value = response.partition(' ')
+    return parse_ftp_time(value.strip()) if code == '213' else None
+
+
+def list_entries(lines):
+    '''
+    Turns the lines of a LIST listing into FTPEntry, skipping its 'total'
+    line. Symbolic links are left out with a warning, as in mlsd_entries.
+    Raises ValueError for a line that cannot be parsed, rather than leaving
+    out an entry.
+
+    >>> list_entries(['total 8',  # doctest: +NORMALIZE_WHITESPACE
+    ...               '-rw-r--r--   1 tesk tesk   42 Jan 01  2020 a file',
+    ...               'drwxr-xr-x   2 tesk tesk 4096 Jan 01 10:00 sub'])
+    [FTPEntry(name='a file', is_dir=False, size=42, modified=None),
+     FTPEntry(name='sub', is_dir=True, size=4096, modified=None)]
+    '''
+    entries = []
+    for line in lines:
+        matches = LIST_LINE.match(line)
+        if matches is None:
+            if LIST_TOTAL.match(line):
+                continue
+            raise ValueError('Unable to parse LIST line: {}'.format(line))
+        name = matches.group('name')
+        if name in ('.', '..'):
+            continue
+        if matches.group('dir') == 'l':
+            # Named 'link -> target'
+            logging.warning('Skipping "%s", which is neither a file nor a '
+                            'directory (symbolic link)',
+                            name.split(' -> ')[0])
+            continue
+        entries.append(FTPEntry(name, matches.group('dir') == 'd',
+                                int(matches.group('size'))))
+    return entries
+
+
+def ftp_path_type(ftp_connection, path):
+    '''
+    Returns the type ('file', 'dir'...) MLST gives for 'path', in one round
+    trip, or None if there is nothing there. Raises ftplib.error_perm if the
+    server does not support MLST.
+    '''
+    try:
+        response = ftp_connection.sendcmd('MLST ' + path)
+    except ftplib.error_perm as err:
+        if str(err).startswith(('500', '502')):
+            raise
+        return None
+    # The facts come on the line between the 250 ones, followed by the path
+    for line in response.splitlines()[1:-1]:
+        facts = line.strip().partition(' ')[0]
+        for fact in facts.split(';'):
+            name, _, value = fact.partition('=')
+            if name.lower() == 'type':
+                return value.lower()
+    return None
+
+
+def ftp_check_directory(ftp_connection, path, dirs=None):
+    """
+    Following convention with the rest of the code,
+    return 0 if it is a directory, 1 if it is not or failed to do the check
+
+    'dirs' are the directories known to exist, mapped to whether this run
+    created them, as kept by FTPConnection. With them, the check is skipped
+    when it can be answered from them and done with MLST if possible.
+    """
+    if dirs is not None:
+        is_directory = path in dirs
+        # Nothing is in a directory this run created but what it put there
+        if not is_directory and dirs.get(os.path.dirname(path)):
+            return 1
+        host = getattr(ftp_connection, 'host', None)
+        if not is_directory and host not in _no_mlst:
+            try:
+                is_directory = ftp_path_type(ftp_connection, path) == 'dir'
+            except ftplib.error_perm:
+                _no_mlst.add(host)
+                return ftp_check_directory(ftp_connection, path)
+            except (ftplib.error_reply, ftplib.error_temp):
+                logging.exception(
+                    'Could not check if path "%s" in "%s" is directory',
+                    path, host)
+                return 1
+        if is_directory:
+            logging.error(
+                'Path "%s" at "%s" already exists and is a folder. \
+                Please specify a target filename and retry',
+                path, host)
+        return 0 if is_directory else 1
+
+    response = ftp_connection.pwd()
+    if response == '':
+        return 1
+    original_directory = response
+
+    # We are NOT scp, so we won't create a file when filename is not
+    # specified (mirrors input behaviour)
+    try:
+        ftp_connection.cwd(path)
+        logging.error(
+            'Path "%s" at "%s" already exists and is a folder. \
+            Please specify a target filename and retry',
+            path, ftp_connection.host)
+        is_directory = True
+    except ftplib.error_perm:
+        is_directory = False
+    except (ftplib.error_reply, ftplib.error_temp):
+        logging.exception('Could not check if path "%s" in "%s" is directory',
+                          path, ftp_connection.host)
+        return 1
+    try:
+        ftp_connection.cwd(original_directory)
+    except (ftplib.error_reply, ftplib.error_perm, ftplib.error_temp):
+        logging.exception(
+            'Error when checking if "%s" in "%s" was a directory',
+            path, ftp_connection.host)
+        return 1
+
+    return 0 if is_directory else 1
+
+
+def is_unsupported(err):
+    '''
+    Whether the FTP error 'err' means that the server does not implement the
+    command (or its argument), as opposed to it failing.
+    '''
+    return str(err)[:3] in ('500', '501', '502', '504')
+
+
+def ftp_remote_size(ftp_connection, path):
+    '''
+    Returns the size in bytes of the remote file 'path', None if it cannot be
+    told (e.g. the file does not exist or the server lacks SIZE).
+    '''
+    try:
+        # Sizes are counted in bytes in binary mode only
+        ftp_connection.voidcmd('TYPE I')
+        return ftp_connection.size(path)
+    except (ftplib.error_reply, ftplib.error_perm):
+        return None
+
+
+def resume_offset(done, size):
+    '''
+    Returns where to resume a transfer of which 'done' bytes out of 'size'
+    were made, 0 to start over if that is not known to be safe.
+
+    >>> resume_offset(10, 25), resume_offset(30, 25), resume_offset(None, 25)
+    (10, 0, 0)
+    '''
+    if done is None or size is None or done > size:
+        return 0
+    return done
+
+
+def ftp_upload_file(ftp_connection, local_source_path,
+                    remote_destination_path, offset=0, reached=None,
+                    append=False):
+    '''
+    Uploads the file at 'local_source_path', only from byte 'offset' on if
+    the server already has the bytes before it, with APPE as well if
+    'append' (the remote file ends at 'offset'). 'reached' is called with
+    the position in the file of what was sent so far. Returns 0 or 1.
+    '''
+    remote = "/" + remote_destination_path
+    reached = reached or (lambda position: None)
+    try:
+        with open(local_source_path, 'r+b') as file:
+            def sent(block):
+                reached(file.tell())
+
+            if not offset:
+                reached(0)
+                ftp_connection.storbinary('STOR ' + remote, file,
+                                          callback=sent)
+                return 0
+            if offset == os.fstat(file.fileno()).st_size:
+                logging.info('"%s" was already uploaded', remote)
+                return 0
+            logging.info('Resuming the upload of "%s" at byte %d', remote,
+                         offset)
+            # REST then STOR writes from 'offset' on, as does APPE. If the
+            # server supports neither, the file is sent again whole.
+            for command in ('REST', 'APPE', 'STOR'):
+                if command == 'APPE' and not append:
+                    continue
+                file.seek(0 if command == 'STOR' else offset)
+                reached(file.tell())
+                try:
+                    if command == 'REST':
+                        ftp_connection.storbinary('STOR ' + remote, file,
+                                                  callback=sent, rest=offset)
+                    else:
+                        ftp_connection.storbinary(command + ' ' + remote,
+                                                  file, callback=sent)
+                    break
+                except ftplib.error_perm as err:
+                    if command == 'STOR' or not is_unsupported(err):
+                        raise
+                    logging.debug('Unable to resume with %s: %s', command,
+                                  err)
+    # ftplib.error_temp is left to the retries
+    except (ftplib.error_reply, ftplib.error_perm):
+        logging.exception(
+            'Unable to upload file "%s" to "%s" as "%s"',
+            local_source_path,
+            ftp_connection.host,
+            remote_destination_path)
+        return 1
+    return 0
+
+
+def ftp_download_file(ftp_connection, remote_source_path,
+                      local_destination_path, checksum=None, size=None,
+                      offset=0, reached=None):
+    '''
+    Downloads the remote file 'remote_source_path', of 'size' bytes if
+    known. With an 'offset', the local file already has that many bytes of
+    it and only those after them are fetched. 'reached' is called with the
+    position in the file of what was received so far. Returns 0 or 1.
+    '''
+    reached = reached or (lambda position: None)
+    try:
+        with open(local_destination_path,
+                  'r+b' if offset else 'w+b') as file:
+            if size:
+                preallocate(file, size)
+            if offset:
+                logging.info('Resuming the download of "%s" at byte %d',
+                             remote_source_path, offset)
+                if checksum is not None:
+                    hash_prefix(local_destination_path, offset, checksum)
+                file.seek(offset)
+            writer = file if checksum is None else HashingWriter(file,
+                                                                 checksum)
+
+            def received(block):
+                writer.write(block)
+                reached(file.tell())
+
+            reached(offset)
+            try:
+                if not offset:
+                    ftp_connection.retrbinary("RETR " + remote_source_path,
+                                              received)
+                elif offset != size:
+                    ftp_connection.retrbinary("RETR " + remote_source_path,
+                                              received, rest=offset)
+            finally:
+                # Keeps only what was received, e.g. for the next attempt
+                # to resume from, and not what was preallocated
+                file.truncate(file.tell())
+    except ftplib.error_perm as err:
+        if offset and is_unsupported(err):
+            logging.info('Unable to resume "%s", downloading it again: %s',
+                         remote_source_path, err)
+            if checksum is not None:
+                checksum.reset()
+            return ftp_download_file(ftp_connection, remote_source_path,
+                                     local_destination_path, checksum, size,
+                                     reached=reached)
+        logging.exception(
+            'Unable to download file "%s" from "%s" as "%s"',
+            remote_source_path,
+            ftp_connection.host,
+            local_destination_path
+        )
+        return 1
+    # ftplib.error_temp is left to the retries
+    except ftplib.error_reply:
+        logging.exception(
+            'Unable to download file "%s" from "%s" as "%s"',
+            remote_source_path,
+            ftp_connection.host,
+            local_destination_path
+        )
+        return 1
+    return 0
+
+
+def preallocate(file, size):
+    '''
+    Reserves 'size' bytes of disk for 'file', where the platform allows it,
+    so that it is not fragmented as it is written.
+    '''
+    if not hasattr(os, 'posix_fallocate'):
+        return
+    try:
+        os.posix_fallocate(file.fileno(), 0, size)
+    except OSError as err:
+        logging.debug('Cannot preallocate %d bytes: %s', size, err)
+
+
+def subfolders_in(whole_path):
+    """
+    Returns all subfolders in a path, in order
+
+    >>> subfolders_in('/')
+    ['/']
+
+    >>> subfolders_in('/this/is/a/path')
+    ['/this', '/this/is', '/this/is/a', '/this/is/a/path']
+
+    >>> subfolders_in('this/is/a/path')
+    ['this', 'this/is', 'this/is/a', 'this/is/a/path']
+    """
+    path_fragments = whole_path.lstrip('/').split('/')
+    if whole_path.startswith('/'):
+        path_fragments[0] = '/' + path_fragments[0]
+    path = path_fragments[0]
+    subfolders = [path]
+    for fragment in path_fragments[1:]:
+        path += '/' + fragment
+        subfolders.append(path)
+    return subfolders
+
+
+def ftp_make_dirs(ftp_connection, path, dirs=None):
+    """
+    Creates the remote directory 'path' and its parents where missing.
+    Returns 0 on success, 1 on failure.
+
+    'dirs' are the directories known to exist, mapped to whether this run
+    created them, as kept by FTPConnection. They are not checked again, and
+    those found or created are added to them.
+    """
+    if dirs is None:
+        dirs = {}
+    if path in dirs:
+        return 0
+
+    response = ftp_connection.pwd()
+    if response == '':
+        return 1
+    original_directory = response
+
+    # if directory exists do not do anything else
+    try:
+        ftp_connection.cwd(path)
+        for subfolder in subfolders_in(path):
+            dirs.setdefault(subfolder, False)
+        return 0
+    except (ftplib.error_perm, ftplib.error_temp):
+        pass
+    except ftplib.error_reply:
+        logging.exception('Unable to create directory "%s" at "%s"',
+                          path, ftp_connection.host)
+        return 1
+
+    for subfolder in subfolders_in(path):
+        if subfolder in dirs:
+            continue
+        try:
+            ftp_connection.cwd(subfolder)
+            dirs.setdefault(subfolder, False)
+        except (ftplib.error_perm, ftplib.error_temp):
+            try:
+                ftp_connection.mkd(subfolder)
+                dirs[subfolder] = True
+            except (ftplib.error_reply, ftplib.error_perm, ftplib.error_temp):
+                logging.exception('Unable to create directory "%s" at "%s"',
+                                  subfolder, ftp_connection.host)
+                return 1
+        except ftplib.error_reply:
+            logging.exception('Unable to create directory "%s" at "%s"',
+                              path, ftp_connection.host)
+            return 1
+
+    try:
+        ftp_connection.cwd(original_directory)
+    except (ftplib.error_reply, ftplib.error_perm, ftplib.error_temp):
+        logging.exception('Unable to create directory "%s" at "%s"',
+                          path, ftp_connection.host)
+        return 1
+    return 0
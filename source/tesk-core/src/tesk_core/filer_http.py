@@ -0,0 +1,944 @@
+import os
+import json
+import logging
+import math
+import threading
+import time
+import requests
+import xml.etree.ElementTree as ElementTree
+from contextlib import nullcontext
+from html.parser import HTMLParser
+from urllib.parse import urljoin, unquote, quote
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from tesk_core.path import getIntEnv, getBoolEnv
+from tesk_core.transput import (
+    Transput,
+    Type,
+    log_throughput,
+    urlparse
+)
+from tesk_core.filer_cache import InputCache
+from tesk_core.filer_http2 import H2Session
+from tesk_core.checksum import hashed, hash_prefix
+from tesk_core.exception import RangeIgnored, TransientTransferError
+from tesk_core.retry import with_retries, is_transient_status, parse_retry_after
+from tesk_core.compression import (
+    supported_encodings,
+    decoding_reader,
+    compress_chunks
+)
+
+# Responses are read and written to disk in blocks of this size, so it is
+# also (roughly) the memory a download needs, whatever the size of the file.
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+CHUNK_SIZE = min(getIntEnv('TESK_FILER_HTTP_CHUNK_SIZE', 1024 * 1024),
+                 MAX_CHUNK_SIZE)
+
+# Send uploads with 'Transfer-Encoding: chunked' instead of a Content-Length,
+# for servers that accept it
+UPLOAD_CHUNKED = getBoolEnv('TESK_FILER_HTTP_UPLOAD_CHUNKED')
+
+# Connections kept open per host by the shared session. Set
+# TESK_FILER_HTTP_KEEPALIVE to 'false' to close them after every request.
+POOL_SIZE = getIntEnv('TESK_FILER_HTTP_POOL_SIZE', 10)
+KEEPALIVE = getBoolEnv('TESK_FILER_HTTP_KEEPALIVE', True)
+
+# 'http2' sends the requests of this filer with httpx, multiplexing those to
+# the same host over one HTTP/2 connection, instead of with requests
+ENGINES = ('requests', 'http2')
+ENGINE = os.environ.get('TESK_FILER_HTTP_ENGINE', 'requests')
+
+# Files of at least two segments are fetched as up to SEGMENTS byte ranges
+# at once when the server supports it. 1 disables segmented downloads.
+SEGMENTS = getIntEnv('TESK_FILER_HTTP_SEGMENTS', 1)
+SEGMENT_SIZE = getIntEnv('TESK_FILER_HTTP_SEGMENT_SIZE', 64 * 1024 * 1024)
+
+# Keep unfinished downloads as '<path>.part' plus a '<path>.part.json' record
+# of their progress, so that a new attempt continues them with a Range
+# request instead of starting again. The record is updated every
+# RESUME_CHECKPOINT bytes.
+RESUME = getBoolEnv('TESK_FILER_HTTP_RESUME')
+RESUME_CHECKPOINT = getIntEnv('TESK_FILER_HTTP_RESUME_CHECKPOINT',
+                              64 * 1024 * 1024)
+PARTIAL_SUFFIX = '.part'
+
+# Files of a directory uploaded at once, and the most requests sent at once
+# to a single host by them (0 for no limit besides the number of workers)
+UPLOAD_WORKERS = getIntEnv('TESK_FILER_HTTP_UPLOAD_WORKERS', 4)
+HOST_CONNECTIONS = getIntEnv('TESK_FILER_HTTP_HOST_CONNECTIONS', 0)
+
+# Files of an input directory downloaded at once, while its listing goes on
+DOWNLOAD_WORKERS = getIntEnv('TESK_FILER_HTTP_DOWNLOAD_WORKERS', 4)
+
+# Directory (e.g. a ReadWriteMany volume shared by filer pods) where inputs
+# are cached, revalidated with conditional requests and evicted least
+# recently used first beyond CACHE_MAX_BYTES (0 for no limit). With
+# CACHE_LINK, cached files are hard linked instead of copied, which needs the
+# inputs on the file system of the cache: not with the cache and the task on
+# volumes of their own.
+CACHE_DIR = os.environ.get('TESK_FILER_HTTP_CACHE_DIR')
+CACHE_MAX_BYTES = getIntEnv('TESK_FILER_HTTP_CACHE_MAX_BYTES',
+                            100 * 1024 ** 3)
+CACHE_LINK = getBoolEnv('TESK_FILER_HTTP_CACHE_LINK')
+
+# Error bodies can be arbitrarily big too, only log their beginning
+ERROR_BODY_LIMIT = 4096
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def new_session(pool_size, keepalive=True):
+    '''
+    Creates a requests.Session keeping up to 'pool_size' connections open per
+    host.
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if not keepalive:
+        session.headers['Connection'] = 'close'
+    return session
+
+
+def get_session():
+    '''
+    Returns the session shared by all HTTP transfers of this filer process,
+    so consecutive requests to a host reuse its connections instead of paying
+    a new TCP and TLS handshake each.
+    '''
+    global _session
+    with _session_lock:
+        if _session is None and ENGINE == 'http2':
+            try:
+                _session = H2Session(KEEPALIVE)
+            except ValueError as err:
+                logging.error('%s, using requests instead', err)
+        elif _session is None and ENGINE != 'requests':
+            logging.error('Unknown HTTP engine %s, using requests instead',
+                          ENGINE)
+        if _session is None:
+            # Segments of a file and files of a directory are transferred at
+            # once from a single host
+            pool_size = max(POOL_SIZE, SEGMENTS, UPLOAD_WORKERS,
+                            DOWNLOAD_WORKERS)
+            _session = new_session(pool_size, KEEPALIVE)
+        return _session
+
+
+def select_engine(engine):
+    '''
+    Makes the next requests use 'engine', one of ENGINES.
+    '''
+    global ENGINE
+    if engine not in ENGINES:
+        raise ValueError('Unknown HTTP engine: {}'.format(engine))
+    close_session()
+    ENGINE = engine
+
+
+def close_session():
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+_host_slots = {}
+_host_slots_lock = threading.Lock()
+
+
+def host_slot(url):
+    '''
+    Returns a context manager holding one of the HOST_CONNECTIONS request
+    slots of the host of 'url' while it is active.
+    '''
+    if HOST_CONNECTIONS <= 0:
+        return nullcontext()
+    netloc = urlparse(url).netloc
+    with _host_slots_lock:
+        if netloc not in _host_slots:
+            _host_slots[netloc] = threading.BoundedSemaphore(HOST_CONNECTIONS)
+        return _host_slots[netloc]
+
+
+_cache = None
+
+
+def get_cache():
+    '''
+    Returns the input cache of this process, or None if it is disabled.
+    '''
+    global _cache
+    if CACHE_DIR and (_cache is None or _cache.root != CACHE_DIR):
+        _cache = InputCache(CACHE_DIR, CACHE_MAX_BYTES, CACHE_LINK)
+    return _cache if CACHE_DIR else None
+
+
+def is_success(req):
+    return 200 <= req.status_code < 300
+
+
+def raise_if_transient(req):
+    '''
+    Raises TransientTransferError if the error response 'req' is worth
+    retrying, e.g. 503 or 429, with the delay asked for in its Retry-After.
+    '''
+    if is_transient_status(req.status_code):
+        raise TransientTransferError(
+            'Got status code {}'.format(req.status_code),
+            parse_retry_after(req.headers.get('Retry-After')))
+
+
+def log_error_response(req):
+    logging.error('Got status code: %d', req.status_code)
+    body = next(req.iter_content(ERROR_BODY_LIMIT), b'')
+    logging.error(body.decode('utf-8', errors='replace'))
+
+
+def write_chunks(chunks, file):
+    '''
+    Writes every chunk of the iterable 'chunks' to 'file', returning the
+    number of bytes written.
+    '''
+    size = 0
+    for chunk in chunks:
+        file.write(chunk)
+        size += len(chunk)
+    return size
+
+
+def read_chunks(file, chunk_size):
+    '''
+    Yields the contents of the binary 'file' in blocks of 'chunk_size' bytes.
+    '''
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk
+
+
+def validator_of(headers):
+    '''
+    Returns the value identifying this version of a resource in an If-Range
+    header: its ETag if it is a strong one, else its Last-Modified date.
+    '''
+    etag = headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return headers.get('Last-Modified')
+
+
+def probe_ranges(url):
+    '''
+    Asks the server about 'url' with a HEAD request.
+
+    Returns the size and validator of the resource when the server accepts
+    byte range requests for it, None otherwise.
+    '''
+    try:
+        head = get_session().head(url, allow_redirects=True)
+    except requests.RequestException as err:
+        logging.debug('HEAD %s failed: %s', url, err)
+        return None
+
+    if not is_success(head):
+        return None
+    if head.headers.get('Accept-Ranges', '').lower() != 'bytes':
+        return None
+    # The length of an encoded body is not the length of the file
+    if head.headers.get('Content-Encoding', 'identity') != 'identity':
+        return None
+    try:
+        return int(head.headers['Content-Length']), validator_of(head.headers)
+    except (KeyError, ValueError):
+        return None
+
+
+class ResumeRecord:
+    '''
+    Progress of a download into a partial file, saved next to it so that
+    another attempt (e.g. a filer pod restarted by the Job) can continue it.
+
+    'written' counts the bytes at the start of a streamed download that are
+    safely on disk, 'segments' the byte ranges of a segmented download that
+    are complete. Both only hold as long as the server still answers with
+    'validator'.
+    '''
+
+    def __init__(self, path, url, validator, size=None):
+        self.path = path
+        self.url = url
+        self.validator = validator
+        self.size = size
+        self.written = 0
+        self.segments = []
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, url):
+        '''
+        Reads the record at 'path', returning None if there is no usable
+        record for 'url'.
+        '''
+        try:
+            with open(path) as file:
+                saved = json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as err:
+            logging.warning('Ignoring unreadable resume record %s: %s',
+                            path, err)
+            return None
+
+        if saved.get('url') != url or not saved.get('validator'):
+            return None
+        record = cls(path, url, saved['validator'], saved.get('size'))
+        record.written = saved.get('written', 0)
+        record.segments = [tuple(segment)
+                           for segment in saved.get('segments', [])]
+        return record
+
+    def save(self):
+        # Write a new file and rename it, so a crash never leaves half a record
+        with open(self.path + '.tmp', 'w') as file:
+            json.dump({'url': self.url,
+                       'validator': self.validator,
+                       'size': self.size,
+                       'written': self.written,
+                       'segments': self.segments}, file)
+        os.replace(self.path + '.tmp', self.path)
+
+    def add_segment(self, segment):
+        with self.lock:
+            self.segments.append(segment)
+            self.save()
+
+    def delete(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def sync_to_disk(file):
+    file.flush()
+    os.fsync(file.fileno())
+
+
+def write_checkpointed(chunks, file, record):
+    '''
+    Like write_chunks, but also saves 'record' every RESUME_CHECKPOINT bytes,
+    once the bytes it accounts for are on disk.
+    '''
+    size = 0
+    unsaved = 0
+    for chunk in chunks:
+        file.write(chunk)
+        size += len(chunk)
+        unsaved += len(chunk)
+        if unsaved >= RESUME_CHECKPOINT:
+            sync_to_disk(file)
+            record.written = file.tell()
+            record.save()
+            unsaved = 0
+    return size
+
+
+def plan_segments(size, count, segment_size):
+    '''
+    Splits 'size' bytes in at most 'count' ranges of at least 'segment_size'
+    bytes, as a list of (first, last) inclusive byte offsets.
+
+    >>> plan_segments(10, 3, 2)
+    [(0, 3), (4, 7), (8, 9)]
+
+    >>> plan_segments(10, 3, 6)
+    [(0, 9)]
+    '''
+    count = max(1, min(count, size // max(segment_size, 1)))
+    step = math.ceil(size / count)
+    return [(first, min(first + step, size) - 1)
+            for first in range(0, size, step)]
+
+
+def download_segment(url, path, first, last, validator=None):
+    '''
+    Fetches the bytes 'first' to 'last' of 'url' into the same offsets of the
+    already allocated file at 'path'.
+
+    With a 'validator', the range is only sent if the resource did not change.
+    Raises RangeIgnored if the server answers with the whole resource.
+    '''
+    headers = {'Range': 'bytes={}-{}'.format(first, last)}
+    if validator:
+        headers['If-Range'] = validator
+    with get_session().get(url, headers=headers, stream=True) as req:
+        # 200 is the whole file: the server ignored the range or the
+        # resource changed
+        if req.status_code != 206:
+            if is_success(req):
+                raise RangeIgnored(url)
+            raise_if_transient(req)
+            log_error_response(req)
+            return 1
+
+        with open(path, 'r+b') as file:
+            file.seek(first)
+            size = write_chunks(req.iter_content(CHUNK_SIZE), file)
+            if validator:
+                sync_to_disk(file)
+
+    if size != last - first + 1:
+        logging.error('Got %d bytes instead of %d for range %d-%d of %s',
+                      size, last - first + 1, first, last, url)
+        return 1
+    return 0
+
+
+def download_cached(cache, url, path):
+    '''
+    Downloads 'url' to 'path' through 'cache'. A cached copy is only used
+    after the server confirmed, with a 304 answer to a conditional request,
+    that it is still current.
+    '''
+    started = time.monotonic()
+    key = cache.key(url)
+    with cache.locked(key):
+        meta = cache.lookup(key)
+        headers = {}
+        if meta is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        with get_session().get(url, headers=headers, stream=True) as req:
+            if req.status_code == 304 and meta is not None:
+                logging.info('Cached copy of %s is current', url)
+                cache.touch(key, meta)
+            elif not is_success(req):
+                raise_if_transient(req)
+                log_error_response(req)
+                return 1
+            elif 'ETag' in req.headers or 'Last-Modified' in req.headers:
+                cache.store(key, url, req.headers.get('ETag'),
+                            req.headers.get('Last-Modified'),
+                            lambda file: write_chunks(
+                                req.iter_content(CHUNK_SIZE), file))
+            else:
+                # Could never be revalidated, so not worth caching
+                with open(path, 'wb') as file:
+                    size = write_chunks(req.iter_content(CHUNK_SIZE), file)
+                log_throughput('Downloaded', size, url, started)
+                return 0
+
+        cache.copy_to(key, path)
+        size = os.path.getsize(path)
+
+    cache.evict()
+    log_throughput('Downloaded', size, url, started)
+    return 0
+
+
+def download_encoded(url, path, encodings, checksum=None):
+    '''
+    Downloads 'url' to 'path', letting the server compress it on the wire
+    with any of 'encodings'. It is decompressed as it is written, and added
+    to 'checksum' if given.
+    '''
+    started = time.monotonic()
+    headers = {'Accept-Encoding': ', '.join(encodings)}
+    with get_session().get(url, headers=headers, stream=True) as req:
+        if not is_success(req):
+            raise_if_transient(req)
+            log_error_response(req)
+            return 1
+        logging.debug('OK, got status code: %d', req.status_code)
+
+        encoding = req.headers.get('Content-Encoding')
+        try:
+            reader = decoding_reader(req.raw, encoding)
+        except ValueError as err:
+            logging.error('Unable to download %s: %s', url, err)
+            return 1
+        chunks = read_chunks(reader, CHUNK_SIZE)
+        if checksum is not None:
+            chunks = hashed(chunks, checksum)
+        with open(path, 'wb') as file:
+            size = write_chunks(chunks, file)
+
+    log_throughput('Downloaded', size, url, started)
+    return 0
+
+
+def put_file(path, url, encoding=None):
+    '''
+    Uploads the file at 'path' to 'url', compressed with 'encoding' if given,
+    returning 0 on success and 1 on failure.
+    '''
+    started = time.monotonic()
+    headers = {}
+    with open(path, 'rb') as file:
+        # A file object is sent as it is read, with its size as
+        # Content-Length. A generator makes requests use chunked encoding,
+        # as does an empty file object, which is therefore sent as no data.
+        if encoding:
+            data = compress_chunks(read_chunks(file, CHUNK_SIZE), encoding)
+            headers['Content-Encoding'] = encoding
+        elif UPLOAD_CHUNKED:
+            data = read_chunks(file, CHUNK_SIZE)
+        elif not os.fstat(file.fileno()).st_size:
+            data = b''
+        else:
+            data = file
+        with get_session().put(url, data=data, headers=headers) as req:
+            if not is_success(req):
+                raise_if_transient(req)
+                log_error_response(req)
+                return 1
+            logging.debug('OK, got status code: %d', req.status_code)
+        size = file.tell()
+
+    log_throughput('Uploaded', size, url, started)
+    return 0
+
+
+def list_upload(path, url):
+    '''
+    Walks the local directory 'path' once, pairing every file in it with its
+    URL under 'url'.
+
+    Returns those pairs and the entries that are neither file nor directory.
+    Raises OSError if 'path' or a directory under it cannot be listed.
+    '''
+    def fail(err):
+        raise err
+
+    files = []
+    unknown = []
+    for dirpath, dirnames, filenames in os.walk(path, onerror=fail,
+                                                followlinks=True):
+        dirnames.sort()
+        relative = os.path.relpath(dirpath, path)
+        base_url = url if relative == os.curdir else url + '/' + relative
+        for filename in sorted(filenames):
+            file_path = dirpath + '/' + filename
+            if os.path.isfile(file_path):
+                files.append((file_path, base_url + '/' + filename))
+            else:
+                unknown.append((file_path, base_url + '/' + filename))
+    return files, unknown
+
+
+def upload_concurrently(files, encoding=None):
+    '''
+    Uploads the (path, url) pairs of 'files' with UPLOAD_WORKERS threads,
+    returning the pairs that could not be uploaded.
+    '''
+    def upload(item):
+        path, url = item
+        with host_slot(url):
+            try:
+                return with_retries(lambda: put_file(path, url, encoding), url)
+            except (requests.RequestException, OSError):
+                logging.exception('Unable to upload "%s" to "%s"', path, url)
+                return 1
+
+    with ThreadPoolExecutor(max_workers=max(UPLOAD_WORKERS, 1)) as executor:
+        results = list(executor.map(upload, files))
+    return [item for item, result in zip(files, results) if result]
+
+
+PROPFIND_BODY = (b'<?xml version="1.0" encoding="utf-8"?>'
+                 b'<propfind xmlns="DAV:"><prop><resourcetype/></prop>'
+                 b'</propfind>')
+
+
+class LinkParser(HTMLParser):
+    '''
+    Collects the targets of the links of an HTML page.
+    '''
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            href = dict(attrs).get('href')
+            if href:
+                self.links.append(href)
+
+
+def child_entries(dir_url, hrefs):
+    '''
+    Resolves the 'hrefs' found in the listing of 'dir_url', keeping only those
+    pointing inside it, as (url, is_directory) pairs. Directory URLs end with
+    a slash.
+
+    Paths are compared unquoted, as servers do not all escape the same
+    characters, and the URLs returned are under 'dir_url' as given.
+    '''
+    dir_path = unquote(dir_url)
+    entries = {}
+    for href in hrefs:
+        if href.startswith(('?', '#')):
+            continue
+        path = unquote(urljoin(dir_url, href).split('#')[0].split('?')[0])
+        if not path.startswith(dir_path) or path == dir_path:
+            continue
+        name = path[len(dir_path):]
+        # Only direct children; deeper ones are found when listing those
+        if '/' in name.rstrip('/'):
+            continue
+        entries[dir_url + quote(name)] = name.endswith('/')
+    return sorted(entries.items())
+
+
+def propfind_hrefs(body):
+    '''
+    Returns the hrefs of a WebDAV multistatus response, with a slash appended
+    to those of collections.
+    '''
+    hrefs = []
+    for response in ElementTree.fromstring(body).iter('{DAV:}response'):
+        href = response.findtext('{DAV:}href')
+        if not href:
+            continue
+        if response.find('.//{DAV:}collection') is not None:
+            href = href.rstrip('/') + '/'
+        hrefs.append(href)
+    return hrefs
+
+
+def list_http_dir(dir_url, root=False):
+    '''
+    Lists the directory 'dir_url' (ending with a slash) with a WebDAV
+    PROPFIND request or, if the server does not do WebDAV, from its HTML
+    index page. An HTML page at the 'root' of a download that links to
+    nothing in it is taken for some other page than an index.
+
+    Returns (url, is_directory) pairs, or None if it cannot be listed.
+    '''
+    session = get_session()
+    with session.request('PROPFIND', dir_url, data=PROPFIND_BODY,
+                         headers={'Depth': '1',
+                                  'Content-Type': 'application/xml'}) as req:
+        if req.status_code == 207:
+            try:
+                return child_entries(dir_url, propfind_hrefs(req.content))
+            except ElementTree.ParseError as err:
+                logging.error('Invalid PROPFIND answer for %s: %s', dir_url,
+                              err)
+                return None
+
+    with session.get(dir_url) as req:
+        if not is_success(req):
+            raise_if_transient(req)
+            log_error_response(req)
+            return None
+        if 'html' not in req.headers.get('Content-Type', ''):
+            logging.error('%s is not an HTML directory index', dir_url)
+            return None
+        parser = LinkParser()
+        parser.feed(req.text)
+        entries = child_entries(dir_url, parser.links)
+        if root and not entries:
+            logging.error('%s is not an HTML directory index: it links to '
+                          'nothing in it', dir_url)
+            return None
+        return entries
+
+
+class HTTPTransput(Transput):
+    def __init__(self, path, url, ftype, options=None):
+        Transput.__init__(self, path, url, ftype, options)
+
+    def encodings(self):
+        '''
+        The content encodings asked for by the 'compression' option: an
+        encoding, a list of them, or true for all supported ones.
+        '''
+        requested = self.options.get('compression')
+        if not requested:
+            return []
+        if requested is True:
+            return supported_encodings()
+        if isinstance(requested, str):
+            requested = [requested]
+        unsupported = [name for name in requested
+                       if name not in supported_encodings()]
+        if unsupported:
+            logging.warning('Ignoring unsupported compression for %s: %s',
+                            self.url, ', '.join(unsupported))
+        return [name for name in requested if name in supported_encodings()]
+
+    def download_file(self):
+        encodings = self.encodings()
+        if encodings:
+            return download_encoded(self.url, self.path, encodings,
+                                    self.checksum) or self.verify_checksum()
+
+        # Neither cached copies nor segments are written as one stream that
+        # can be hashed on the way
+        cache = get_cache()
+        if cache is not None and self.checksum is None:
+            return download_cached(cache, self.url, self.path)
+
+        if SEGMENTS > 1 and self.checksum is None:
+            probe = probe_ranges(self.url)
+            if probe is not None and probe[0] >= 2 * SEGMENT_SIZE:
+                return self.download_segmented(*probe)
+            logging.debug('Not splitting %s: ranges not supported or file '
+                          'smaller than 2 segments', self.url)
+        return self.download_stream()
+
+    def target_path(self):
+        '''
+        Where the download is written before it is complete.
+        '''
+        return self.path + PARTIAL_SUFFIX if RESUME else self.path
+
+    def record_path(self):
+        return self.target_path() + '.json'
+
+    def load_resume_record(self):
+        if not RESUME or not os.path.exists(self.target_path()):
+            return None
+        return ResumeRecord.load(self.record_path(), self.url)
+
+    def finish_download(self):
+        if RESUME:
+            os.replace(self.target_path(), self.path)
+            ResumeRecord(self.record_path(), self.url, None).delete()
+
+    def download_stream(self):
+        started = time.monotonic()
+        target = self.target_path()
+
+        headers = {}
+        offset = 0
+        record = self.load_resume_record()
+        if record is not None and not record.segments and record.written:
+            offset = min(record.written, os.path.getsize(target))
+            headers = {'Range': 'bytes={}-'.format(offset),
+                       'If-Range': record.validator}
+
+        with get_session().get(self.url, headers=headers, stream=True) as req:
+            if req.status_code == 416 and offset:
+                logging.warning('Cannot resume %s at byte %d, starting over',
+                                self.url, offset)
+                record.delete()
+                return self.download_stream()
+            if not is_success(req):
+                raise_if_transient(req)
+                log_error_response(req)
+                return 1
+            logging.debug('OK, got status code: %d', req.status_code)
+
+            if req.status_code == 206:
+                logging.info('Resuming %s at byte %d', self.url, offset)
+                if self.checksum is not None:
+                    hash_prefix(target, offset, self.checksum, CHUNK_SIZE)
+            else:
+                # The whole file, because it changed or ranges are unsupported
+                offset = 0
+
+            record = None
+            validator = validator_of(req.headers)
+            if RESUME and validator:
+                record = ResumeRecord(self.record_path(), self.url, validator)
+                record.written = offset
+
+            with open(target, 'r+b' if offset else 'wb') as file:
+                file.seek(offset)
+                file.truncate()
+                chunks = req.iter_content(CHUNK_SIZE)
+                if self.checksum is not None:
+                    chunks = hashed(chunks, self.checksum)
+                if record is not None:
+                    size = write_checkpointed(chunks, file, record)
+                else:
+                    size = write_chunks(chunks, file)
+
+        self.finish_download()
+        log_throughput('Downloaded', size, self.url, started)
+        return self.verify_checksum()
+
+    def download_segmented(self, size, validator):
+        started = time.monotonic()
+        target = self.target_path()
+        segments = plan_segments(size, SEGMENTS, SEGMENT_SIZE)
+
+        record = self.load_resume_record()
+        if (record is None or record.validator != validator
+                or record.size != size):
+            record = None
+            # Every segment writes to its own offsets of the full size file
+            with open(target, 'wb') as file:
+                file.truncate(size)
+            if RESUME and validator:
+                record = ResumeRecord(self.record_path(), self.url,
+                                      validator, size)
+                record.save()
+
+        missing = segments
+        if record is not None:
+            missing = [segment for segment in segments
+                       if segment not in record.segments]
+            if len(missing) < len(segments):
+                logging.info('Resuming %s, %d of %d segments left', self.url,
+                             len(missing), len(segments))
+        logging.debug('Downloading %s in %d segments', self.url, len(missing))
+
+        def fetch(segment):
+            if with_retries(lambda: download_segment(
+                    self.url, target, *segment,
+                    validator=validator if record else None),
+                    '{} bytes {}-{}'.format(self.url, *segment)):
+                return 1
+            if record is not None:
+                record.add_segment(segment)
+            return 0
+
+        if missing:
+            try:
+                with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+                    results = list(executor.map(fetch, missing))
+            except RangeIgnored:
+                logging.warning('%s ignores byte ranges, downloading it in a '
+                                'single stream', self.url)
+                if record is not None:
+                    record.delete()
+                return self.download_stream()
+            if any(results):
+                return 1
+
+        self.finish_download()
+        log_throughput('Downloaded', size, self.url, started)
+        return 0
+
+    def upload_file(self):
+        encodings = self.encodings()
+        return put_file(self.path, self.url,
+                        encodings[0] if encodings else None)
+
+    def upload_fileobj(self, file):
+        # Sent with chunked encoding, as its size is not known beforehand
+        with get_session().put(self.url, data=read_chunks(file, CHUNK_SIZE),
+                               headers={}) as req:
+            if not is_success(req):
+                raise_if_transient(req)
+                log_error_response(req)
+                return 1
+            logging.debug('OK, got status code: %d', req.status_code)
+        return 0
+
+    def download_fileobj(self, consume):
+        # The body is read as it was sent: the archive format says how it is
+        # compressed, and a Content-Encoding can then only be that of the
+        # file itself (e.g. a .tar.gz sent as gzip), not to be undone twice
+        headers = {'Accept-Encoding': 'identity'}
+        with get_session().get(self.url, headers=headers, stream=True) as req:
+            if not is_success(req):
+                raise_if_transient(req)
+                log_error_response(req)
+                return 1
+            logging.debug('OK, got status code: %d', req.status_code)
+            consume(req.raw)
+        return 0
+
+    def upload_dir(self):
+        try:
+            files, unknown = list_upload(self.path, self.url)
+        except OSError as err:
+            logging.error('Unable to list the directory "%s": %s', self.path,
+                          err)
+            return 1
+        for file_path, _ in unknown:
+            logging.error(
+                'Directory listing in is neither file nor directory: "%s"',
+                file_path)
+
+        encodings = self.encodings()
+        failed = unknown + upload_concurrently(
+            files, encodings[0] if encodings else None)
+
+        # return 1 if any upload failed
+        if failed:
+            logging.error('Unable to upload %d of %d files of "%s":',
+                          len(failed), len(files) + len(unknown), self.path)
+            for file_path, file_url in failed:
+                logging.error('  "%s" -> %s', file_path, file_url)
+            return 1
+        return 0
+
+    def local_path(self, base_url, url):
+        '''
+        Where the file or directory at 'url', found under 'base_url', goes.
+        '''
+        parts = unquote(url[len(base_url):]).strip('/').split('/')
+        if '..' in parts:
+            raise ValueError('Refusing to write outside of "{}": {}'
+                             .format(self.path, url))
+        return os.path.join(self.path, *parts)
+
+    def download_dir(self):
+        base_url = self.url.rstrip('/') + '/'
+
+        def fetch(url, path):
+            transfer = HTTPTransput(path, url, Type.File, self.options)
+            try:
+                return with_retries(transfer.download_file, url)
+            except (requests.RequestException, OSError):
+                logging.exception('Unable to download "%s" to "%s"', url, path)
+                return 1
+
+        # Directories are listed one after another while the files already
+        # found are being downloaded
+        failed = []
+        fetches = []
+        pending = [base_url]
+        seen = set(pending)
+        with ThreadPoolExecutor(max_workers=max(DOWNLOAD_WORKERS, 1)) as executor:
+            while pending:
+                dir_url = pending.pop(0)
+                entries = with_retries(
+                    lambda: list_http_dir(dir_url, dir_url == base_url),
+                    dir_url, failed=None)
+                if entries is None:
+                    failed.append(dir_url)
+                    continue
+                os.makedirs(self.local_path(base_url, dir_url), exist_ok=True)
+
+                for url, is_dir in entries:
+                    try:
+                        path = self.local_path(base_url, url)
+                    except ValueError as err:
+                        logging.error(err)
+                        failed.append(url)
+                        continue
+                    if is_dir:
+                        if url not in seen:
+                            seen.add(url)
+                            pending.append(url)
+                    else:
+                        fetches.append(
+                            (url, executor.submit(fetch, url, path)))
+
+        failed += [url for url, fetch in fetches if fetch.result()]
+
+        # return 1 if any download failed
+        if failed:
+            logging.error('Unable to download %d entries of %s:',
+                          len(failed), self.url)
+            for url in failed:
+                logging.error('  %s', url)
+            return 1
+        return 0
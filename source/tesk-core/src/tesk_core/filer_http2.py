@@ -0,0 +1,180 @@
+import asyncio
+import threading
+import requests
+from tesk_core.transput import ChunkReader
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+class H2Response:
+    '''
+    The part of the interface of a requests.Response used by the filer, on
+    top of an httpx.Response read through the event loop of 'session'.
+    '''
+
+    def __init__(self, session, response):
+        self.session = session
+        self.response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+
+    def iterate(self, chunks):
+        while True:
+            try:
+                yield self.session.call(next_chunk(chunks))
+            except StopAsyncIteration:
+                return
+
+    def iter_content(self, chunk_size=1):
+        return self.iterate(self.response.aiter_bytes(chunk_size))
+
+    @property
+    def raw(self):
+        '''
+        Binary file reading the body as it came on the wire, i.e. not
+        decompressed.
+        '''
+        return ChunkReader(self.iterate(self.response.aiter_raw()))
+
+    @property
+    def content(self):
+        return self.session.call(self.response.aread())
+
+    @property
+    def text(self):
+        self.session.call(self.response.aread())
+        return self.response.text
+
+    def close(self):
+        self.session.call(self.response.aclose())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+async def next_chunk(chunks):
+    return await chunks.__anext__()
+
+
+class H2Session:
+    '''
+    The part of the interface of a requests.Session used by the filer, sending
+    requests with httpx over HTTP/2 where the server supports it.
+
+    Concurrent requests to a host are multiplexed as streams of a single
+    connection instead of each taking a connection of its own. The
+    connections belong to an event loop running in a thread of its own, as
+    those of httpx cannot be shared by threads; the threads of the filer hand
+    their requests over to it. Needs the optional 'httpx[http2]' package.
+    '''
+
+    def __init__(self, keepalive=True, transport=None):
+        if httpx is None:
+            raise ValueError("The HTTP/2 engine needs the 'httpx[http2]' "
+                             "package")
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       name='http2', daemon=True)
+        self.thread.start()
+        limits = httpx.Limits(keepalive_expiry=5.0 if keepalive else 0)
+        # Transfers can take as long as they need, like with requests
+        self.client = self.call(self.new_client(limits, transport))
+        self.headers = self.client.headers
+
+    @staticmethod
+    async def new_client(limits, transport):
+        return httpx.AsyncClient(http2=True, limits=limits, timeout=None,
+                                 follow_redirects=True, transport=transport)
+
+    def call(self, coroutine):
+        '''
+        Runs 'coroutine' in the event loop, returning its result.
+        '''
+        try:
+            return asyncio.run_coroutine_threadsafe(coroutine,
+                                                    self.loop).result()
+        except httpx.HTTPError as err:
+            raise requests.ConnectionError(err) from err
+
+    async def body_chunks(self, data):
+        '''
+        Yields the chunks of the iterable 'data' or the blocks of the file
+        'data', read outside of the event loop.
+        '''
+        if hasattr(data, 'read'):
+            chunks = iter(lambda: data.read(64 * 1024), b'')
+        else:
+            chunks = iter(data)
+        while True:
+            chunk = await self.loop.run_in_executor(None, next, chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    async def send(self, method, url, data, headers, stream,
+                   allow_redirects):
+        # A server closing a connection (e.g. after as many requests as it
+        # serves on one) fails the streams it did not process yet. They are
+        # sent again on a new connection if their body can be sent again.
+        position = data.tell() if hasattr(data, 'seek') else None
+        resendable = (data is None or isinstance(data, bytes)
+                      or position is not None)
+        for attempt in range(2):
+            if attempt and position is not None:
+                data.seek(position)
+            content = data
+            if data is not None and not isinstance(data, bytes):
+                content = self.body_chunks(data)
+                # A file is sent with its size as Content-Length, like
+                # requests does
+                if position is not None:
+                    headers = dict(headers or {})
+                    headers.setdefault('Content-Length', str(
+                        file_size(data) - position))
+            request = self.client.build_request(method, url, content=content,
+                                                headers=headers)
+            try:
+                response = await self.client.send(
+                    request, stream=True, follow_redirects=allow_redirects)
+                if not stream:
+                    await response.aread()
+                return response
+            except httpx.RemoteProtocolError:
+                if attempt or not resendable:
+                    raise
+
+    def request(self, method, url, data=None, headers=None, stream=False,
+                allow_redirects=True):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return H2Response(self, self.call(self.send(
+            method, url, data, headers, stream, allow_redirects)))
+
+    def get(self, url, headers=None, stream=False):
+        return self.request('GET', url, headers=headers, stream=stream)
+
+    def head(self, url, headers=None, allow_redirects=False):
+        return self.request('HEAD', url, headers=headers,
+                            allow_redirects=allow_redirects)
+
+    def put(self, url, data=None, headers=None):
+        return self.request('PUT', url, data=data, headers=headers)
+
+    def close(self):
+        self.call(self.client.aclose())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+def file_size(file):
+    position = file.tell()
+    file.seek(0, 2)
+    size = file.tell()
+    file.seek(position)
+    return size
@@ -1,31 +1,169 @@
 import sys
 import os
 import logging
-import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from functools import partial
 import botocore
+import botocore.config
 import boto3
-from tesk_core.transput import Transput, Type
+import boto3.exceptions
+from boto3.s3.transfer import TransferConfig
+from tesk_core.path import getIntEnv
+from tesk_core.transput import Transput
+from tesk_core.checksum import HashingWriter
+from tesk_core.retry import is_transient, with_retries
+
+# Objects of an S3 directory transferred at once
+WORKERS = getIntEnv('TESK_FILER_S3_WORKERS', 8)
+
+# Objects of at least MULTIPART_THRESHOLD bytes are sent or fetched in parts
+# of MULTIPART_CHUNK_SIZE bytes, MAX_CONCURRENCY of them at once
+MULTIPART_THRESHOLD = getIntEnv('TESK_FILER_S3_MULTIPART_THRESHOLD',
+                                8 * 1024 * 1024)
+MULTIPART_CHUNK_SIZE = getIntEnv('TESK_FILER_S3_MULTIPART_CHUNK_SIZE',
+                                 8 * 1024 * 1024)
+MAX_CONCURRENCY = getIntEnv('TESK_FILER_S3_MAX_CONCURRENCY', 10)
+# Bytes per second an object is sent or fetched at, at most (0: no limit)
+MAX_BANDWIDTH = getIntEnv('TESK_FILER_S3_MAX_BANDWIDTH', 0)
+
+# Environment variables boto3 takes credentials from, which tell the clients
+# of a process apart
+CREDENTIAL_VARIABLES = ('AWS_PROFILE', 'AWS_ACCESS_KEY_ID',
+                        'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN')
+
+_resources = {}
+_known_buckets = set()
+_resources_lock = threading.Lock()
+
+
+def client_key(endpoint=None):
+    return (endpoint,) + tuple(os.environ.get(name)
+                               for name in CREDENTIAL_VARIABLES)
+
+
+def get_resource(endpoint=None):
+    '''
+    Returns the S3 resource shared by all transfers of this filer process
+    with the credentials of the environment, talking to 'endpoint' or to the
+    one of the AWS configuration. They share its client and its connections
+    instead of each resolving credentials and opening connections of their
+    own.
+    '''
+    key = client_key(endpoint)
+    with _resources_lock:
+        if key not in _resources:
+            # Every object of a directory transferred at once can have all
+            # its parts in flight
+            config = botocore.config.Config(max_pool_connections=max(
+                10, max(WORKERS, 1) * max(MAX_CONCURRENCY, 1)))
+            # Sessions are not thread safe, unlike the clients they create
+            _resources[key] = boto3.session.Session().resource(
+                's3', endpoint_url=endpoint, config=config)
+        return _resources[key]
+
+
+def get_client(endpoint=None):
+    return get_resource(endpoint).meta.client
+
+
+def transfer_config():
+    '''
+    The TransferConfig of the object transfers, as the TESK_FILER_S3_*
+    settings tune it.
+    '''
+    config = TransferConfig(multipart_threshold=max(MULTIPART_THRESHOLD, 1),
+                            multipart_chunksize=max(MULTIPART_CHUNK_SIZE, 1),
+                            max_concurrency=max(MAX_CONCURRENCY, 1))
+    # Not an argument of TransferConfig in older versions of boto3, but
+    # honoured by its transfer manager all the same
+    config.max_bandwidth = MAX_BANDWIDTH if MAX_BANDWIDTH > 0 else None
+    return config
+
+
+def run_all(tasks):
+    '''
+    Calls the actions of the (name, action) pairs of the iterable 'tasks'
+    with WORKERS threads, taking the next pairs from it as threads free up,
+    so that transfers start before it is exhausted. Returns the names of
+    those whose action did not return 0.
+    '''
+    workers = max(WORKERS, 1)
+    failed = []
+    running = {}
+
+    def collect(futures):
+        for future in futures:
+            name = running.pop(future)
+            if future.result():
+                failed.append(name)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for name, action in tasks:
+            # Bounded number of them waiting for a worker
+            if len(running) >= 2 * workers:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                collect(done)
+            running[executor.submit(action)] = name
+        collect(list(running))
+    return failed
+
+
+def scan_tree(root):
+    '''
+    Yields the entries under the directory 'root' that are not directories,
+    with their path relative to it, walking it with os.scandir.
+    '''
+    pending = ['']
+    while pending:
+        relative_dir = pending.pop()
+        with os.scandir(os.path.join(root, relative_dir)) as entries:
+            for entry in entries:
+                relative = relative_dir + entry.name
+                if entry.is_dir():
+                    pending.append(relative + '/')
+                else:
+                    yield entry, relative
+
+
+def clear_resources():
+    '''
+    Forgets the shared resources and the buckets known to exist, e.g. after
+    the credentials or the endpoint changed.
+    '''
+    with _resources_lock:
+        _resources.clear()
+        _known_buckets.clear()
+
 
 class S3Transput(Transput):
-    def __init__(self, path, url, ftype):
-        Transput.__init__(self, path, url, ftype)
+    def __init__(self, path, url, ftype, options=None):
+        Transput.__init__(self, path, url, ftype, options)
         self.bucket, self.file_path = self.get_bucket_name_and_file_path()
         self.bucket_obj = None
 
     def __enter__(self):
-        client = boto3.resource('s3', endpoint_url=self.extract_endpoint())
-        if self.check_if_bucket_exists(client):
-            sys.exit(1)
+        client = get_resource()
+        # Buckets are only checked by the first of their transfers
+        bucket_key = client_key() + (self.bucket,)
+        if bucket_key not in _known_buckets:
+            if self.check_if_bucket_exists(client):
+                sys.exit(1)
+            with _resources_lock:
+                _known_buckets.add(bucket_key)
         self.bucket_obj = client.Bucket(self.bucket)
         return self
 
     def extract_endpoint(self):
-        return boto3.client('s3').meta.endpoint_url
+        return get_client().meta.endpoint_url
 
     def check_if_bucket_exists(self, client):
         try:
             client.meta.client.head_bucket(Bucket=self.bucket)
         except botocore.exceptions.ClientError as e:
+            # Throttling and unavailability are left to the retries
+            if is_transient(e):
+                raise
             # If a client error is thrown, then check that it was a 404 error.
             # If it was a 404 error, then the bucket does not exist.
             logging.error('Got status code: %s', e.response['Error']['Code'])
@@ -48,69 +186,164 @@ class S3Transput(Transput):
         logging.debug('Downloading s3 object: "%s" Target: %s', self.bucket + "/" + self.file_path, self.path)
         basedir = os.path.dirname(self.path)
         os.makedirs(basedir, exist_ok=True)
-        return self.get_s3_file(self.path, self.file_path)
+        return self.get_s3_file(self.path, self.file_path,
+                                self.checksum) or self.verify_checksum()
 
     def upload_file(self):
         logging.debug('Uploading s3 object: "%s" Target: %s', self.path,  self.bucket + "/" + self.file_path)
+        return self.put_s3_file(self.path, self.file_path)
+
+    def upload_fileobj(self, file):
         try:
-            self.bucket_obj.upload_file(Filename=self.path, Key=self.file_path)
-        except (botocore.exceptions.ClientError,  OSError) as err:
+            self.bucket_obj.upload_fileobj(Fileobj=file, Key=self.file_path,
+                                           Config=transfer_config())
+        except botocore.exceptions.ClientError as err:
+            if is_transient(err):
+                raise
             logging.error("File upload failed for '%s'", self.bucket + "/" + self.file_path)
             logging.error(err)
             return 1
         return 0
 
+    def download_fileobj(self, consume):
+        try:
+            body = self.bucket_obj.Object(self.file_path).get()['Body']
+        except botocore.exceptions.ClientError as err:
+            if is_transient(err):
+                raise
+            logging.error('Got status code: %s', err.response['Error']['Code'])
+            logging.error(err.response['Error']['Message'])
+            return 1
+        try:
+            consume(body)
+        finally:
+            body.close()
+        return 0
+
     def upload_dir(self):
         logging.debug('Uploading s3 object: "%s" Target: %s', self.path, self.bucket + "/" + self.file_path)
+        prefix = self.file_path.strip('/')
+        prefix = prefix + '/' if prefix else ''
+        failed = []
+        found = 0
+
+        def puts():
+            nonlocal found
+            for entry, relative in scan_tree(self.path):
+                if not entry.is_file():
+                    logging.error("Object is neither file or directory : '%s' ", entry.path)
+                    failed.append(entry.path)
+                    continue
+                found += 1
+                key = prefix + relative
+                yield key, partial(with_retries,
+                                   partial(self.put_s3_file, entry.path, key),
+                                   key)
+
+        # The files of all subdirectories are uploaded over the one client,
+        # starting while the tree is still being walked
         try:
-            for item in os.listdir(self.path):
-                path = os.path.join(self.path,item)
-                if os.path.isdir(path):
-                    file_type = Type.Directory
-                elif os.path.isfile(path):
-                    file_type = Type.File
-                else:
-                    # An exception is raised, if the object type is neither file or directory
-                    logging.error("Object is neither file or directory : '%s' ",path)
-                    raise IOError
-                file_path = os.path.join(self.url, item)
-                with S3Transput(path, file_path, file_type) as transfer:
-                    if transfer.upload():
-                        return 1
+            failed += run_all(puts())
         except OSError as err:
             logging.error("File upload failed for '%s'", self.bucket + "/" + self.file_path)
             logging.error(err)
             return 1
+        if failed:
+            logging.error('Unable to upload %d of %d files of %s:',
+                          len(failed), found, self.path)
+            for name in failed:
+                logging.error('  %s', name)
+            return 1
         return 0
 
     def download_dir(self):
         logging.debug('Downloading s3 object: "%s" Target: %s', self.bucket + "/" + self.file_path, self.path)
-        client = boto3.client('s3', endpoint_url=self.extract_endpoint())
+        client = get_client()
         if not self.file_path.endswith('/'):
             self.file_path += '/'
-        objects = client.list_objects_v2(Bucket=self.bucket, Prefix=self.file_path)
+        prefix = self.file_path
+        pages = client.get_paginator('list_objects_v2').paginate(
+            Bucket=self.bucket, Prefix=prefix)
 
-        # If the file path does not exists in s3 bucket, 'Contents' key will not be present in objects
-        if "Contents" not in objects:
+        def fetch(path, key):
+            try:
+                return with_retries(lambda: self.get_s3_file(path, key), key)
+            except OSError:
+                logging.exception('Unable to download "%s" to "%s"', key, path)
+                return 1
+
+        failed = []
+        made = set()
+        found = 0
+
+        def fetches():
+            nonlocal found
+            for page in pages:
+                for obj in page.get('Contents', []):
+                    found += 1
+                    key = obj['Key']
+                    relative = key[len(prefix):]
+                    if relative.startswith('/') or '..' in relative.split('/'):
+                        logging.error('Not downloading "%s" outside of "%s"',
+                                      key, self.path)
+                        failed.append(key)
+                        continue
+                    dir_name, file_name = os.path.split(relative)
+                    dir_path = os.path.join(self.path, dir_name)
+                    if dir_path not in made:
+                        os.makedirs(dir_path, exist_ok=True)
+                        made.add(dir_path)
+                    # Keys ending with a slash only stand for directories
+                    if file_name:
+                        yield key, partial(fetch,
+                                           os.path.join(dir_path, file_name),
+                                           key)
+
+        # The objects of a page are downloaded while the next ones are listed
+        failed += run_all(fetches())
+
+        # If the file path does not exist in the bucket, there are no objects
+        # under it
+        if not found:
             logging.error('Got status code: %s', 404)
             logging.error("Invalid file path!.")
             return 1
+        if failed:
+            logging.error('Unable to download %d of %d objects of %s:',
+                          len(failed), found, self.url)
+            for key in failed:
+                logging.error('  %s', key)
+            return 1
+        return 0
 
-        # Looping through the list of objects and downloading them
-        for obj in objects["Contents"]:
-            file_name = os.path.basename(obj["Key"])
-            dir_name = os.path.dirname(obj["Key"])
-            path_to_create = re.sub(r'^' + self.file_path.strip('/').replace('/', '\/') + '', "", dir_name).strip('/')
-            path_to_create = os.path.join(self.path, path_to_create)
-            os.makedirs(path_to_create, exist_ok=True)
-            if self.get_s3_file(os.path.join(path_to_create, file_name), obj["Key"]):
-                return 1
+    def put_s3_file(self, file_name, key):
+        try:
+            self.bucket_obj.upload_file(Filename=file_name, Key=key,
+                                        Config=transfer_config())
+        # upload_file wraps the ClientError of a failed upload
+        except (botocore.exceptions.ClientError,
+                boto3.exceptions.S3UploadFailedError, OSError) as err:
+            if is_transient(err):
+                raise
+            logging.error("File upload failed for '%s'", self.bucket + "/" + key)
+            logging.error(err)
+            return 1
         return 0
 
-    def get_s3_file(self, file_name, key):
+    def get_s3_file(self, file_name, key, checksum=None):
         try:
-            self.bucket_obj.download_file(Filename=file_name, Key=key)
+            if checksum is None:
+                self.bucket_obj.download_file(Filename=file_name, Key=key,
+                                              Config=transfer_config())
+            else:
+                # Parts are written in order to a file object that cannot seek
+                with open(file_name, 'wb') as file:
+                    self.bucket_obj.download_fileobj(
+                        Fileobj=HashingWriter(file, checksum), Key=key,
+                        Config=transfer_config())
         except botocore.exceptions.ClientError as err:
+            if is_transient(err):
+                raise
             logging.error('Got status code: %s', err.response['Error']['Code'])
             logging.error(err.response['Error']['Message'])
             return 1
@@ -1,4 +1,5 @@
 import os
+import logging
 from os.path import relpath
 from tesk_core.exception import InvalidHostPath
 try:
@@ -27,6 +28,39 @@ def getPathEnv(varName):
     return os.path.normpath(varContent) if varContent else None
 
 
+def getIntEnv(varName, default):
+    '''
+    Gets an integer from env var 'varName'
+
+    Falls back to 'default' when the variable is unset or not a number.
+    '''
+
+    varContent = getEnv(varName)
+
+    if not varContent:
+        return default
+    try:
+        return int(varContent)
+    except ValueError:
+        logging.error("Ignoring '%s': '%s' is not an integer", varName, varContent)
+        return default
+
+
+def getBoolEnv(varName, default=False):
+    '''
+    Is env var 'varName' set to a true value ('1', 'true', 'yes' or 'on')?
+
+    Returns 'default' when the variable is unset.
+    '''
+
+    varContent = getEnv(varName)
+
+    if varContent is None:
+        return default
+
+    return varContent.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
 HOST_BASE_PATH       = getPathEnv('HOST_BASE_PATH')
 CONTAINER_BASE_PATH  = getPathEnv('CONTAINER_BASE_PATH')
 TRANSFER_PVC_NAME    = getEnv('TRANSFER_PVC_NAME')
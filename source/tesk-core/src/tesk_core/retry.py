@@ -0,0 +1,176 @@
+import ftplib
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import boto3.exceptions
+import botocore.exceptions
+import requests
+import urllib3.exceptions
+from tesk_core.exception import TransientTransferError
+from tesk_core.path import getIntEnv
+
+# A transfer failing with a transient error is tried up to ATTEMPTS times,
+# waiting a random time of up to BASE_DELAY_MS * 2^retry milliseconds,
+# capped at MAX_DELAY_MS, between attempts. BUDGET bounds the retries of all
+# the transfers of a filer run, so that an unreachable server does not keep
+# the task waiting for every one of its files.
+ATTEMPTS = getIntEnv('TESK_FILER_RETRY_ATTEMPTS', 5)
+BASE_DELAY_MS = getIntEnv('TESK_FILER_RETRY_BASE_DELAY_MS', 1000)
+MAX_DELAY_MS = getIntEnv('TESK_FILER_RETRY_MAX_DELAY_MS', 60000)
+BUDGET = getIntEnv('TESK_FILER_RETRY_BUDGET', 50)
+
+# Error codes of S3 (and compatible stores) for requests to slow down or
+# sent while the service is unavailable
+S3_TRANSIENT_CODES = {
+    'InternalError',
+    'RequestLimitExceeded',
+    'RequestTimeout',
+    'ServiceUnavailable',
+    'SlowDown',
+    'Throttling',
+    'ThrottlingException',
+    'TooManyRequestsException',
+}
+
+
+def is_transient_status(status_code):
+    '''
+    Whether an HTTP error status is worth retrying.
+
+    >>> [is_transient_status(code) for code in (404, 408, 429, 503)]
+    [False, True, True, True]
+    '''
+    return status_code in (408, 429) or status_code >= 500
+
+
+def is_transient(err):
+    '''
+    Whether the exception 'err' is a failure that may not happen again.
+    '''
+    if isinstance(err, boto3.exceptions.S3UploadFailedError):
+        # boto3 raises it while handling the ClientError of the upload
+        cause = err.__cause__ or err.__context__
+        return cause is not None and is_transient(cause)
+    if isinstance(err, botocore.exceptions.ClientError):
+        error = err.response.get('Error', {})
+        status = err.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        return (error.get('Code') in S3_TRANSIENT_CODES
+                or (status is not None and is_transient_status(status)))
+    return isinstance(err, (
+        TransientTransferError,
+        # Connections that failed, timed out or were closed midway
+        requests.ConnectionError,
+        requests.Timeout,
+        requests.exceptions.ChunkedEncodingError,
+        # Raised by reads of the raw body of a requests response, which
+        # requests does not wrap
+        urllib3.exceptions.ProtocolError,
+        urllib3.exceptions.ReadTimeoutError,
+        urllib3.exceptions.IncompleteRead,
+        botocore.exceptions.ConnectionError,
+        botocore.exceptions.ReadTimeoutError,
+        ConnectionError,
+        TimeoutError,
+        EOFError,
+        # 4xx replies of FTP servers
+        ftplib.error_temp,
+    ))
+
+
+def parse_retry_after(value):
+    '''
+    The seconds to wait according to a Retry-After header, which is either
+    a number of seconds or an HTTP date. None if 'value' is neither.
+
+    >>> parse_retry_after('120')
+    120.0
+    >>> parse_retry_after('Thu, 01 Jan 1970 00:00:00 GMT')
+    0.0
+    >>> parse_retry_after('soon') is None
+    True
+    '''
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date is None:
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return max((date - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+def backoff_delay(retry, retry_after=None):
+    '''
+    Seconds to wait before the retry number 'retry' (from 0): a random time
+    up to the exponentially growing, capped delay (full jitter), or what the
+    server asked for if that is longer, still within the cap.
+    '''
+    cap = MAX_DELAY_MS / 1000
+    delay = random.uniform(0, min(cap, BASE_DELAY_MS / 1000 * 2 ** retry))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, cap))
+    return delay
+
+
+class RetryBudget:
+    '''
+    Retries left to the transfers of this process, shared by their threads.
+    '''
+
+    def __init__(self, retries):
+        self.left = retries
+        self.lock = threading.Lock()
+
+    def take(self):
+        '''
+        Uses up one retry, returning False if there is none left.
+        '''
+        with self.lock:
+            if self.left <= 0:
+                return False
+            self.left -= 1
+            return True
+
+
+_budget = RetryBudget(BUDGET)
+
+
+def with_retries(action, what, failed=1):
+    '''
+    Calls 'action' until it does not raise a transient error, returning
+    what it returns. Other exceptions are raised.
+
+    Returns 'failed' once ATTEMPTS calls of it or the retry budget are used
+    up. 'what' names what 'action' transfers, for the logs.
+    '''
+    attempt = 1
+    while True:
+        try:
+            return action()
+        except Exception as err:
+            if not is_transient(err):
+                raise
+            if attempt >= ATTEMPTS:
+                logging.error('Giving up on %s after %d attempts: %s', what,
+                              attempt, err)
+                return failed
+            if not _budget.take():
+                logging.error('Giving up on %s, no retries left for this '
+                              'task: %s', what, err)
+                return failed
+            delay = backoff_delay(attempt - 1,
+                                  getattr(err, 'retry_after', None))
+            logging.warning('Attempt %d at %s failed, retrying in %.1fs: %s',
+                            attempt, what, delay, err)
+            time.sleep(delay)
+            attempt += 1
@@ -154,6 +154,11 @@ def run_task(data, filer_name, filer_version, have_json_pvc=False):
         if os.environ.get('FILER_BACKOFF_LIMIT') is not None:
             filer.set_backoffLimit(int(os.environ['FILER_BACKOFF_LIMIT']))
 
+        filer.set_transfer_settings(os.environ)
+
+        if os.environ.get('FILER_CACHE_PVC_NAME') is not None:
+            filer.add_cache_mount(os.environ['FILER_CACHE_PVC_NAME'])
+
         pvc = init_pvc(data, filer)
 
     for executor in data['executors']:
@@ -1,7 +1,13 @@
 import enum
+import functools
 import os
 import netrc
 import logging
+import time
+import tarfile
+from tesk_core.checksum import Checksum
+from tesk_core.archive import Packer, archive_encoding, unpack
+from tesk_core.retry import is_transient
 try:
     from urllib.parse import urlparse
 except ImportError:
@@ -14,29 +20,90 @@ class Type(enum.Enum):
     Directory = 'DIRECTORY'
 
 
+# Optional keys of an input or output of the filer JSON that tune how it is
+# transferred. See the README for their meaning.
+TRANSFER_OPTIONS = ('compression', 'checksum', 'archive')
+
+
+def log_throughput(action, size, url, started):
+    '''
+    Logs the amount of bytes moved for 'url' and the resulting throughput.
+
+    'started' is the time.monotonic() value taken when the transfer began.
+    '''
+    elapsed = max(time.monotonic() - started, 1e-6)
+    logging.info('%s %d bytes for %s in %.2fs (%.2f MB/s)', action, size, url,
+                 elapsed, size / elapsed / 1e6)
+
+
+class ChunkReader:
+    '''
+    Binary file reading the chunks of bytes of the iterable 'chunks'.
+    '''
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        # The chunk being read, up to 'offset'. It is sliced rather than
+        # cut down, so that a read costs as much as the bytes it returns.
+        self.chunk = b''
+        self.offset = 0
+
+    def read(self, size=-1):
+        left = -1 if size is None or size < 0 else size
+        parts = []
+        while left != 0:
+            if self.offset >= len(self.chunk):
+                chunk = next(self.chunks, None)
+                if chunk is None:
+                    break
+                self.chunk, self.offset = chunk, 0
+                continue
+            end = len(self.chunk)
+            if left > 0:
+                end = min(end, self.offset + left)
+                left -= end - self.offset
+            parts.append(self.chunk[self.offset:end])
+            self.offset = end
+        return b''.join(parts)
+
+    def readable(self):
+        return True
+
+
+@functools.lru_cache(maxsize=None)
+def read_netrc(netrc_path):
+    '''
+    Parses the netrc file at 'netrc_path', once for all the transputs of a
+    run. Returns None if it cannot be read.
+    '''
+    try:
+        return netrc.netrc(netrc_path)
+    except IOError as fnfe:
+        logging.error(fnfe)
+    except netrc.NetrcParseError as err:
+        logging.error('netrc.NetrcParseError')
+        logging.error(err)
+    except Exception as er:
+        logging.error(er)
+    return None
+
+
 class Transput:
-    def __init__(self, path, url, ftype):
+    def __init__(self, path, url, ftype, options=None):
         self.path = path
         self.url = url
         self.ftype = ftype
+        self.options = options or {}
+        self.checksum = None
 
         parsed_url = urlparse(url)
         self.netloc = parsed_url.netloc
         self.url_path = parsed_url.path
-        self.netrc_file = None
         try:
             netrc_path = os.path.join(os.environ['HOME'], '.netrc')
         except KeyError:
             netrc_path = '/.netrc'
-        try:
-            self.netrc_file = netrc.netrc(netrc_path)
-        except IOError as fnfe:
-            logging.error(fnfe)
-        except netrc.NetrcParseError as err:
-            logging.error('netrc.NetrcParseError')
-            logging.error(err)
-        except Exception as er:
-            logging.error(er)
+        self.netrc_file = read_netrc(netrc_path)
 
     def upload(self):
         logging.debug('%s uploading %s %s', self.__class__.__name__,
@@ -44,6 +111,8 @@ class Transput:
         if self.ftype == Type.File:
             return self.upload_file()
         if self.ftype == Type.Directory:
+            if self.options.get('archive'):
+                return self.upload_archive()
             return self.upload_dir()
         return 1
 
@@ -51,11 +120,85 @@ class Transput:
         logging.debug('%s downloading %s %s', self.__class__.__name__,
                       self.ftype, self.url)
         if self.ftype == Type.File:
+            try:
+                self.checksum = Checksum.parse(self.options.get('checksum'))
+            except ValueError as err:
+                logging.error('Invalid checksum for %s: %s', self.url, err)
+                return 1
             return self.download_file()
         if self.ftype == Type.Directory:
+            if 'checksum' in self.options:
+                logging.warning('Ignoring the checksum of directory %s',
+                                self.url)
+            if self.options.get('archive'):
+                return self.download_archive()
             return self.download_dir()
         return 1
 
+    def upload_archive(self):
+        '''
+        Uploads the directory as a single tar archive, packed while it is
+        sent.
+        '''
+        try:
+            encoding = archive_encoding(self.options['archive'])
+        except ValueError as err:
+            logging.error('Unable to upload %s: %s', self.path, err)
+            return 1
+        started = time.monotonic()
+        with Packer(self.path, encoding) as archive:
+            try:
+                if self.upload_fileobj(archive):
+                    return 1
+            except OSError as err:
+                # Raised while packing, e.g. for a file that cannot be read
+                if is_transient(err):
+                    raise
+                logging.error('Unable to upload %s: %s', self.path, err)
+                return 1
+        log_throughput('Uploaded', archive.size, self.url, started)
+        return 0
+
+    def download_archive(self):
+        '''
+        Downloads a tar archive, extracting it into the directory while it
+        is received.
+        '''
+        try:
+            encoding = archive_encoding(self.options['archive'])
+        except ValueError as err:
+            logging.error('Unable to download %s: %s', self.url, err)
+            return 1
+        files = []
+
+        def extract(file):
+            files.append(unpack(file, self.path, encoding))
+
+        try:
+            if self.download_fileobj(extract):
+                return 1
+        except (tarfile.TarError, ValueError) as err:
+            logging.error('Unable to unpack %s into %s: %s', self.url,
+                          self.path, err)
+            return 1
+        logging.info('Unpacked %d files of %s', files[0], self.url)
+        return 0
+
+    def verify_checksum(self):
+        '''
+        Checks the digest computed while downloading a file against the
+        'checksum' option, if there is one. A file that does not match is
+        removed.
+
+        Returns 0 if the file is fine, 1 if not.
+        '''
+        if self.checksum is None:
+            return 0
+        if self.checksum.verify(self.path, self.url):
+            os.remove(self.path)
+            return 1
+        return 0
+
     def delete(self):
         pass
 
@@ -71,6 +214,20 @@ class Transput:
     def upload_dir(self):
         raise NotImplementedError()
 
+    def upload_fileobj(self, file):
+        '''
+        Uploads what is read from the binary file 'file' to the URL.
+        '''
+        logging.error('Archives cannot be uploaded to %s', self.url)
+        return 1
+
+    def download_fileobj(self, consume):
+        '''
+        Calls 'consume' with a binary file reading the URL.
+        '''
+        logging.error('Archives cannot be downloaded from %s', self.url)
+        return 1
+
     # make it compatible with contexts (with keyword)
     def __enter__(self):
         return self
@@ -41,6 +41,21 @@ class FilerClassTest_env(unittest.TestCase):
         ])
         self.assertEquals(f.spec['spec']['backoffLimit'], 10)
 
+    def test_transfer_settings(self):
+
+        f = Filer('name', {'a': 1})
+        f.set_transfer_settings({
+            'TESK_FILER_HTTP_SEGMENTS'     : '8',
+            'TESK_FILER_HTTP_SEGMENT_SIZE' : '1048576',
+            'FILER_BACKOFF_LIMIT'          : '2',
+        })
+
+        self.assertEquals(f.getEnv()[-2:], [
+
+            { 'name': 'TESK_FILER_HTTP_SEGMENTS'     , 'value': '8'       }
+           ,{ 'name': 'TESK_FILER_HTTP_SEGMENT_SIZE' , 'value': '1048576' }
+        ])
+
 
     def test_mounts(self):
         '''
@@ -136,6 +151,19 @@ class FilerClassTest_no_env(unittest.TestCase):
         ])
 
 
+    def test_cache_mount(self):
+
+        f = Filer('name', {'a': 1})
+        f.add_cache_mount('shared-cache')
+
+        self.assertEquals(f.getVolumeMounts()[-1], {'name': 'input-cache', 'mountPath': '/cache'})
+        self.assertEquals(f.getVolumes()[-1], {
+            'name': 'input-cache',
+            'persistentVolumeClaim': {'claimName': 'shared-cache'}
+        })
+        self.assertEquals(f.getEnv()[-1], {'name': 'TESK_FILER_HTTP_CACHE_DIR', 'value': '/cache'})
+
+
     def test_image_pull_policy(self):
 
         f = Filer('name', {'a': 1})
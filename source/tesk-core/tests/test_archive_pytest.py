@@ -0,0 +1,236 @@
+"""Tests for the archive mode of the filer using 'pytest'."""
+
+import ftplib
+import io
+import os
+import tarfile
+
+import pytest
+import urllib3
+from requests import Response
+
+from tesk_core.archive import Packer, archive_encoding, unpack
+from tesk_core.compression import supported_encodings
+from tesk_core.filer import FTPTransput
+from tesk_core.filer_http import HTTPTransput
+from tesk_core.retry import with_retries
+from tesk_core.transput import ChunkReader, Type
+
+URL = 'http://www.foo.bar/out.tar'
+
+FORMATS = ['tar', 'tar.gz', pytest.param('tar.zst', marks=pytest.mark.skipif(
+    'zstd' not in supported_encodings(), reason='needs zstandard'))]
+
+
+def make_tree(root):
+    """ A directory with nested files, returning their contents by path."""
+
+    files = {
+        'file1': b'this is random',
+        'dir2/file2': b'not really',
+        'dir2/dir3/file4.txt': b'took me a while' * 10000,
+    }
+    for name, contents in files.items():
+        path = root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(contents)
+    (root / 'empty').mkdir()
+    return files
+
+
+def assert_tree(root, files):
+    for name, contents in files.items():
+        assert (root / name).read_bytes() == contents
+    assert (root / 'empty').is_dir()
+
+
+@pytest.mark.parametrize('archive', FORMATS)
+def test_pack_unpack(tmp_path, archive):
+    """ Ensure a directory packed into a stream is unpacked as it was."""
+
+    files = make_tree(tmp_path / 'in')
+    encoding = archive_encoding(archive)
+
+    with Packer(str(tmp_path / 'in'), encoding) as packed:
+        data = packed.read()
+    assert packed.size == len(data)
+
+    assert unpack(io.BytesIO(data), str(tmp_path / 'out'), encoding) == 3
+    assert_tree(tmp_path / 'out', files)
+
+
+def test_pack_error(tmp_path):
+    """ Ensure a file that cannot be packed fails the read instead of ending
+    the archive early."""
+
+    (tmp_path / 'in').mkdir()
+    os.symlink(str(tmp_path / 'missing'), str(tmp_path / 'in' / 'link'))
+
+    with Packer(str(tmp_path / 'in'), None) as packed:
+        with pytest.raises(FileNotFoundError):
+            packed.read()
+
+
+def test_unpack_outside(tmp_path):
+    """ Ensure members that would land outside of the directory are
+    refused."""
+
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w') as tar:
+        member = tarfile.TarInfo('../escaped')
+        tar.addfile(member, io.BytesIO())
+    data.seek(0)
+
+    with pytest.raises(ValueError):
+        unpack(data, str(tmp_path / 'out'), None)
+    assert not (tmp_path / 'escaped').exists()
+
+
+def test_unknown_format(tmp_path, caplog):
+    """ Ensure an unknown archive format fails the transfer."""
+
+    transfer = HTTPTransput(str(tmp_path), URL, Type.Directory,
+                            options={'archive': 'rar'})
+    assert transfer.upload() == 1
+    assert 'Unknown archive format: rar' in caplog.text
+
+
+@pytest.mark.parametrize('size', [None, -1, 0, 1, 3, 7, 100])
+def test_chunk_reader(size):
+    """ Ensure chunks are read back whole, whatever the size of the reads."""
+
+    chunks = [b'abc', b'', b'defgh', b'i', b'jklmnopq']
+    reader = ChunkReader(iter(chunks))
+    data = b''
+    while True:
+        read = reader.read(size)
+        if size == 0:
+            assert read == b''
+            return
+        if not read:
+            break
+        assert size is None or size < 0 or len(read) <= size
+        data += read
+    assert data == b''.join(chunks)
+    assert reader.read(size) == b''
+
+
+def test_http_archive(mocker, tmp_path):
+    """ Ensure an HTTP output directory is sent as a single archive, which
+    is unpacked again as an input."""
+
+    files = make_tree(tmp_path / 'in')
+    uploaded = []
+
+    def put(url, data, headers):
+        uploaded.append(b''.join(data))
+        response = Response()
+        response.status_code = 201
+        response._content = b''
+        response._content_consumed = True
+        return response
+
+    mock_put = mocker.patch('requests.Session.put', side_effect=put)
+    options = {'archive': 'tar.gz'}
+
+    assert HTTPTransput(str(tmp_path / 'in'), URL, Type.Directory,
+                        options=options).upload() == 0
+    assert mock_put.call_count == 1
+
+    response = Response()
+    response.status_code = 200
+    response.raw = io.BytesIO(uploaded[0])
+    mocker.patch('requests.Session.get', return_value=response)
+
+    assert HTTPTransput(str(tmp_path / 'out'), URL, Type.Directory,
+                        options=options).download() == 0
+    assert_tree(tmp_path / 'out', files)
+
+
+def test_http_archive_content_encoding(mocker, tmp_path):
+    """ Ensure a .tar.gz which the server says is gzip encoded is only
+    decompressed once."""
+
+    files = make_tree(tmp_path / 'in')
+    with Packer(str(tmp_path / 'in'), 'gzip') as packer:
+        archive = packer.read()
+
+    response = Response()
+    response.status_code = 200
+    response.headers['Content-Encoding'] = 'gzip'
+    response.raw = urllib3.HTTPResponse(
+        body=io.BytesIO(archive), headers={'Content-Encoding': 'gzip'},
+        preload_content=False, decode_content=False)
+    mock_get = mocker.patch('requests.Session.get', return_value=response)
+
+    assert HTTPTransput(str(tmp_path / 'out'), URL + '.gz', Type.Directory,
+                        options={'archive': 'tar.gz'}).download() == 0
+    assert_tree(tmp_path / 'out', files)
+    assert mock_get.call_args[1]['headers'] == {'Accept-Encoding': 'identity'}
+
+
+class BrokenBody(io.BytesIO):
+    """ A body whose connection is reset once 'size' bytes were read."""
+
+    def __init__(self, data, size):
+        super().__init__(data)
+        self.size = size
+
+    def read(self, *args):
+        if self.tell() >= self.size:
+            raise ConnectionResetError(104, 'Connection reset by peer')
+        return super().read(min(args[0] if args else self.size,
+                                self.size - self.tell()))
+
+
+def archive_response(body):
+    response = Response()
+    response.status_code = 200
+    response.raw = urllib3.HTTPResponse(body=body, preload_content=False)
+    return response
+
+
+def test_http_archive_connection_reset(mocker, tmp_path):
+    """ Ensure an archive download whose connection is reset midway is
+    retried."""
+
+    mocker.patch('tesk_core.retry.time.sleep')
+    files = make_tree(tmp_path / 'in')
+    with Packer(str(tmp_path / 'in'), 'gzip') as packer:
+        archive = packer.read()
+    mock_get = mocker.patch('requests.Session.get', side_effect=[
+        archive_response(BrokenBody(archive, len(archive) // 2)),
+        archive_response(io.BytesIO(archive))])
+
+    transput = HTTPTransput(str(tmp_path / 'out'), URL + '.gz',
+                            Type.Directory, options={'archive': 'tar.gz'})
+    assert with_retries(transput.download, transput.url) == 0
+    assert_tree(tmp_path / 'out', files)
+    assert mock_get.call_count == 2
+
+
+def test_ftp_archive(mocker, tmp_path):
+    """ Ensure an FTP output directory is stored as a single archive, which
+    is unpacked again as an input."""
+
+    files = make_tree(tmp_path / 'in')
+    stored = []
+    conn = mocker.MagicMock(spec=ftplib.FTP)
+    conn.pwd.return_value = '/'
+    conn.storbinary.side_effect = lambda command, file: stored.append(
+        file.read())
+    url = 'ftp://www.foo.bar/archives/out.tar.gz'
+    options = {'archive': 'tar.gz'}
+
+    assert FTPTransput(str(tmp_path / 'in'), url, Type.Directory,
+                       ftp_conn=conn, options=options).upload() == 0
+    conn.storbinary.assert_called_once_with('STOR //archives/out.tar.gz',
+                                            mocker.ANY)
+
+    data_connection = conn.transfercmd.return_value.__enter__.return_value
+    data_connection.makefile.return_value = io.BytesIO(stored[0])
+
+    assert FTPTransput(str(tmp_path / 'out'), url, Type.Directory,
+                       ftp_conn=conn, options=options).download() == 0
+    conn.transfercmd.assert_called_once_with('RETR /archives/out.tar.gz')
+    assert_tree(tmp_path / 'out', files)
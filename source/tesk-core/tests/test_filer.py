@@ -210,6 +210,7 @@ class FilerTest(unittest.TestCase, AssertThrowsMixin):
 
     def test_newTransput(self):
         self.assertEqual(newTransput('ftp', 'test.com'), FTPTransput)
+        self.assertEqual(newTransput('ftps', 'test.com'), FTPTransput)
         self.assertEqual(newTransput('http', 'test.com'), HTTPTransput)
         self.assertEqual(newTransput('https', 'test.com'), HTTPTransput)
         self.assertEqual(newTransput('file', '/home/tfga/workspace/'), FileTransput)
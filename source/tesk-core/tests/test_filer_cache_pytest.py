@@ -0,0 +1,81 @@
+"""Tests for 'filer_cache.py' using 'pytest'."""
+
+import errno
+import logging
+import os
+
+from tesk_core.filer_cache import InputCache
+
+
+def fill(cache, url, contents, last_used):
+    key = cache.key(url)
+    with cache.locked(key):
+        cache.store(key, url, '"etag"', None,
+                    lambda file: file.write(contents))
+        meta = cache.lookup(key)
+        meta['last_used'] = last_used
+        cache.save_meta(key, meta)
+    return key
+
+
+def test_store_and_lookup(tmp_path):
+    """ Ensure a stored entry can be found again and copied out."""
+
+    cache = InputCache(str(tmp_path), 0)
+    key = fill(cache, 'http://foo.bar/a', b'contents', 1)
+
+    with cache.locked(key):
+        meta = cache.lookup(key)
+        cache.copy_to(key, str(tmp_path / 'copy'))
+
+    assert meta['url'] == 'http://foo.bar/a'
+    assert meta['etag'] == '"etag"'
+    assert meta['size'] == len(b'contents')
+    assert open(str(tmp_path / 'copy'), 'rb').read() == b'contents'
+    assert cache.lookup(cache.key('http://foo.bar/b')) is None
+
+
+def test_evict_least_recently_used(tmp_path):
+    """ Ensure eviction removes the oldest entries first, skipping those in
+        use, until the cache fits in its size limit."""
+
+    cache = InputCache(str(tmp_path), 25)
+    oldest = fill(cache, 'http://foo.bar/oldest', b'x' * 10, 1)
+    in_use = fill(cache, 'http://foo.bar/in_use', b'x' * 10, 2)
+    old = fill(cache, 'http://foo.bar/old', b'x' * 10, 3)
+    recent = fill(cache, 'http://foo.bar/recent', b'x' * 10, 4)
+
+    with cache.locked(in_use):
+        cache.evict()
+
+    remaining = {key for key, _ in cache.entries()}
+    assert remaining == {in_use, recent}
+    assert not os.path.exists(cache.data_path(oldest))
+    assert not os.path.exists(cache.data_path(old))
+
+
+def test_link_other_file_system(tmp_path, mocker, caplog):
+    """ Ensure entries that cannot be linked across file systems are copied,
+        with a single warning."""
+
+    cache = InputCache(str(tmp_path), 0, link=True)
+    key = fill(cache, 'http://foo.bar/a', b'contents', 1)
+    link = mocker.patch('tesk_core.filer_cache.os.link',
+                        side_effect=OSError(errno.EXDEV, 'Invalid cross-device link'))
+
+    with caplog.at_level(logging.WARNING):
+        for name in ['copy1', 'copy2']:
+            cache.copy_to(key, str(tmp_path / name))
+            assert open(str(tmp_path / name), 'rb').read() == b'contents'
+
+    link.assert_called_once()
+    assert caplog.text.count('Cannot hard link cached inputs') == 1
+
+
+def test_link(tmp_path):
+    """ Ensure entries are hard linked when on the same file system."""
+
+    cache = InputCache(str(tmp_path), 0, link=True)
+    key = fill(cache, 'http://foo.bar/a', b'contents', 1)
+    cache.copy_to(key, str(tmp_path / 'linked'))
+    assert os.path.samefile(str(tmp_path / 'linked'), cache.data_path(key))
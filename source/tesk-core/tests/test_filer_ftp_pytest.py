@@ -2,7 +2,10 @@
 
 from unittest import mock
 import ftplib
+import logging
 import os
+import socket
+import pytest
 
 from tesk_core.filer import (
     FTPTransput,
@@ -13,6 +16,14 @@ from tesk_core.filer import (
     ftp_check_directory,
     ftp_make_dirs
 )
+from tesk_core.filer_ftp import (
+    FTPEntry,
+    FTPPool,
+    ReusingFTP_TLS,
+    close_pool,
+    ftp_list_dir
+)
+from tesk_core.retry import with_retries
 
 
 def test_ftp_login(mocker):
@@ -122,11 +133,14 @@ def test_ftp_upload_dir(mocker, fs, ftpserver):
 
     # We use mock.ANY since the 2nd argument of the 'ftplib.FTP.storbinary' is
     # a file object and we can't have the same between the original and the
-    # mock calls
+    # mock calls, as is its callback
     assert sorted(mock_storbinary.mock_calls) == sorted([
-        mock.call('STOR /' + '/dir1/file1', mock.ANY),
-        mock.call('STOR /' + '/dir1/dir2/file2', mock.ANY),
-        mock.call('STOR /' + '/dir1/dir2/file4.txt', mock.ANY)
+        mock.call('STOR /' + '/dir1/file1', mock.ANY,
+                  callback=mock.ANY),
+        mock.call('STOR /' + '/dir1/dir2/file2', mock.ANY,
+                  callback=mock.ANY),
+        mock.call('STOR /' + '/dir1/dir2/file4.txt', mock.ANY,
+                  callback=mock.ANY)
     ])
 
 
@@ -224,3 +238,474 @@ def test_ftp_make_dirs_error(mocker, ftpserver, caplog):
 
     assert ftp_make_dirs(conn, 'dir1') == 1
     assert 'Unable to create directory' in caplog.text
+
+
+def mock_ftp_server(mocker, tmp_path, files):
+    """ Fakes the FTP class of the filer, with servers on which 'files' are
+        files, and creates them locally under 'tmp_path'/out."""
+
+    for name in files:
+        (tmp_path / 'out' / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / 'out' / name).write_text(name)
+
+    def cwd(path):
+        if any(path.endswith('/' + name) for name in files):
+            raise ftplib.error_perm('550 Not a directory')
+
+    mocker.patch('tesk_core.filer_ftp._pool', FTPPool(8))
+    ftp_class = mocker.patch('tesk_core.filer_ftp.FTP')
+    ftp_class.return_value.pwd.return_value = '/'
+    ftp_class.return_value.cwd.side_effect = cwd
+    return ftp_class
+
+
+def test_ftp_upload_dir_pool(mocker, tmp_path):
+    """ Ensure the files of an output directory are uploaded over at most
+        WORKERS connections, each logged into once and kept open for the
+        next transfers."""
+
+    files = ['file{}'.format(i) for i in range(10)]
+    files += ['sub/file', 'sub/sub/file']
+    ftp_class = mock_ftp_server(mocker, tmp_path, files)
+    ftp = ftp_class.return_value
+    mocker.patch('tesk_core.filer_ftp.WORKERS', 3)
+
+    with FTPTransput(str(tmp_path / 'out'), 'ftp://www.foo.bar/out',
+                     Type.Directory) as transput:
+        assert transput.upload() == 0
+
+    assert 1 <= ftp_class.call_count <= 3
+    assert ftp.login.call_count == ftp_class.call_count
+    assert sorted(call.args[0] for call in ftp.storbinary.mock_calls) == [
+        'STOR //out/' + name for name in sorted(files)]
+    ftp.close.assert_not_called()
+
+    close_pool()
+    assert ftp.close.call_count == ftp_class.call_count
+
+
+def test_ftp_upload_dir_host_connections(mocker, tmp_path):
+    """ Ensure no more than HOST_CONNECTIONS connections are opened to a
+        host, whatever the number of workers."""
+
+    files = ['file{}'.format(i) for i in range(10)]
+    ftp_class = mock_ftp_server(mocker, tmp_path, files)
+    mocker.patch('tesk_core.filer_ftp._pool', FTPPool(1))
+    mocker.patch('tesk_core.filer_ftp.WORKERS', 4)
+
+    with FTPTransput(str(tmp_path / 'out'), 'ftp://www.foo.bar/out',
+                     Type.Directory) as transput:
+        assert transput.upload() == 0
+
+    ftp_class.assert_called_once_with()
+    assert ftp_class.return_value.storbinary.call_count == 10
+
+
+def test_ftp_upload_dir_reconnect(mocker, tmp_path):
+    """ Ensure a connection dropped by the server is opened again, and the
+        file being uploaded then uploaded anew."""
+
+    files = ['file1', 'file2', 'file3']
+    ftp_class = mock_ftp_server(mocker, tmp_path, files)
+    ftp = ftp_class.return_value
+    ftp.storbinary.side_effect = [None, EOFError(), None, None]
+    # Nothing of it reached the server, it is sent again whole
+    ftp.size.side_effect = ftplib.error_perm('550 No such file')
+    mocker.patch('tesk_core.filer_ftp.WORKERS', 1)
+
+    with FTPTransput(str(tmp_path / 'out'), 'ftp://www.foo.bar/out',
+                     Type.Directory) as transput:
+        assert transput.upload() == 0
+
+    assert ftp_class.call_count == 2
+    assert ftp.login.call_count == 2
+    assert ftp.storbinary.call_count == 4
+
+
+def test_ftp_upload_dir_known_dirs(mocker, tmp_path):
+    """ Ensure the remote directories of an upload are created once and
+        then not checked again for every file."""
+
+    files = ['a/b/c/file{}'.format(i) for i in range(10)] + ['a/file']
+    ftp_class = mock_ftp_server(mocker, tmp_path, files)
+    ftp = ftp_class.return_value
+    created = set()
+
+    def cwd(path):
+        if path not in created and path != '/':
+            raise ftplib.error_perm('550 No such directory')
+    ftp.cwd.side_effect = cwd
+    ftp.mkd.side_effect = created.add
+    mocker.patch('tesk_core.filer_ftp.WORKERS', 1)
+
+    with FTPTransput(str(tmp_path / 'out'), 'ftp://www.foo.bar/out',
+                     Type.Directory) as transput:
+        assert transput.upload() == 0
+
+    assert sorted(created) == ['/out', '/out/a', '/out/a/b', '/out/a/b/c']
+    assert ftp.storbinary.call_count == 11
+    # For each of '/out/a' and '/out/a/b/c': a cwd into it, one into each
+    # missing folder before its mkd, and one back
+    assert ftp.cwd.call_count == 8
+    ftp.sendcmd.assert_not_called()
+
+
+def test_ftp_check_directory_known_dirs(mocker):
+    """ Ensure checking whether an upload target is a directory takes at
+        most a MLST, with what is known of the remote directories."""
+
+    conn = mocker.MagicMock(spec=ftplib.FTP)
+    conn.host = 'www.foo.bar'
+    mocker.patch('tesk_core.filer_ftp._no_mlst', set())
+    dirs = {'/out': False, '/out/new': True, '/out/dir': False}
+
+    assert ftp_check_directory(conn, '/out/dir', dirs) == 0
+    assert ftp_check_directory(conn, '/out/new/file', dirs) == 1
+    conn.sendcmd.assert_not_called()
+
+    conn.sendcmd.return_value = ('250- Listing /out/file\n'
+                                 ' type=file;size=3; /out/file\n250 End')
+    assert ftp_check_directory(conn, '/out/file', dirs) == 1
+    conn.sendcmd.return_value = ('250- Listing /out/other\n'
+                                 ' Type=dir;Modify=20200101000000; /out/other'
+                                 '\n250 End')
+    assert ftp_check_directory(conn, '/out/other', dirs) == 0
+    conn.sendcmd.side_effect = ftplib.error_perm('550 No such file')
+    assert ftp_check_directory(conn, '/out/missing', dirs) == 1
+    conn.cwd.assert_not_called()
+
+
+def test_ftp_check_directory_without_mlst(mocker):
+    """ Ensure a server without MLST has its paths checked with CWD, and
+        is still listed with MLSD."""
+
+    conn = mocker.MagicMock(spec=ftplib.FTP)
+    conn.host = 'www.foo.bar'
+    no_mlsd = mocker.patch('tesk_core.filer_ftp._no_mlsd', set())
+    no_mlst = mocker.patch('tesk_core.filer_ftp._no_mlst', set())
+    conn.sendcmd.side_effect = ftplib.error_perm('500 Unknown command')
+    conn.pwd.return_value = '/'
+    conn.cwd.side_effect = [ftplib.error_perm('550 Not a directory'), None]
+
+    assert ftp_check_directory(conn, '/out/file', {'/out': False}) == 1
+    assert no_mlst == {'www.foo.bar'}
+    assert no_mlsd == set()
+
+    conn.mlsd.return_value = iter([('file', {'type': 'file', 'size': '3'})])
+    assert ftp_list_dir(conn, '/out') == [FTPEntry('file', False, 3)]
+    conn.retrlines.assert_not_called()
+
+
+LISTINGS = {
+    '/in': [('.', {'type': 'cdir'}),
+            ('small', {'type': 'file', 'size': '1'}),
+            ('sub', {'type': 'dir'}),
+            ('large', {'type': 'file', 'size': '100'})],
+    '/in/sub': [('medium', {'type': 'file', 'size': '10'}),
+                ('empty', {'type': 'dir'})],
+    '/in/sub/empty': [],
+}
+
+
+def mock_ftp_listings(mocker, mlsd=True, odd_line=None):
+    """ Fakes the FTP class of the filer, with servers listing LISTINGS with
+        MLSD, or with LIST if not 'mlsd', adding 'odd_line' to the LIST
+        listings. Files contain their RETR command. Returns the RETR
+        commands sent, in order."""
+
+    mocker.patch('tesk_core.filer_ftp._pool', FTPPool(8))
+    mocker.patch('tesk_core.filer_ftp._no_mlsd', set())
+    retrieved = []
+
+    def list_lines(path, callback):
+        callback('total {}'.format(len(LISTINGS[path])))
+        for name, facts in LISTINGS[path]:
+            if facts['type'] in ('file', 'dir'):
+                callback('{}rw-r--r--   1 tesk     tesk   {:>10} Jan 01  2020 {}'
+                         .format('d' if facts['type'] == 'dir' else '-',
+                                 facts.get('size', 4096), name))
+            elif facts['type'].startswith('OS.unix=slink:'):
+                target = facts['type'].split(':', 1)[1]
+                callback('lrwxrwxrwx   1 tesk     tesk   {:>10} Jan 01  2020 '
+                         '{} -> {}'.format(len(target), name, target))
+        if odd_line is not None:
+            callback(odd_line)
+
+    def new_connection():
+        ftp = mocker.MagicMock(spec=ftplib.FTP)
+        ftp.host = 'www.foo.bar'
+        state = {}
+        ftp.cwd.side_effect = lambda path: state.update(cwd=path)
+        if mlsd:
+            ftp.mlsd.side_effect = lambda path, facts: iter(LISTINGS[path])
+        else:
+            ftp.mlsd.side_effect = ftplib.error_perm('500 Unknown command')
+        ftp.retrlines.side_effect = lambda command, callback: list_lines(
+            state['cwd'], callback)
+
+        def retrbinary(command, callback):
+            retrieved.append(command)
+            callback(command.encode())
+        ftp.retrbinary.side_effect = retrbinary
+        return ftp
+
+    mocker.patch('tesk_core.filer_ftp.FTP', side_effect=new_connection)
+    return retrieved
+
+
+@pytest.mark.parametrize('mlsd', [True, False])
+def test_ftp_download_dir_listing(mocker, tmp_path, mlsd):
+    """ Ensure input directories are listed with MLSD, or LIST on servers
+        without it, and their files downloaded largest first."""
+
+    retrieved = mock_ftp_listings(mocker, mlsd)
+    mocker.patch('tesk_core.filer_ftp.WORKERS', 1)
+
+    with FTPTransput(str(tmp_path / 'in'), 'ftp://www.foo.bar/in',
+                     Type.Directory) as transput:
+        assert transput.download() == 0
+
+    assert retrieved == ['RETR /in/large', 'RETR /in/sub/medium',
+                         'RETR /in/small']
+    for name in ['small', 'large', 'sub/medium']:
+        assert (tmp_path / 'in' / name).read_text() == 'RETR /in/' + name
+    assert (tmp_path / 'in' / 'sub' / 'empty').is_dir()
+
+
+@pytest.mark.parametrize('mlsd', [True, False])
+def test_ftp_download_dir_links(mocker, tmp_path, caplog, mlsd):
+    """ Ensure symbolic links are left out of input directories with a
+        warning, whether listed with MLSD or LIST."""
+
+    mocker.patch.dict(LISTINGS, {'/in': LISTINGS['/in'] + [
+        ('link', {'type': 'OS.unix=slink:/in/small'})]})
+    retrieved = mock_ftp_listings(mocker, mlsd)
+    mocker.patch('tesk_core.filer_ftp.WORKERS', 1)
+
+    with FTPTransput(str(tmp_path / 'in'), 'ftp://www.foo.bar/in',
+                     Type.Directory) as transput:
+        assert transput.download() == 0
+
+    assert 'RETR /in/link' not in retrieved
+    assert not (tmp_path / 'in' / 'link').exists()
+    assert 'Skipping "link", which is neither a file nor a directory' \
+        in caplog.text
+
+
+def test_ftp_download_dir_unknown_listing(mocker, tmp_path, caplog):
+    """ Ensure a LIST listing with lines that cannot be parsed fails the
+        download instead of leaving out their entries."""
+
+    mock_ftp_listings(mocker, mlsd=False,
+                      odd_line='01-01-20  10:00AM       <DIR>          win')
+    mocker.patch('tesk_core.filer_ftp.WORKERS', 1)
+
+    with FTPTransput(str(tmp_path / 'in'), 'ftp://www.foo.bar/in',
+                     Type.Directory) as transput:
+        assert transput.download() == 1
+
+    assert 'Unable to list "ftp://www.foo.bar/in"' in caplog.text
+    assert 'Unable to parse LIST line: 01-01-20' in caplog.text
+
+
+def test_ftp_download_dir_pool(mocker, tmp_path, caplog):
+    """ Ensure the tree of an input directory is planned first, and its
+        files then all downloaded over several connections."""
+
+    caplog.set_level(logging.INFO)
+    retrieved = mock_ftp_listings(mocker)
+    mocker.patch('tesk_core.filer_ftp.WORKERS', 4)
+
+    with FTPTransput(str(tmp_path / 'in'), 'ftp://www.foo.bar/in',
+                     Type.Directory) as transput:
+        assert transput.download() == 0
+
+    assert sorted(retrieved) == ['RETR /in/large', 'RETR /in/small',
+                                 'RETR /in/sub/medium']
+    assert (tmp_path / 'in' / 'sub' / 'medium').read_text() == \
+        'RETR /in/sub/medium'
+    assert 'Downloading 3 files (111 bytes) in 3 directories' in caplog.text
+
+
+def test_ftp_download_file_resume(mocker, tmp_path):
+    """ Ensure a download interrupted by a dropped connection is retried
+        from where it stopped, and its checksum still computed over the
+        whole file."""
+
+    mocker.patch('tesk_core.filer_ftp._transferred', {})
+    mocker.patch('tesk_core.retry.time.sleep')
+    ftp = mocker.patch('tesk_core.filer_ftp.FTP').return_value
+    ftp.size.return_value = 11
+
+    def retrbinary(command, callback, rest=None):
+        if rest is None:
+            callback(b'hello ')
+            raise EOFError()
+        assert rest == 6
+        callback(b'world')
+    ftp.retrbinary.side_effect = retrbinary
+
+    path = str(tmp_path / 'file')
+    options = {'checksum': 'sha256:b94d27b9934d3e08a52e52d7da7dabfac484efe3'
+                           '7a5380ee9088f7ace2efcde9'}
+    with FTPTransput(path, 'ftp://www.foo.bar/file', Type.File,
+                     options=options) as transput:
+        assert with_retries(transput.download, transput.url) == 0
+
+    assert ftp.retrbinary.call_count == 2
+    with open(path, 'rb') as file:
+        assert file.read() == b'hello world'
+
+
+@pytest.mark.parametrize('rest', [True, False])
+def test_ftp_upload_file_resume(mocker, tmp_path, rest):
+    """ Ensure an upload interrupted by a dropped connection is retried from
+        what the server received, with REST and STOR or else APPE."""
+
+    mocker.patch('tesk_core.filer_ftp._transferred', {})
+    mocker.patch('tesk_core.retry.time.sleep')
+    ftp = mocker.patch('tesk_core.filer_ftp.FTP').return_value
+    ftp.pwd.return_value = '/'
+    ftp.size.return_value = 6
+    sent = []
+
+    def cwd(path):
+        if path != '/out':
+            raise ftplib.error_perm('550 Not a directory')
+
+    def storbinary(command, file, callback=None, rest=None):
+        if not sent:
+            sent.append(file.read(6))
+            callback(sent[0])
+            raise EOFError()
+        if rest is not None and not rest_supported:
+            raise ftplib.error_perm('502 REST not implemented')
+        sent.append((command, rest, file.read()))
+    rest_supported = rest
+    ftp.cwd.side_effect = cwd
+    ftp.storbinary.side_effect = storbinary
+
+    path = tmp_path / 'file'
+    path.write_bytes(b'hello world')
+    with FTPTransput(str(path), 'ftp://www.foo.bar/out/file',
+                     Type.File) as transput:
+        assert with_retries(transput.upload, transput.url) == 0
+
+    assert sent[-1] == (('STOR //out/file', 6, b'world') if rest
+                        else ('APPE //out/file', None, b'world'))
+
+
+@pytest.mark.parametrize('stale', [b'OLDOLD', b'OLDOLDOLDOL'])
+def test_ftp_upload_file_interrupted_before_data(mocker, tmp_path, caplog,
+                                                 stale):
+    """ Ensure an upload that failed before any of the file was sent is
+        retried whole, and a stale remote file neither resumed from nor
+        taken for the upload."""
+
+    mocker.patch('tesk_core.filer_ftp._transferred', {})
+    mocker.patch('tesk_core.retry.time.sleep')
+    ftp = mocker.patch('tesk_core.filer_ftp.FTP').return_value
+    ftp.pwd.return_value = '/'
+    ftp.size.return_value = len(stale)
+    stored = []
+
+    def cwd(path):
+        if path != '/out':
+            raise ftplib.error_perm('550 Not a directory')
+
+    def storbinary(command, file, callback=None, rest=None):
+        if not stored:
+            stored.append(None)
+            raise EOFError()
+        stored.append((command, rest, file.read()))
+    ftp.cwd.side_effect = cwd
+    ftp.storbinary.side_effect = storbinary
+
+    path = tmp_path / 'file'
+    path.write_bytes(b'hello world')
+    with caplog.at_level(logging.INFO):
+        with FTPTransput(str(path), 'ftp://www.foo.bar/out/file',
+                         Type.File) as transput:
+            assert with_retries(transput.upload, transput.url) == 0
+
+    assert stored[1:] == [('STOR //out/file', None, b'hello world')]
+    assert 'already uploaded' not in caplog.text
+    assert 'Resuming' not in caplog.text
+
+
+def test_ftps_connection(mocker):
+    """ Ensure ftps:// URLs get control and data connections secured with
+        TLS, to the port of the URL."""
+
+    ftp_tls = mocker.patch('tesk_core.filer_ftp.ReusingFTP_TLS').return_value
+    mocker.patch('tesk_core.filer_ftp._pool', FTPPool(8))
+
+    transput = FTPTransput('/tmp/dir', 'ftps://www.foo.bar:2121/dir',
+                           Type.Directory)
+    with transput.borrow() as connection:
+        assert connection.ftp is ftp_tls
+
+    ftp_tls.connect.assert_called_once_with('www.foo.bar', 2121)
+    ftp_tls.login.assert_called_once()
+    ftp_tls.prot_p.assert_called_once_with()
+
+
+@pytest.mark.parametrize('reuse', [True, False])
+def test_ftps_session_reuse(mocker, reuse):
+    """ Ensure the TLS data connections resume the session of the control
+        connection, unless told not to."""
+
+    mocker.patch('tesk_core.filer_ftp.TLS_SESSION_REUSE', reuse)
+    data_socket = mocker.MagicMock()
+    mocker.patch('ftplib.FTP.ntransfercmd', return_value=(data_socket, None))
+    context = mocker.MagicMock()
+    ftp = ReusingFTP_TLS(context=context)
+    ftp.host = 'www.foo.bar'
+    ftp.sock = mocker.MagicMock()
+    ftp.prot_p = mocker.MagicMock()
+    ftp._prot_p = True
+
+    conn, _ = ftp.ntransfercmd('RETR /file')
+
+    assert conn is context.wrap_socket.return_value
+    context.wrap_socket.assert_called_once_with(
+        data_socket, server_hostname='www.foo.bar',
+        session=ftp.sock.session if reuse else None)
+    data_socket.setsockopt.assert_called_once_with(
+        socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def test_ftp_upload_dir_sync(mocker, tmp_path):
+    """ Ensure that in sync mode, only the files that differ from their
+        remote copy, as listed by MLSD, are uploaded."""
+
+    files = ['same', 'other_size', 'older', 'missing', 'no_time']
+    ftp_class = mock_ftp_server(mocker, tmp_path, files)
+    ftp = ftp_class.return_value
+    ftp.host = 'www.foo.bar'
+    mocker.patch('tesk_core.filer_ftp._no_mlsd', set())
+    mocker.patch('tesk_core.filer_ftp.SYNC', True)
+    for name in files:
+        os.utime(str(tmp_path / 'out' / name), (1577836800, 1577836800))
+
+    def mlsd(path, facts):
+        assert path == '/out'
+        return iter([
+            ('same', {'type': 'file', 'size': '4',
+                      'modify': '20200101000000'}),
+            ('other_size', {'type': 'file', 'size': '3',
+                            'modify': '20200101000000'}),
+            ('older', {'type': 'file', 'size': '5',
+                       'modify': '20191231235959'}),
+            ('no_time', {'type': 'file', 'size': '7'}),
+        ])
+    ftp.mlsd.side_effect = mlsd
+    ftp.sendcmd.side_effect = lambda command: '213 20200102000000'
+
+    with FTPTransput(str(tmp_path / 'out'), 'ftp://www.foo.bar/out',
+                     Type.Directory) as transput:
+        assert transput.upload() == 0
+
+    assert sorted(call.args[0] for call in ftp.storbinary.mock_calls) == [
+        'STOR //out/missing', 'STOR //out/older', 'STOR //out/other_size']
+    ftp.sendcmd.assert_any_call('MDTM /out/no_time')
@@ -10,8 +10,10 @@ import pytest
 from tesk_core.filer import (
     process_file,
     copyContent,
-    FileProtocolDisabled
+    FileProtocolDisabled,
+    Type
 )
+from tesk_core.exception import TransientTransferError
 
 
 def test_process_file_no_scheme(caplog):
@@ -41,6 +43,23 @@ def test_process_file_with_scheme(mocker):
     mock_new_Trans.assert_called_once_with('http','www.foo.bar')
 
 
+def test_process_file_options(mocker):
+    """ Ensure the transfer options of a file are handed to its transput."""
+
+    filedata = {
+        'url': 'http://www.foo.bar',
+        'path': '.',
+        'type': 'FILE',
+        'name': 'foo',
+        'compression': 'gzip',
+    }
+    mock_new_Trans = mocker.patch('tesk_core.filer.newTransput')
+    process_file('inputs', filedata)
+
+    mock_new_Trans.return_value.assert_called_once_with(
+        '.', 'http://www.foo.bar', Type.File, options={'compression': 'gzip'})
+
+
 def test_process_file_from_content(tmpdir, tmp_path):
     """ Ensure 'process_file' behaves correctly when the file contents
         should be drawn from the filedata content field."""
@@ -62,3 +81,22 @@ def test_copyContent_dir(mocker):
     copyContent('.', '/test_dst')
 
     mock_os_listdir.assert_called_once_with('.')
+
+
+def test_process_file_retries(mocker):
+    """ Ensure a transfer failing with a transient error is attempted again,
+    connecting anew."""
+
+    filedata = {
+        'url': 'http://www.foo.bar',
+        'path': '.',
+        'type': 'FILE',
+    }
+    transput = mocker.MagicMock()
+    transput.return_value.__enter__.return_value.download.side_effect = [
+        TransientTransferError('Got status code 503'), 0]
+    mocker.patch('tesk_core.filer.newTransput', return_value=transput)
+    mocker.patch('tesk_core.retry.time.sleep')
+
+    assert process_file('inputs', filedata) == 0
+    assert transput.call_count == 2
@@ -0,0 +1,118 @@
+"""Tests for the HTTP/2 engine of the filer using 'pytest'."""
+
+import pytest
+import requests
+
+from tesk_core.filer_http import HTTPTransput, get_session, select_engine
+from tesk_core.transput import Type
+
+httpx = pytest.importorskip('httpx')
+
+from tesk_core.filer_http2 import H2Session
+
+URL = 'https://www.foo.bar/file'
+
+
+@pytest.fixture
+def h2_session(mocker):
+    """ An HTTP/2 session answering with 'handler', used by the filer."""
+
+    sessions = []
+
+    def make(handler):
+        session = H2Session(transport=httpx.MockTransport(handler))
+        sessions.append(session)
+        mocker.patch('tesk_core.filer_http._session', session)
+        return session
+
+    yield make
+    for session in sessions:
+        session.close()
+
+
+def test_download_file(h2_session, tmp_path):
+    """ Ensure a file is downloaded through the HTTP/2 session."""
+
+    body = bytes(range(256)) * 64
+    h2_session(lambda request: httpx.Response(200, content=body))
+    path = str(tmp_path / 'file')
+
+    assert 0 == HTTPTransput(path, URL, Type.File).download_file()
+    assert open(path, 'rb').read() == body
+
+
+def test_download_file_error(h2_session, tmp_path, caplog):
+    """ Ensure an error status fails the download."""
+
+    h2_session(lambda request: httpx.Response(404, content=b'Not there'))
+
+    assert 1 == HTTPTransput(str(tmp_path / 'file'), URL,
+                             Type.File).download_file()
+    assert 'Not there' in caplog.text
+
+
+def test_upload_file(h2_session, tmp_path):
+    """ Ensure a file is sent with its size as Content-Length."""
+
+    received = []
+
+    def handler(request):
+        received.append((request.headers.get('Content-Length'),
+                         request.read()))
+        return httpx.Response(201)
+
+    h2_session(handler)
+    path = tmp_path / 'file'
+    path.write_bytes(b'x' * 100000)
+
+    assert 0 == HTTPTransput(str(path), URL, Type.File).upload_file()
+    assert received == [('100000', b'x' * 100000)]
+
+
+def test_resend_unprocessed(h2_session, tmp_path):
+    """ Ensure a request failed by the server closing its connection is sent
+    again, with the whole file."""
+
+    received = []
+
+    def handler(request):
+        received.append(request.read())
+        if len(received) == 1:
+            raise httpx.RemoteProtocolError('ConnectionTerminated')
+        return httpx.Response(201)
+
+    h2_session(handler)
+    path = tmp_path / 'file'
+    path.write_bytes(b'contents')
+
+    assert 0 == HTTPTransput(str(path), URL, Type.File).upload_file()
+    assert received == [b'contents', b'contents']
+
+
+def test_connection_error(h2_session):
+    """ Ensure httpx errors are raised as those of requests."""
+
+    def handler(request):
+        raise httpx.ConnectError('Refused')
+
+    session = h2_session(handler)
+    with pytest.raises(requests.ConnectionError):
+        session.get(URL)
+
+
+def test_select_engine(mocker):
+    """ Ensure the engine picks the session type, and unknown ones are
+    refused."""
+
+    mocker.patch('tesk_core.filer_http._session', None)
+    mocker.patch('tesk_core.filer_http.ENGINE', 'requests')
+
+    select_engine('http2')
+    try:
+        assert isinstance(get_session(), H2Session)
+    finally:
+        select_engine('requests')
+    assert isinstance(get_session(), requests.Session)
+
+    with pytest.raises(ValueError):
+        select_engine('http3')
@@ -1,6 +1,14 @@
 """Tests for 'filer.py' HTTP functionalities using 'pytest'."""
 
-from requests import Response, put
+from requests import Response, put, ConnectionError
+import gzip
+import hashlib
+import io
+import json
+import pytest
+import threading
+import time
+import logging
 import os
 from unittest import mock
 
@@ -8,6 +16,14 @@ from tesk_core.filer import (
     HTTPTransput,
     Type
 )
+from tesk_core.filer_http import (
+    get_session,
+    close_session,
+    ResumeRecord,
+    child_entries
+)
+from tesk_core.checksum import write_report
+from tesk_core.exception import TransientTransferError
 
 PATH_DOWN = 'test_download_file.txt'
 PATH_UP = 'tests/test_filer_http_pytest.py'
@@ -18,6 +34,8 @@ FTYPE = 'FILE'
 
 resp = Response()
 resp._content = b'{ "foo" : "bar" }'
+# The body is already in memory, so streaming it must not touch 'raw'
+resp._content_consumed = True
 
 
 def test_download_file(mocker):
@@ -25,7 +43,7 @@ def test_download_file(mocker):
 
     resp.status_code = SUCCESS
     http_obj = HTTPTransput(PATH_DOWN, URL, FTYPE)
-    mocker.patch('requests.get', return_value=resp)
+    mocker.patch('requests.Session.get', return_value=resp)
 
     with mock.patch(
             'builtins.open',
@@ -36,12 +54,170 @@ def test_download_file(mocker):
         assert open(PATH_DOWN, 'rb').read() == resp._content
 
 
+def test_download_file_streams_chunks(mocker, caplog):
+    """ Ensure the body is requested as a stream and written to disk in
+    chunks of at most 'CHUNK_SIZE' bytes."""
+
+    caplog.set_level(logging.INFO)
+    resp.status_code = SUCCESS
+    http_obj = HTTPTransput(PATH_DOWN, URL, FTYPE)
+    mock_get = mocker.patch('requests.Session.get', return_value=resp)
+    mocker.patch('tesk_core.filer_http.CHUNK_SIZE', 4)
+
+    with mock.patch('builtins.open', mock.mock_open(), create=False) as m:
+        assert 0 == http_obj.download_file()
+
+    mock_get.assert_called_once_with(URL, headers={}, stream=True)
+    writes = [c.args[0] for c in m().write.mock_calls]
+    assert all(len(chunk) <= 4 for chunk in writes)
+    assert b''.join(writes) == resp._content
+    assert 'Downloaded {} bytes'.format(len(resp._content)) in caplog.text
+
+
+def range_response(body, headers):
+    """ Builds the response of a server supporting byte ranges over 'body'.
+    """
+
+    rresp = Response()
+    rresp._content_consumed = True
+    first, last = headers['Range'][len('bytes='):].split('-')
+    rresp._content = body[int(first):int(last) + 1]
+    rresp.status_code = 206
+    return rresp
+
+
+def test_download_file_segmented(mocker, tmp_path):
+    """ Ensure a file is fetched as concurrent byte ranges written at their
+    offsets when the server supports ranges."""
+
+    body = bytes(range(256)) * 40
+    head = Response()
+    head.status_code = SUCCESS
+    head.headers.update({'Accept-Ranges': 'bytes',
+                         'Content-Length': str(len(body))})
+    mocker.patch('requests.Session.head', return_value=head)
+    mock_get = mocker.patch(
+        'requests.Session.get',
+        side_effect=lambda url, headers, stream: range_response(body, headers))
+    mocker.patch('tesk_core.filer_http.SEGMENTS', 4)
+    mocker.patch('tesk_core.filer_http.SEGMENT_SIZE', 1000)
+
+    path = str(tmp_path / 'segmented')
+    assert 0 == HTTPTransput(path, URL, FTYPE).download_file()
+    assert open(path, 'rb').read() == body
+    assert sorted(c.kwargs['headers']['Range'] for c in mock_get.mock_calls) \
+        == ['bytes=0-2559', 'bytes=2560-5119', 'bytes=5120-7679',
+            'bytes=7680-10239']
+
+
+def test_download_file_segmented_fallback(mocker, tmp_path):
+    """ Ensure a server without range support gets a single request."""
+
+    head = Response()
+    head.status_code = SUCCESS
+    head.headers.update({'Content-Length': '100000'})
+    mocker.patch('requests.Session.head', return_value=head)
+    resp.status_code = SUCCESS
+    mock_get = mocker.patch('requests.Session.get', return_value=resp)
+    mocker.patch('tesk_core.filer_http.SEGMENTS', 4)
+    mocker.patch('tesk_core.filer_http.SEGMENT_SIZE', 1000)
+
+    path = str(tmp_path / 'single')
+    assert 0 == HTTPTransput(path, URL, FTYPE).download_file()
+    mock_get.assert_called_once_with(URL, headers={}, stream=True)
+    assert open(path, 'rb').read() == resp._content
+
+
+def test_download_file_segmented_ranges_ignored(mocker, tmp_path, caplog):
+    """ Ensure a server advertising ranges but answering them with the whole
+    file gets the file downloaded in a single stream instead."""
+
+    body = bytes(range(256)) * 40
+    head = Response()
+    head.status_code = SUCCESS
+    head.headers.update({'Accept-Ranges': 'bytes',
+                         'Content-Length': str(len(body))})
+    mocker.patch('requests.Session.head', return_value=head)
+
+    def whole(url, headers, stream):
+        wresp = Response()
+        wresp.status_code = SUCCESS
+        wresp._content = body
+        wresp._content_consumed = True
+        return wresp
+
+    mock_get = mocker.patch('requests.Session.get', side_effect=whole)
+    mocker.patch('tesk_core.filer_http.SEGMENTS', 4)
+    mocker.patch('tesk_core.filer_http.SEGMENT_SIZE', 1000)
+
+    path = str(tmp_path / 'segmented')
+    assert 0 == HTTPTransput(path, URL, FTYPE).download_file()
+    assert open(path, 'rb').read() == body
+    assert mock_get.mock_calls[-1] == mock.call(URL, headers={}, stream=True)
+    assert 'ignores byte ranges' in caplog.text
+
+
+def test_download_file_resume(mocker, tmp_path):
+    """ Ensure a partial download with a matching record continues with a
+    Range request and ends up as the complete file."""
+
+    body = bytes(range(256)) * 4
+    path = str(tmp_path / 'resumed')
+    with open(path + '.part', 'wb') as partial:
+        partial.write(body[:300])
+    record = ResumeRecord(path + '.part.json', URL, '"v1"')
+    record.written = 300
+    record.save()
+
+    def get(url, headers, stream):
+        rresp = range_response(body, {'Range': headers['Range'] + '1023'})
+        rresp.headers['ETag'] = '"v1"'
+        return rresp
+
+    mock_get = mocker.patch('requests.Session.get', side_effect=get)
+    mocker.patch('tesk_core.filer_http.RESUME', True)
+
+    assert 0 == HTTPTransput(path, URL, FTYPE).download_file()
+    mock_get.assert_called_once_with(
+        URL, headers={'Range': 'bytes=300-', 'If-Range': '"v1"'}, stream=True)
+    assert open(path, 'rb').read() == body
+    assert not os.path.exists(path + '.part')
+    assert not os.path.exists(path + '.part.json')
+
+
+def test_download_file_interrupted_keeps_progress(mocker, tmp_path):
+    """ Ensure an interrupted download leaves its partial file and a record
+    of the bytes safely written."""
+
+    def chunks(size):
+        yield b'a' * 10
+        yield b'b' * 10
+        raise ConnectionError('connection reset')
+
+    broken = Response()
+    broken._content_consumed = True
+    broken.status_code = SUCCESS
+    broken.headers['ETag'] = '"v2"'
+    broken.iter_content = chunks
+    mocker.patch('requests.Session.get', return_value=broken)
+    mocker.patch('tesk_core.filer_http.RESUME', True)
+    mocker.patch('tesk_core.filer_http.RESUME_CHECKPOINT', 10)
+
+    path = str(tmp_path / 'interrupted')
+    with pytest.raises(ConnectionError):
+        HTTPTransput(path, URL, FTYPE).download_file()
+
+    assert open(path + '.part', 'rb').read() == b'a' * 10 + b'b' * 10
+    with open(path + '.part.json') as record:
+        assert json.load(record)['written'] == 20
+
+
 def test_download_file_error(mocker, caplog):
     """ Ensure download error returns the correct value and log message."""
 
     resp.status_code = FAIL
     http_obj = HTTPTransput(PATH_DOWN, URL, FTYPE)
-    mocker.patch('requests.get', return_value=resp)
+    mocker.patch('requests.Session.get', return_value=resp)
 
     assert 1 == http_obj.download_file()
     assert 'Got status code: {}'.format(FAIL) in caplog.text
@@ -52,22 +228,122 @@ def test_upload_file(mocker):
 
     resp.status_code = SUCCESS
     http_obj = HTTPTransput(PATH_UP, URL, FTYPE)
-    mocker.patch('requests.put', return_value=resp)
+    mocker.patch('requests.Session.put', return_value=resp)
 
     assert 0 == http_obj.upload_file()
 
 
+def test_upload_file_chunked(mocker, fs):
+    """ Ensure the chunked mode sends the file as a generator of bounded
+    binary chunks."""
+
+    contents = bytes(range(256)) * 4
+    fs.create_file('binary.dat', contents=contents)
+    resp.status_code = SUCCESS
+    sent = []
+
+    def put(url, data, headers):
+        assert not hasattr(data, 'read')
+        sent.extend(data)
+        return resp
+
+    mocker.patch('requests.Session.put', side_effect=put)
+    mocker.patch('tesk_core.filer_http.UPLOAD_CHUNKED', True)
+    mocker.patch('tesk_core.filer_http.CHUNK_SIZE', 100)
+
+    assert 0 == HTTPTransput('binary.dat', URL, FTYPE).upload_file()
+    assert all(len(chunk) <= 100 for chunk in sent)
+    assert b''.join(sent) == contents
+
+
+def test_upload_file_empty(mocker, tmp_path):
+    """ Ensure an empty file is sent with a Content-Length of 0, not chunked
+    encoding, which some servers refuse."""
+
+    path = tmp_path / 'empty'
+    path.write_bytes(b'')
+    sent = []
+
+    def send(request, **kwargs):
+        sent.append(request)
+        return make_response(SUCCESS, b'')
+
+    mocker.patch('requests.adapters.HTTPAdapter.send', side_effect=send)
+
+    assert 0 == HTTPTransput(str(path), URL, FTYPE).upload_file()
+    assert sent[0].headers['Content-Length'] == '0'
+    assert 'Transfer-Encoding' not in sent[0].headers
+    assert not sent[0].body
+
+
+def test_upload_file_compressed(mocker, fs):
+    """ Ensure the 'compression' option sends the file gzipped on the wire,
+    with the matching Content-Encoding."""
+
+    contents = b'chrom\tpos\tref\talt\n' * 1000
+    fs.create_file('calls.tsv', contents=contents)
+    resp.status_code = SUCCESS
+    sent = {}
+
+    def put(url, data, headers):
+        sent['headers'] = headers
+        sent['body'] = b''.join(data)
+        return resp
+
+    mocker.patch('requests.Session.put', side_effect=put)
+
+    http_obj = HTTPTransput('calls.tsv', URL, FTYPE,
+                            options={'compression': 'gzip'})
+    assert 0 == http_obj.upload_file()
+    assert sent['headers'] == {'Content-Encoding': 'gzip'}
+    assert len(sent['body']) < len(contents)
+    assert gzip.decompress(sent['body']) == contents
+
+
+def test_download_file_compressed(mocker, tmp_path):
+    """ Ensure the 'compression' option asks for compressed content and
+    writes it decompressed."""
+
+    contents = b'line of a log file\n' * 1000
+    compressed = make_response(SUCCESS, None, {'Content-Encoding': 'gzip'})
+    compressed.raw = io.BytesIO(gzip.compress(contents))
+    mock_get = mocker.patch('requests.Session.get', return_value=compressed)
+
+    path = str(tmp_path / 'log')
+    http_obj = HTTPTransput(path, URL, FTYPE, options={'compression': True})
+    assert 0 == http_obj.download_file()
+    assert mock_get.call_args.kwargs['headers']['Accept-Encoding'] \
+        .startswith('gzip')
+    assert open(path, 'rb').read() == contents
+
+
 def test_upload_file_error(mocker, caplog):
     """ Ensure upload error returns the correct value and log message."""
 
     resp.status_code = FAIL
     http_obj = HTTPTransput(PATH_UP, URL, FTYPE)
-    mocker.patch('requests.put', return_value=resp)
+    mocker.patch('requests.Session.put', return_value=resp)
 
     assert 1 == http_obj.upload_file()
     assert 'Got status code: {}'.format(FAIL) in caplog.text
 
 
+def test_shared_session(mocker):
+    """ Ensure every transfer goes through one pooled session until it is
+    closed."""
+
+    mocker.patch('tesk_core.filer_http.POOL_SIZE', 12)
+    close_session()
+
+    session = get_session()
+    assert get_session() is session
+    assert session.get_adapter(URL)._pool_maxsize == 12
+
+    close_session()
+    assert get_session() is not session
+    close_session()
+
+
 def test_upload_dir(mocker, fs):
     """ Ensure that each file inside nexted directories gets successfully
     uploaded."""
@@ -83,7 +359,13 @@ def test_upload_dir(mocker, fs):
     fs.create_file('dir1/dir2/file4.txt', contents="took me a while")
 
 
-    mock_put = mocker.patch('requests.put', return_value=resp)
+    uploaded = {}
+
+    def put(url, data, headers):
+        uploaded[url] = data.read()
+        return resp
+
+    mocker.patch('requests.Session.put', side_effect=put)
 
     http_obj = HTTPTransput(
         "dir1",
@@ -93,13 +375,205 @@ def test_upload_dir(mocker, fs):
 
     assert http_obj.upload_dir() == 0
 
-    # We emply the 'list.sorted' trick to ignore calls order because the
-    # 'assert_has_calls' method would not work in this setting
-    assert sorted(mock_put.mock_calls) == sorted([
-        mock.call(endpoint + '/dir1/dir2/file2', data="not really"),
-        mock.call(endpoint + '/dir1/dir2/file4.txt', data="took me a while"),
-        mock.call(endpoint + '/dir1/file1', data="this is random"),
-    ])
+    # Files are sent as binary file objects, so compare what was read from them
+    assert uploaded == {
+        endpoint + '/dir1/dir2/file2': b"not really",
+        endpoint + '/dir1/dir2/file4.txt': b"took me a while",
+        endpoint + '/dir1/file1': b"this is random",
+    }
+
+
+@pytest.mark.parametrize('path', ['/nonexistent/outdir', 'file1'])
+def test_upload_dir_unlisted(mocker, fs, caplog, path):
+    """ Ensure an output directory that cannot be listed fails the upload
+    instead of uploading nothing."""
+
+    fs.create_file('file1', contents="not a directory")
+    mock_put = mocker.patch('requests.Session.put')
+
+    assert HTTPTransput(path, URL, Type.Directory).upload() == 1
+    mock_put.assert_not_called()
+    assert 'Unable to list the directory "{}"'.format(path) in caplog.text
+
+
+def test_upload_dir_concurrent(mocker, fs, caplog):
+    """ Ensure a directory is uploaded by several workers, never exceeding
+    the connections allowed per host, and that failed files are reported."""
+
+    fs.create_dir('out')
+    for i in range(12):
+        fs.create_file('out/sub{}/file{}'.format(i % 3, i), contents=str(i))
+
+    lock = threading.Lock()
+    active = []
+    most_active = []
+
+    def put(url, data, headers):
+        with lock:
+            active.append(url)
+            most_active.append(len(active))
+        time.sleep(0.01)
+        with lock:
+            active.remove(url)
+        failed = Response()
+        failed._content_consumed = True
+        failed._content = b''
+        failed.status_code = 403 if url.endswith('/file7') else SUCCESS
+        return failed
+
+    mocker.patch('requests.Session.put', side_effect=put)
+    mocker.patch('tesk_core.filer_http.UPLOAD_WORKERS', 6)
+    mocker.patch('tesk_core.filer_http.HOST_CONNECTIONS', 2)
+
+    http_obj = HTTPTransput('out', URL + '/out', Type.Directory)
+
+    assert http_obj.upload_dir() == 1
+    assert len(most_active) == 12
+    assert max(most_active) == 2
+    assert 'Unable to upload 1 of 12 files' in caplog.text
+    assert '"out/sub1/file7" -> {}/out/sub1/file7'.format(URL) in caplog.text
+
+
+def make_response(status_code, content, headers=None):
+    made = Response()
+    made._content_consumed = True
+    made._content = content
+    made.status_code = status_code
+    made.headers.update(headers or {})
+    return made
+
+
+def test_child_entries():
+    """ Ensure only the direct children of a listed directory are kept."""
+
+    base = URL + '/data/'
+    hrefs = ['../', '?C=N;O=D', '/data/', 'a.txt', 'sub/', '/data/b%20c.txt',
+             URL + '/other/x', 'http://elsewhere/data/y', 'sub/deeper.txt']
+    assert child_entries(base, hrefs) == [
+        (base + 'a.txt', False),
+        (base + 'b%20c.txt', False),
+        (base + 'sub/', True),
+    ]
+
+
+def test_child_entries_quoted():
+    """ Ensure links escaping other characters than the listed URL are still
+    found inside it."""
+
+    base = URL + '/my%20data/'
+    hrefs = ['/my data/a b.txt', '/my%20data/c%2Bd.txt', '/my%20data/sub/',
+             URL + '/my%20data/']
+    assert child_entries(base, hrefs) == [
+        (base + 'a%20b.txt', False),
+        (base + 'c%2Bd.txt', False),
+        (base + 'sub/', True),
+    ]
+
+
+def test_download_dir_not_an_index(mocker, tmp_path, caplog):
+    """ Ensure an HTML page that links to nothing in the directory to
+    download fails the download instead of making it an empty one."""
+
+    mocker.patch('requests.Session.request',
+                 side_effect=lambda method, url, **kwargs:
+                     make_response(405, b''))
+    mocker.patch('requests.Session.get', return_value=make_response(
+        SUCCESS, b'<html><a href="/login">Log in</a></html>',
+        {'Content-Type': 'text/html'}))
+
+    target = str(tmp_path / 'idx')
+    assert 1 == HTTPTransput(target, URL + '/idx/', Type.Directory).download()
+    assert 'is not an HTML directory index' in caplog.text
+
+
+def test_download_dir_webdav(mocker, tmp_path):
+    """ Ensure a WebDAV collection is listed with PROPFIND and every file
+    found in it is downloaded to the matching local path."""
+
+    def multistatus(*hrefs):
+        responses = ''.join(
+            '<d:response><d:href>{}</d:href><d:propstat><d:prop>'
+            '<d:resourcetype>{}</d:resourcetype></d:prop></d:propstat>'
+            '</d:response>'.format(href.rstrip('/'),
+                                   '<d:collection/>' if href.endswith('/')
+                                   else '')
+            for href in hrefs)
+        return ('<?xml version="1.0"?><d:multistatus xmlns:d="DAV:">{}'
+                '</d:multistatus>'.format(responses)).encode()
+
+    listings = {
+        URL + '/dav/': multistatus('/dav/', '/dav/f1', '/dav/sub/'),
+        URL + '/dav/sub/': multistatus('/dav/sub/', '/dav/sub/f2'),
+    }
+    mock_request = mocker.patch(
+        'requests.Session.request',
+        side_effect=lambda method, url, **kwargs:
+            make_response(207, listings[url]))
+    mocker.patch(
+        'requests.Session.get',
+        side_effect=lambda url, **kwargs:
+            make_response(SUCCESS, url.encode()))
+
+    target = str(tmp_path / 'dav')
+    assert 0 == HTTPTransput(target, URL + '/dav', Type.Directory).download_dir()
+    assert [c.args[:2] for c in mock_request.mock_calls] == [
+        ('PROPFIND', URL + '/dav/'), ('PROPFIND', URL + '/dav/sub/')]
+    assert open(target + '/f1', 'rb').read() == (URL + '/dav/f1').encode()
+    assert open(target + '/sub/f2', 'rb').read() \
+        == (URL + '/dav/sub/f2').encode()
+
+
+def test_download_dir_autoindex(mocker, tmp_path, caplog):
+    """ Ensure servers without WebDAV are crawled through their HTML index
+    pages, and that files that fail are reported."""
+
+    pages = {
+        URL + '/idx/': b'<html><a href="../">Parent</a><a href="f1">f1</a>'
+                       b'<a href="missing">missing</a><a href="sub/">sub/</a>',
+        URL + '/idx/sub/': b'<html><a href="f2">f2</a></html>',
+    }
+
+    def get(url, **kwargs):
+        if url in pages:
+            return make_response(SUCCESS, pages[url],
+                                 {'Content-Type': 'text/html'})
+        if url.endswith('missing'):
+            return make_response(404, b'Not found')
+        return make_response(SUCCESS, url.encode())
+
+    mocker.patch('requests.Session.request',
+                 side_effect=lambda method, url, **kwargs:
+                     make_response(405, b''))
+    mocker.patch('requests.Session.get', side_effect=get)
+
+    target = str(tmp_path / 'idx')
+    assert 1 == HTTPTransput(target, URL + '/idx/', Type.Directory).download()
+    assert open(target + '/f1', 'rb').read() == (URL + '/idx/f1').encode()
+    assert open(target + '/sub/f2', 'rb').read() \
+        == (URL + '/idx/sub/f2').encode()
+    assert 'Unable to download 1 entries' in caplog.text
+    assert URL + '/idx/missing' in caplog.text
+
+
+def test_download_file_cached(mocker, tmp_path):
+    """ Ensure a cached input is revalidated with a conditional request and
+    copied from the cache when the server answers 304."""
+
+    answers = [make_response(SUCCESS, b'reference', {'ETag': '"r1"'}),
+               make_response(304, b'')]
+    mock_get = mocker.patch('requests.Session.get', side_effect=answers)
+    mocker.patch('tesk_core.filer_http.CACHE_DIR', str(tmp_path / 'cache'))
+
+    first, second = str(tmp_path / 'first'), str(tmp_path / 'second')
+    assert 0 == HTTPTransput(first, URL, FTYPE).download_file()
+    assert 0 == HTTPTransput(second, URL, FTYPE).download_file()
+
+    assert mock_get.mock_calls == [
+        mock.call(URL, headers={}, stream=True),
+        mock.call(URL, headers={'If-None-Match': '"r1"'}, stream=True),
+    ]
+    assert open(first, 'rb').read() == b'reference'
+    assert open(second, 'rb').read() == b'reference'
 
 
     def test_upload_dir_error(mocker, fs):
@@ -127,3 +601,88 @@ def test_upload_dir(mocker, fs):
 
         assert http_obj1.upload_dir() == 1
         assert http_obj2.upload_dir() == 1
+
+
+def test_download_file_checksum(mocker, tmp_path):
+    """ Ensure a file with a checksum is hashed as it is written, and the
+    digest recorded in the report."""
+
+    resp.status_code = SUCCESS
+    mocker.patch('requests.Session.get', return_value=resp)
+    mocker.patch('tesk_core.checksum._report', [])
+    path = str(tmp_path / 'checked')
+    digest = hashlib.sha256(resp._content).hexdigest()
+
+    http_obj = HTTPTransput(path, URL, Type.File,
+                            options={'checksum': 'sha256:' + digest})
+    assert 0 == http_obj.download()
+    assert open(path, 'rb').read() == resp._content
+
+    report = str(tmp_path / 'report.json')
+    write_report(report)
+    assert json.load(open(report)) == [{
+        'path': path, 'url': URL, 'algorithm': 'sha256', 'digest': digest,
+        'expected': digest, 'ok': True}]
+
+
+def test_download_file_checksum_mismatch(mocker, tmp_path, caplog):
+    """ Ensure a file whose digest differs from the expected one is removed
+    and the download fails."""
+
+    resp.status_code = SUCCESS
+    mocker.patch('requests.Session.get', return_value=resp)
+    mocker.patch('tesk_core.checksum._report', [])
+    path = str(tmp_path / 'checked')
+
+    http_obj = HTTPTransput(path, URL, Type.File,
+                            options={'checksum': 'md5:' + '0' * 32})
+    assert 1 == http_obj.download()
+    assert not os.path.exists(path)
+    assert 'md5 checksum of {} is'.format(URL) in caplog.text
+
+
+def test_download_file_checksum_resumed(mocker, tmp_path):
+    """ Ensure the bytes kept from an interrupted download are part of the
+    digest of the resumed one."""
+
+    body = bytes(range(256)) * 4
+    path = str(tmp_path / 'resumed')
+    with open(path + '.part', 'wb') as partial:
+        partial.write(body[:300])
+    record = ResumeRecord(path + '.part.json', URL, '"v1"')
+    record.written = 300
+    record.save()
+
+    def get(url, headers, stream):
+        rresp = range_response(body, {'Range': headers['Range'] + '1023'})
+        rresp.headers['ETag'] = '"v1"'
+        return rresp
+
+    mocker.patch('requests.Session.get', side_effect=get)
+    mocker.patch('tesk_core.filer_http.RESUME', True)
+    mocker.patch('tesk_core.checksum._report', [])
+
+    checksum = 'sha256:' + hashlib.sha256(body).hexdigest()
+    assert 0 == HTTPTransput(path, URL, Type.File,
+                             options={'checksum': checksum}).download()
+
+
+def test_download_file_checksum_invalid(caplog):
+    """ Ensure an unknown algorithm fails the download before any request."""
+
+    http_obj = HTTPTransput(PATH_DOWN, URL, Type.File,
+                            options={'checksum': 'sha3:abcd'})
+    assert 1 == http_obj.download()
+    assert 'Invalid checksum' in caplog.text
+
+
+def test_download_file_retry_after(mocker):
+    """ Ensure server errors are raised as transient, with the delay asked
+    for by the server."""
+
+    busy = make_response(503, b'Busy', {'Retry-After': '7'})
+    mocker.patch('requests.Session.get', return_value=busy)
+
+    with pytest.raises(TransientTransferError) as err:
+        HTTPTransput(PATH_DOWN, URL, FTYPE).download_file()
+    assert err.value.retry_after == 7
@@ -0,0 +1,156 @@
+"""Tests for 'retry.py' using 'pytest'."""
+
+import ftplib
+
+import boto3.exceptions
+import botocore.exceptions
+import pytest
+import requests
+import urllib3.exceptions
+
+from tesk_core.exception import TransientTransferError
+from tesk_core.retry import (
+    RetryBudget,
+    backoff_delay,
+    is_transient,
+    with_retries
+)
+
+
+@pytest.fixture
+def sleeps(mocker):
+    """ The delays slept for, without sleeping."""
+
+    sleeps = []
+    mocker.patch('tesk_core.retry.time.sleep', side_effect=sleeps.append)
+    mocker.patch('tesk_core.retry._budget', RetryBudget(100))
+    return sleeps
+
+
+def failing(errors, result=0):
+    """ An action raising 'errors' one after another, then returning
+    'result'."""
+
+    errors = list(errors)
+
+    def action():
+        if errors:
+            raise errors.pop(0)
+        return result
+
+    return action
+
+
+def test_retries_until_success(sleeps):
+    """ Ensure transient errors are retried with growing delays."""
+
+    action = failing([requests.ConnectionError('reset'),
+                      ftplib.error_temp('421 Too many users')])
+    assert with_retries(action, 'file') == 0
+    assert len(sleeps) == 2
+
+
+def test_gives_up(sleeps, mocker, caplog):
+    """ Ensure a transfer fails after its attempts are used up."""
+
+    mocker.patch('tesk_core.retry.ATTEMPTS', 3)
+    action = failing([TransientTransferError('Got status code 503')] * 5)
+
+    assert with_retries(action, 'file') == 1
+    assert len(sleeps) == 2
+    assert 'Giving up on file after 3 attempts' in caplog.text
+
+
+def test_budget(sleeps, mocker, caplog):
+    """ Ensure the retries of all transfers are bounded by the budget."""
+
+    mocker.patch('tesk_core.retry._budget', RetryBudget(1))
+    error = requests.ConnectionError('reset')
+
+    assert with_retries(failing([error]), 'first') == 0
+    assert with_retries(failing([error]), 'second') == 1
+    assert 'no retries left' in caplog.text
+
+
+def test_not_transient(sleeps):
+    """ Ensure other errors are raised at once."""
+
+    with pytest.raises(ValueError):
+        with_retries(failing([ValueError('bad')]), 'file')
+    assert sleeps == []
+
+
+def test_retry_after(sleeps, mocker):
+    """ Ensure the delay asked for by the server is honoured, within the
+    cap."""
+
+    mocker.patch('tesk_core.retry.MAX_DELAY_MS', 30000)
+    action = failing([TransientTransferError('429', retry_after=20),
+                      TransientTransferError('429', retry_after=3600)])
+    assert with_retries(action, 'file') == 0
+    assert sleeps[0] >= 20
+    assert sleeps[1] == 30
+
+
+@pytest.mark.parametrize('retry', range(10))
+def test_backoff_delay(mocker, retry):
+    """ Ensure delays grow exponentially up to the cap."""
+
+    mocker.patch('tesk_core.retry.BASE_DELAY_MS', 100)
+    mocker.patch('tesk_core.retry.MAX_DELAY_MS', 10000)
+    assert 0 <= backoff_delay(retry) <= min(10, 0.1 * 2 ** retry)
+
+
+@pytest.mark.parametrize('code, status, expected', [
+    ('SlowDown', 503, True),
+    ('ThrottlingException', 400, True),
+    ('InternalError', 500, True),
+    ('NoSuchKey', 404, False),
+    ('AccessDenied', 403, False),
+])
+def test_s3_errors(code, status, expected):
+    """ Ensure S3 throttling and unavailability are transient."""
+
+    err = botocore.exceptions.ClientError(
+        {'Error': {'Code': code, 'Message': ''},
+         'ResponseMetadata': {'HTTPStatusCode': status}}, 'GetObject')
+    assert is_transient(err) == expected
+
+
+@pytest.mark.parametrize('code, status, expected', [
+    ('SlowDown', 503, True),
+    ('AccessDenied', 403, False),
+])
+def test_s3_upload_errors(code, status, expected):
+    """ Ensure failed uploads are as transient as the S3 error behind them."""
+
+    err = botocore.exceptions.ClientError(
+        {'Error': {'Code': code, 'Message': ''},
+         'ResponseMetadata': {'HTTPStatusCode': status}}, 'PutObject')
+    try:
+        try:
+            raise err
+        except botocore.exceptions.ClientError:
+            raise boto3.exceptions.S3UploadFailedError('Failed to upload')
+    except boto3.exceptions.S3UploadFailedError as upload_err:
+        assert is_transient(upload_err) == expected
+    assert not is_transient(boto3.exceptions.S3UploadFailedError('Failed'))
+
+
+def test_ftp_errors():
+    """ Ensure FTP 4xx replies are transient, 5xx ones are not."""
+
+    assert is_transient(ftplib.error_temp('450 File unavailable'))
+    assert not is_transient(ftplib.error_perm('550 No such file'))
+
+
+def test_raw_read_errors():
+    """ Ensure connections broken or timed out while reading the raw body of
+    a response are transient."""
+
+    assert is_transient(urllib3.exceptions.ProtocolError(
+        'Connection broken', ConnectionResetError()))
+    assert is_transient(urllib3.exceptions.ReadTimeoutError(
+        None, 'http://www.foo.bar/file', 'Read timed out.'))
+    assert is_transient(urllib3.exceptions.IncompleteRead(10, 20))
+    assert not is_transient(urllib3.exceptions.DecodeError('Bad gzip'))
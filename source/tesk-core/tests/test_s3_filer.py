@@ -1,14 +1,22 @@
 import os
+import hashlib
 import pytest
 import boto3
-from tesk_core.filer_s3 import S3Transput
+import botocore.exceptions
+from tesk_core.filer_s3 import S3Transput, clear_resources, get_resource, transfer_config
+from tesk_core.transput import Type
+from tesk_core.retry import RetryBudget, with_retries
 #from tesk_core.extract_endpoint import extract_endpoint
 from moto import mock_s3
 from unittest.mock import patch, mock_open
 
 @pytest.fixture()
 def moto_boto():
+    # Every test gets a new stand-in, whose buckets the filer does not know yet
+    clear_resources()
     with mock_s3():
+        # Made before pyfakefs or a patched open() hide the service models of botocore
+        get_resource().meta.client.get_paginator('list_objects_v2')
         boto3.client('s3', endpoint_url="http://s3.amazonaws.com")
 
         client = boto3.resource('s3',endpoint_url="http://s3.amazonaws.com")
@@ -44,6 +52,28 @@ def test_check_if_bucket_exists(moto_boto, path, url, ftype, expected):
         trans = S3Transput(path, url, ftype)
         assert trans.check_if_bucket_exists(client) == expected
 
+def test_s3_transputs_share_client(moto_boto):
+    """
+    Checking that transfers share one client and only check their bucket once
+    """
+    path = "/home/user/filer_test/file.txt"
+    with S3Transput(path, "s3://tesk/folder/file.txt", Type.File) as first:
+        with patch.object(S3Transput, 'check_if_bucket_exists') as check:
+            with S3Transput(path, "s3://tesk/folder1/folder2/file.txt", Type.File) as second:
+                assert second.bucket_obj.meta.client is first.bucket_obj.meta.client
+            check.assert_not_called()
+
+
+def test_s3_resource_per_credentials(moto_boto, monkeypatch):
+    """
+    Checking that other credentials or another endpoint get a client of their own
+    """
+    resource = get_resource()
+    assert get_resource() is resource
+    assert get_resource("http://localhost:9000") is not resource
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "other")
+    assert get_resource() is not resource
+
 # @patch('tesk_core.filer.os.makedirs')
 # @patch('builtins.open')
 # @patch('s3transfer.utils.OSUtils.rename_file')
@@ -64,6 +94,145 @@ def test_s3_download_file( moto_boto, path, url, ftype, expected, fs, caplog):
 
 
 
+@pytest.mark.parametrize("checksum,expected", [
+        ("md5:d41d8cd98f00b204e9800998ecf8427e", 0),
+        ("md5:00000000000000000000000000000000", 1),
+    ])
+def test_s3_download_file_checksum(moto_boto, checksum, expected, fs, monkeypatch):
+    """
+    Checking that a file is hashed as it is downloaded and removed if its digest differs
+    """
+    monkeypatch.setattr('tesk_core.checksum._report', [])
+    path = "/home/user/filer_test/file.txt"
+    with S3Transput(path, "s3://tesk/folder/file.txt", Type.File,
+                    options={'checksum': checksum}) as trans:
+        assert trans.download() == expected
+        assert os.path.exists(path) == (not expected)
+
+
+def throttle(client, operation, times):
+    """
+    Makes the first 'times' calls of 'operation' by 'client' fail with SlowDown, returning
+    the list of all of its calls.
+    """
+    calls = []
+
+    def slow_down(**kwargs):
+        calls.append(kwargs)
+        if len(calls) <= times:
+            raise botocore.exceptions.ClientError(
+                {'Error': {'Code': 'SlowDown', 'Message': 'Please reduce your request rate.'},
+                 'ResponseMetadata': {'HTTPStatusCode': 503}}, operation)
+
+    client.meta.events.register('before-call.s3.' + operation, slow_down)
+    return calls
+
+
+def test_s3_upload_throttled(moto_boto, tmp_path, mocker):
+    """
+    Checking that an upload the store asked to slow down is retried
+    """
+    mocker.patch('tesk_core.retry.time.sleep')
+    mocker.patch('tesk_core.retry._budget', RetryBudget(10))
+    (tmp_path / "file.txt").write_text("throttled")
+    calls = throttle(get_resource().meta.client, 'PutObject', 1)
+
+    with S3Transput(str(tmp_path / "file.txt"), "s3://tesk/folder/throttled.txt", Type.File) as trans:
+        assert with_retries(trans.upload_file, trans.url) == 0
+    assert len(calls) == 2
+    body = boto3.client('s3').get_object(Bucket='tesk', Key='folder/throttled.txt')['Body']
+    assert body.read() == b"throttled"
+
+
+def test_s3_upload_directory_failed_object(moto_boto, tmp_path, mocker, caplog):
+    """
+    Checking that an object the store refuses fails the directory upload, not the filer
+    """
+    (tmp_path / "in").mkdir()
+    (tmp_path / "in" / "ok.txt").write_text("ok")
+    (tmp_path / "in" / "denied.txt").write_text("denied")
+
+    def deny(params, **kwargs):
+        if params['Key'].endswith('denied.txt'):
+            raise botocore.exceptions.ClientError(
+                {'Error': {'Code': 'AccessDenied', 'Message': 'Access Denied'},
+                 'ResponseMetadata': {'HTTPStatusCode': 403}}, 'PutObject')
+
+    get_resource().meta.client.meta.events.register('before-parameter-build.s3.PutObject', deny)
+    with S3Transput(str(tmp_path / "in"), "s3://tesk/denied", Type.Directory) as trans:
+        assert trans.upload_dir() == 1
+    assert "Unable to upload 1 of 2 files" in caplog.text
+    assert "denied.txt" in caplog.text
+    assert boto3.client('s3').get_object(Bucket='tesk', Key='denied/ok.txt')['Body'].read() == b"ok"
+
+
+def test_s3_transfer_config(moto_boto, tmp_path, monkeypatch):
+    """
+    Checking that transfers are tuned by the TESK_FILER_S3_* settings
+    """
+    monkeypatch.setattr('tesk_core.filer_s3.MULTIPART_THRESHOLD', 16 * 1024 * 1024)
+    monkeypatch.setattr('tesk_core.filer_s3.MULTIPART_CHUNK_SIZE', 32 * 1024 * 1024)
+    monkeypatch.setattr('tesk_core.filer_s3.MAX_CONCURRENCY', 4)
+    monkeypatch.setattr('tesk_core.filer_s3.MAX_BANDWIDTH', 1024 * 1024)
+    (tmp_path / "file.txt").write_bytes(b"tuned")
+
+    with S3Transput(str(tmp_path / "file.txt"), "s3://tesk/folder/tuned.txt", Type.File) as trans:
+        with patch.object(trans.bucket_obj, 'upload_file') as upload:
+            assert trans.upload_file() == 0
+    config = upload.call_args.kwargs['Config']
+    assert config.multipart_threshold == 16 * 1024 * 1024
+    assert config.multipart_chunksize == 32 * 1024 * 1024
+    assert config.max_request_concurrency == 4
+    assert config.max_bandwidth == 1024 * 1024
+
+    monkeypatch.setattr('tesk_core.filer_s3.MAX_BANDWIDTH', 0)
+    assert transfer_config().max_bandwidth is None
+
+
+def test_s3_multipart_round_trip(moto_boto, tmp_path, monkeypatch):
+    """
+    Checking that objects transferred in several parts arrive whole
+    """
+    monkeypatch.setattr('tesk_core.filer_s3.MULTIPART_THRESHOLD', 5 * 1024 * 1024)
+    monkeypatch.setattr('tesk_core.filer_s3.MULTIPART_CHUNK_SIZE', 5 * 1024 * 1024)
+    monkeypatch.setattr('tesk_core.checksum._report', [])
+    content = os.urandom(11 * 1024 * 1024)
+    (tmp_path / "big").write_bytes(content)
+
+    with S3Transput(str(tmp_path / "big"), "s3://tesk/folder/big", Type.File) as trans:
+        assert trans.upload_file() == 0
+    etag = boto3.client('s3').head_object(Bucket='tesk', Key='folder/big')['ETag']
+    assert etag.strip('"').endswith('-3')
+
+    checksum = "md5:" + hashlib.md5(content).hexdigest()
+    with S3Transput(str(tmp_path / "copy"), "s3://tesk/folder/big", Type.File,
+                    options={'checksum': checksum}) as trans:
+        assert trans.download() == 0
+    assert (tmp_path / "copy").read_bytes() == content
+    (tmp_path / "big").unlink()
+    (tmp_path / "copy").unlink()
+
+
+def test_s3_archive(moto_boto, tmp_path):
+    """
+    Checking that a directory is uploaded as a single archive object and unpacked again on download
+    """
+    (tmp_path / "in" / "sub").mkdir(parents=True)
+    (tmp_path / "in" / "sub" / "file.txt").write_bytes(b"archived")
+    options = {'archive': 'tar.gz'}
+
+    with S3Transput(str(tmp_path / "in"), "s3://tesk/archives/in.tar.gz", Type.Directory,
+                    options=options) as trans:
+        assert trans.upload() == 0
+    keys = [obj.key for obj in boto3.resource('s3').Bucket('tesk').objects.filter(Prefix='archives/')]
+    assert keys == ['archives/in.tar.gz']
+
+    with S3Transput(str(tmp_path / "out"), "s3://tesk/archives/in.tar.gz", Type.Directory,
+                    options=options) as trans:
+        assert trans.download() == 0
+    assert (tmp_path / "out" / "sub" / "file.txt").read_bytes() == b"archived"
+
+
 @patch('tesk_core.filer.os.makedirs')
 @patch('builtins.open')
 @patch('s3transfer.utils.OSUtils.rename_file')
@@ -90,6 +259,27 @@ def test_s3_download_directory( mock_makedirs, mock_open, mock_rename, path, url
             mock_rename.assert_called_once_with('filer_test/folder2', exist_ok=True)
 
 
+def test_s3_download_directory_pages(moto_boto, tmp_path, caplog):
+    """
+    Checking that directories of more than one page of objects are downloaded entirely
+    """
+    client = boto3.client('s3', endpoint_url="http://s3.amazonaws.com")
+    for i in range(1005):
+        client.put_object(Bucket='tesk', Key='many/sub{}/file{}.txt'.format(i % 3, i),
+                          Body=str(i))
+    client.put_object(Bucket='tesk', Key='many/empty/', Body='')
+    client.put_object(Bucket='tesk', Key='many/../escape.txt', Body='')
+
+    with S3Transput(str(tmp_path / "out"), "s3://tesk/many", Type.Directory) as trans:
+        assert trans.download_dir() == 1
+    assert "Not downloading \"many/../escape.txt\"" in caplog.text
+    assert "Unable to download 1 of 1007 objects" in caplog.text
+    assert len(list((tmp_path / "out").glob("sub*/file*.txt"))) == 1005
+    assert (tmp_path / "out" / "sub2" / "file1004.txt").read_text() == "1004"
+    assert (tmp_path / "out" / "empty").is_dir()
+    assert not (tmp_path / "escape.txt").exists()
+
+
 @pytest.mark.parametrize("path, url, ftype,expected", [
         ("/home/user/filer_test/file.txt", "s3://tesk/folder/file.txt","FILE",0),
         ("/home/user/filer_test/file_new.txt", "s3://tesk/folder/file.txt","FILE",1),
@@ -135,20 +325,46 @@ def test_s3_upload_directory(path, url, ftype, expected, moto_boto, caplog):
         '''
         assert client.Object('tesk', 'folder1/folder2/test_filer.py').load() == None
 
-def test_upload_directory_for_unknown_file_type(moto_boto, fs, monkeypatch, caplog):
+def test_upload_directory_for_unknown_file_type(moto_boto, tmp_path, caplog):
     """
-        Checking whether an exception is raised when the object type is neither file or directory
-        If the exception is raised, an error message will be logged.
+        Checking that objects which are neither files nor directories are reported as failed.
+        The files next to them are uploaded all the same.
     """
-    monkeypatch.setattr(os.path, 'isfile', lambda _:False)
-    fs.create_file("/home/user/filer_test/text.txt")
+    (tmp_path / "text.txt").write_text("text")
+    os.mkfifo(str(tmp_path / "fifo"))
     url, ftype = "s3://tesk/folder10/folder20","DIRECTORY"
-    path = "/home/user/filer_test/"
-    trans = S3Transput(path, url, ftype)
+    trans = S3Transput(str(tmp_path), url, ftype)
     client = boto3.resource('s3', endpoint_url="http://s3.amazonaws.com")
     trans.bucket_obj = client.Bucket(trans.bucket)
-    trans.upload_dir()
+    try:
+        assert trans.upload_dir() == 1
+    finally:
+        # Nothing reading the leftovers of tests would ever get to its end
+        os.remove(str(tmp_path / "fifo"))
     assert "Object is neither file or directory" in caplog.text
+    assert client.Object('tesk', 'folder10/folder20/text.txt').load() == None
+
+
+def test_s3_upload_directory_tree(moto_boto, tmp_path, monkeypatch):
+    """
+        Checking that the files of all subdirectories are uploaded over one client
+    """
+    monkeypatch.setattr('tesk_core.filer_s3.WORKERS', 3)
+    for i in range(20):
+        sub = tmp_path / "in" / "a{}".format(i % 2) / "b{}".format(i % 3)
+        sub.mkdir(parents=True, exist_ok=True)
+        (sub / "file{}.txt".format(i)).write_text(str(i))
+    (tmp_path / "in" / "empty").mkdir()
+
+    with S3Transput(str(tmp_path / "in"), "s3://tesk/tree/", Type.Directory) as trans:
+        with patch.object(S3Transput, '__enter__') as enter:
+            assert trans.upload_dir() == 0
+        enter.assert_not_called()
+    keys = sorted(obj.key for obj in boto3.resource('s3').Bucket('tesk').objects.filter(Prefix='tree/'))
+    assert len(keys) == 20
+    assert 'tree/a1/b0/file3.txt' in keys
+    body = boto3.client('s3').get_object(Bucket='tesk', Key='tree/a1/b0/file3.txt')['Body']
+    assert body.read() == b'3'
 
 
 @patch("tesk_core.filer.os.path.exists", return_value=1)